@@ -0,0 +1,424 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stand in for the OpenStack APIs tempest discovery talks to
+
+Serves just enough of Keystone v2 and v3, Glance v2, Nova v2.1 and
+Neutron v2.0 for the charm's discovery, from one HTTP server with Keystone
+at the root, as the identity-admin relation gives no path, and the other
+services under their own path prefix. Listings are generated from their
+index rather than stored, so catalogues of tens of thousands of images
+cost the server next to no memory. Every request is counted per endpoint
+and can be delayed to stand in for a remote cloud.
+"""
+
+import argparse
+import collections
+import datetime
+import http.server
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+TOKEN = 'fake-token'
+USER_ID = 'fake-user-id'
+PROJECT_ID = 'fake-project-id'
+# GET returns the request counts per endpoint, POST also resets them
+STATS_PATH = '/_stats'
+# Glance's default and maximum page sizes
+GLANCE_PAGE = 25
+GLANCE_MAX_PAGE = 1000
+# Minimal image schema, glanceclient validates images against it
+IMAGE_SCHEMA = {
+    'name': 'image',
+    'properties': {
+        'id': {'type': 'string'},
+        'name': {'type': ['null', 'string']},
+        'status': {'type': 'string'},
+        'visibility': {'type': 'string'},
+    },
+    'additionalProperties': {'type': 'string'},
+    'links': [],
+}
+
+
+def resource_id(kind, index):
+    """Return a stable uuid shaped id for the index'th resource of a kind"""
+    return '{:08x}-0000-4000-8000-{:012d}'.format(
+        sum(kind.encode('utf-8')), index)
+
+
+class Catalogue(object):
+
+    """Resources served by the fake cloud
+
+    Each listing holds count resources named <kind>-<index>, with the given
+    names placed at the end of the listing, where a scan finds them last.
+    """
+
+    def __init__(self, images=10, flavors=10, networks=5, routers=5,
+                 image_names=('cirros', 'precise'),
+                 flavor_names=('m1.small', 'm1.medium'),
+                 network_names=('ext_net',),
+                 router_names=('provider-router',)):
+        self.counts = {
+            'image': max(images, len(image_names)),
+            'flavor': max(flavors, len(flavor_names)),
+            'network': max(networks, len(network_names)),
+            'router': max(routers, len(router_names)),
+        }
+        self.names = {
+            'image': list(image_names),
+            'flavor': list(flavor_names),
+            'network': list(network_names),
+            'router': list(router_names),
+        }
+
+    def name(self, kind, index):
+        named = self.names[kind]
+        first_named = self.counts[kind] - len(named)
+        if index >= first_named:
+            return named[index - first_named]
+        return '{}-{}'.format(kind, index)
+
+    def listing(self, kind, marker=None, limit=None, names=None):
+        """Return a page of resources as (index, name) pairs
+
+        :params marker: string Id of the resource before the page
+        :params limit: int Most resources to return, None for all
+        :params names: list of names to filter on
+        """
+        if names:
+            matches = [(index, name) for index, name in
+                       enumerate(self.names[kind],
+                                 self.counts[kind] - len(self.names[kind]))
+                       if name in names]
+            return matches[:limit] if limit else matches
+        start = 0
+        if marker:
+            start = int(marker.rsplit('-', 1)[1]) + 1
+        stop = self.counts[kind]
+        if limit:
+            stop = min(stop, start + limit)
+        return [(index, self.name(kind, index))
+                for index in range(start, stop)]
+
+
+class FakeOpenStack(http.server.ThreadingHTTPServer):
+
+    """Threaded HTTP server answering as a small OpenStack cloud"""
+
+    daemon_threads = True
+
+    def __init__(self, catalogue=None, latency=0, address=('127.0.0.1', 0)):
+        """
+        :params catalogue: Catalogue of the resources to serve
+        :params latency: float Seconds to delay every response by
+        :params address: (host, port) to listen on, port 0 picks one
+        """
+        super().__init__(address, FakeOpenStackHandler)
+        self.catalogue = catalogue or Catalogue()
+        self.latency = latency
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] += 1
+
+    def service_catalog(self, version):
+        """Return the token catalogue in the given identity API format"""
+        services = [
+            ('keystone', 'identity', '/v3' if version == '3' else '/v2.0'),
+            ('glance', 'image', '/image'),
+            ('nova', 'compute', '/compute/v2.1'),
+            ('neutron', 'network', '/network'),
+        ]
+        catalog = []
+        for name, service_type, path in services:
+            url = self.url + path
+            if version == '3':
+                endpoints = [{'id': '{}-{}'.format(name, interface),
+                              'interface': interface,
+                              'region': 'RegionOne',
+                              'region_id': 'RegionOne',
+                              'url': url}
+                             for interface in ('public', 'internal',
+                                               'admin')]
+            else:
+                endpoints = [{'region': 'RegionOne', 'publicURL': url,
+                              'internalURL': url, 'adminURL': url}]
+            catalog.append({'name': name, 'type': service_type,
+                            'id': name, 'endpoints': endpoints})
+        return catalog
+
+
+class FakeOpenStackHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    """(method, path regex, handler) of every API call served, the path is
+       matched with any .json suffix removed
+    """
+    routes = [
+        ('GET', r'/', 'identity_versions'),
+        ('GET', r'/v3/?', 'identity_version_v3'),
+        ('GET', r'/v2\.0/?', 'identity_version_v2'),
+        ('POST', r'/v3/auth/tokens', 'token_v3'),
+        ('POST', r'/v2\.0/tokens', 'token_v2'),
+        ('GET', r'/v2\.0/users/[^/]+/credentials/OS-EC2', 'ec2_credentials'),
+        ('GET', r'/image/?', 'image_versions'),
+        ('GET', r'/image/v2/schemas/image', 'image_schema'),
+        ('GET', r'/image/v2/images', 'images'),
+        ('GET', r'/image/v2/images/[^/]+', 'image'),
+        ('GET', r'/compute/v2\.1/?', 'compute_version'),
+        ('GET', r'/compute/v2\.1/flavors(?:/detail)?', 'flavors'),
+        ('GET', r'/compute/v2\.1/limits', 'limits'),
+        ('GET', r'/network/?', 'network_versions'),
+        ('GET', r'/network/v2\.0/networks', 'networks'),
+        ('GET', r'/network/v2\.0/routers', 'routers'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        path = re.sub(r'\.json$', '', url.path)
+        if path == STATS_PATH:
+            # The benchmark's own calls, neither delayed nor counted
+            with self.server.lock:
+                stats = dict(self.server.requests)
+                if method == 'POST':
+                    self.server.requests.clear()
+            return self.reply(200, stats)
+        self.query = urllib.parse.parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        for route_method, regex, name in self.routes:
+            if route_method == method and re.fullmatch(regex, path):
+                self.server.count('{} {}'.format(method, name))
+                status, body, headers = getattr(self, name)(path)
+                return self.reply(status, body, headers)
+        self.server.count('{} unknown'.format(method))
+        self.reply(404, {'error': 'No fake for {} {}'.format(method, path)})
+
+    def reply(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def arg(self, name, default=None):
+        return self.query.get(name, [default])[0]
+
+    def limit(self, default=None, maximum=None):
+        limit = int(self.arg('limit') or default or 0) or None
+        if limit and maximum:
+            limit = min(limit, maximum)
+        return limit
+
+    def version(self, version_id, path):
+        return {'id': version_id, 'status': 'stable',
+                'updated': '2020-01-01T00:00:00Z',
+                'links': [{'rel': 'self',
+                           'href': self.server.url + path + '/'}],
+                'media-types': [{
+                    'base': 'application/json',
+                    'type': 'application/vnd.openstack.identity-{}'
+                            '+json'.format(version_id)}]}
+
+    def identity_versions(self, path):
+        return 300, {'versions': {'values': [
+            self.version('v3.14', '/v3'),
+            self.version('v2.0', '/v2.0')]}}, None
+
+    def identity_version_v3(self, path):
+        return 200, {'version': self.version('v3.14', '/v3')}, None
+
+    def identity_version_v2(self, path):
+        return 200, {'version': self.version('v2.0', '/v2.0')}, None
+
+    def expiry(self):
+        expires = (datetime.datetime.utcnow() +
+                   datetime.timedelta(hours=1))
+        return expires.strftime('%Y-%m-%dT%H:%M:%S.000000Z')
+
+    def token_v3(self, path):
+        domain = {'id': 'default', 'name': 'Default'}
+        return 201, {'token': {
+            'methods': ['password'],
+            'expires_at': self.expiry(),
+            'issued_at': self.expiry(),
+            'user': {'id': USER_ID, 'name': 'admin', 'domain': domain},
+            'project': {'id': PROJECT_ID, 'name': 'admin',
+                        'domain': domain},
+            'roles': [{'id': 'admin', 'name': 'admin'}],
+            'catalog': self.server.service_catalog('3')}}, {
+                'X-Subject-Token': TOKEN}
+
+    def token_v2(self, path):
+        return 200, {'access': {
+            'token': {'id': TOKEN, 'expires': self.expiry(),
+                      'tenant': {'id': PROJECT_ID, 'name': 'admin'}},
+            'user': {'id': USER_ID, 'name': 'admin',
+                     'roles': [{'name': 'admin'}]},
+            'serviceCatalog': self.server.service_catalog('2'),
+            'metadata': {'roles': ['admin']}}}, None
+
+    def ec2_credentials(self, path):
+        return 200, {'credentials': [{
+            'access': 'fake-access', 'secret': 'fake-secret',
+            'user_id': USER_ID, 'tenant_id': PROJECT_ID}]}, None
+
+    def image_versions(self, path):
+        return 300, {'versions': [{
+            'id': 'v2.9', 'status': 'CURRENT',
+            'links': [{'rel': 'self',
+                       'href': self.server.url + '/image/v2/'}]}]}, None
+
+    def image_schema(self, path):
+        return 200, IMAGE_SCHEMA, None
+
+    def image_body(self, index, name):
+        return {'id': resource_id('image', index), 'name': name,
+                'status': 'active', 'visibility': 'public'}
+
+    def images(self, path):
+        limit = self.limit(GLANCE_PAGE, GLANCE_MAX_PAGE)
+        names = self.query.get('name')
+        page = self.server.catalogue.listing(
+            'image', marker=self.arg('marker'), limit=limit, names=names)
+        body = {'images': [self.image_body(index, name)
+                           for index, name in page],
+                'first': '/v2/images', 'schema': '/v2/schemas/images'}
+        if not names and len(page) == limit:
+            body['next'] = '/v2/images?{}'.format(urllib.parse.urlencode(
+                {'marker': body['images'][-1]['id'], 'limit': limit}))
+        return 200, body, None
+
+    def image(self, path):
+        image_id = path.rsplit('/', 1)[1]
+        try:
+            index = int(image_id.rsplit('-', 1)[1])
+        except (IndexError, ValueError):
+            return 404, {'message': 'No image {}'.format(image_id)}, None
+        catalogue = self.server.catalogue
+        if index >= catalogue.counts['image']:
+            return 404, {'message': 'No image {}'.format(image_id)}, None
+        return 200, self.image_body(index, catalogue.name('image', index)), \
+            None
+
+    def compute_version(self, path):
+        return 200, {'version': {
+            'id': 'v2.1', 'status': 'CURRENT', 'version': '2.90',
+            'min_version': '2.1', 'updated': '2013-07-23T11:33:21Z',
+            'links': [{'rel': 'self',
+                       'href': self.server.url + '/compute/v2.1/'}]}}, None
+
+    def flavors(self, path):
+        page = self.server.catalogue.listing(
+            'flavor', marker=self.arg('marker'), limit=self.limit())
+        return 200, {'flavors': [{
+            'id': resource_id('flavor', index), 'name': name,
+            'ram': 2048, 'vcpus': 1, 'disk': 20,
+            'OS-FLV-EXT-DATA:ephemeral': 0, 'swap': '',
+            'os-flavor-access:is_public': True,
+            'rxtx_factor': 1.0, 'links': []}
+            for index, name in page]}, None
+
+    def limits(self, path):
+        return 200, {'limits': {'rate': [], 'absolute': {
+            'maxTotalInstances': 100, 'totalInstancesUsed': 0,
+            'maxTotalCores': 200, 'totalCoresUsed': 0}}}, None
+
+    def network_versions(self, path):
+        return 200, {'versions': [{
+            'id': 'v2.0', 'status': 'CURRENT',
+            'links': [{'rel': 'self',
+                       'href': self.server.url + '/network/v2.0/'}]}]}, \
+            None
+
+    def neutron_listing(self, kind):
+        page = self.server.catalogue.listing(
+            kind, marker=self.arg('marker'), limit=self.limit(),
+            names=self.query.get('name'))
+        return 200, {kind + 's': [{
+            'id': resource_id(kind, index), 'name': name,
+            'tenant_id': PROJECT_ID, 'status': 'ACTIVE'}
+            for index, name in page]}, None
+
+    def networks(self, path):
+        return self.neutron_listing('network')
+
+    def routers(self, path):
+        return self.neutron_listing('router')
+
+
+def main(argv=None):
+    """Serve a fake cloud until stopped, printing its url once it is up"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--images', type=int, default=10)
+    parser.add_argument('--flavors', type=int, default=10)
+    parser.add_argument('--networks', type=int, default=5)
+    parser.add_argument('--routers', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds to delay each response by')
+    args = parser.parse_args(argv)
+    server = FakeOpenStack(
+        Catalogue(images=args.images, flavors=args.flavors,
+                  networks=args.networks, routers=args.routers),
+        latency=args.latency / 1000.0, address=('127.0.0.1', args.port))
+    print(server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure what importing the charm costs every hook at startup
+
+Each hook imports reactive/tempest_handlers.py and with it
+charm.openstack.tempest. Every scenario is timed in a fresh interpreter,
+so nothing is already imported, and reports the import time, the peak
+RSS of the interpreter and the OpenStack client packages it loaded.
+
+The hook scenario is what a hook pays now. The hook-with-clients scenario
+also imports the client libraries, which is what every hook paid when
+they were imported at module load, so the two give the before and after
+of deferring them to discovery.
+
+Run it with an interpreter which has the charm's dependencies, for
+example from the top of the charm repository:
+
+    python3 benchmarks/import_time.py --repeat 20 --top 15
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+# Top level packages of the OpenStack client libraries
+CLIENT_PACKAGES = ['glanceclient', 'keystoneauth1', 'keystoneclient',
+                   'neutronclient', 'novaclient', 'requests', 'subunit']
+# Client modules charm.openstack.tempest used to import at module load
+CLIENT_MODULES = [
+    'glanceclient',
+    'keystoneauth1.identity.v2',
+    'keystoneauth1.identity.v3',
+    'keystoneauth1.session',
+    'keystoneclient.v2_0.client',
+    'keystoneclient.v3.client',
+    'neutronclient.v2_0.client',
+    'novaclient.client',
+    'requests.adapters',
+    'subunit',
+]
+# Timed in a fresh interpreter, the modules to import are its arguments
+PROBE = """
+import importlib
+import json
+import resource
+import sys
+import time
+
+start = time.perf_counter()
+for name in sys.argv[2:]:
+    importlib.import_module(name)
+elapsed = time.perf_counter() - start
+packages = set(name.split('.')[0] for name in sys.modules)
+print(json.dumps({
+    'seconds': elapsed,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'modules': len(sys.modules),
+    'clients': sorted(packages.intersection(json.loads(sys.argv[1])))}))
+"""
+# Match -X importtime lines like: 'import time:  120 |  4031 | charm.x'
+IMPORTTIME_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def probe_env(paths):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        paths + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+
+def measure(modules, env, repeat):
+    """Import modules in repeat fresh interpreters
+
+    @returns dict of the median import time and the last run's details,
+             or an error if the modules could not be imported
+    """
+    samples = []
+    for _ in range(repeat):
+        proc = subprocess.run(
+            [sys.executable, '-c', PROBE, json.dumps(CLIENT_PACKAGES)] +
+            modules, env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode:
+            return {'error': proc.stderr.strip().splitlines()[-1]}
+        samples.append(json.loads(proc.stdout))
+    result = dict(samples[-1])
+    times = [sample['seconds'] for sample in samples]
+    result['seconds'] = statistics.median(times)
+    result['min_seconds'] = min(times)
+    return result
+
+
+def slowest_imports(modules, env, top):
+    """Return the top cumulative import times of modules, in seconds"""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import ' + ', '.join(modules)],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    timings = []
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            timings.append((int(match.group(2)) / 1e6, match.group(4)))
+    return sorted(timings, reverse=True)[:top]
+
+
+def main(argv=None):
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='fresh interpreters to time each scenario in')
+    parser.add_argument('--module', default='charm.openstack.tempest',
+                        help='module a hook imports')
+    parser.add_argument('--path', action='append',
+                        help='directories to import the charm from, '
+                             'src/lib and src of this repository by default')
+    parser.add_argument('--top', type=int, default=0,
+                        help='also list the slowest imports of a hook')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args(argv)
+    env = probe_env(args.path or [os.path.join(repo, 'src', 'lib'),
+                                  os.path.join(repo, 'src')])
+    scenarios = [
+        ('hook', [args.module]),
+        ('hook-with-clients', [args.module] + CLIENT_MODULES),
+    ]
+    results = {name: measure(modules, env, args.repeat)
+               for name, modules in scenarios}
+    if args.top:
+        results['slowest-imports'] = slowest_imports(
+            [args.module], env, args.top)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print('{:<20} {:>10} {:>10} {:>10} {:>8}  {}'.format(
+        'scenario', 'median s', 'min s', 'rss MiB', 'modules', 'clients'))
+    for name, _ in scenarios:
+        result = results[name]
+        if 'error' in result:
+            print('{:<20} {}'.format(name, result['error']))
+            continue
+        print('{:<20} {:>10.3f} {:>10.3f} {:>10.1f} {:>8}  {}'.format(
+            name, result['seconds'], result['min_seconds'],
+            result['max_rss_kb'] / 1024.0, result['modules'],
+            ', '.join(result['clients']) or '-'))
+    for seconds, module in results.get('slowest-imports', []):
+        print('{:>10.3f}  {}'.format(seconds, module))
+
+
+if __name__ == '__main__':
+    main()
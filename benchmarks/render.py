@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark discovery and config rendering against a fake OpenStack
+
+Each scenario starts benchmarks/fake_openstack.py in its own process with
+the given catalogue sizes and latency, then times full renders of
+tempest.conf: a TempestAdminAdapter is built from an identity-admin
+relation pointing at the fake cloud, runs discovery and the template is
+rendered from it. Every render starts with a fresh adapter, so it pays for
+authentication as an action would, and the discovery cache is disabled.
+
+Reported per scenario are the median and fastest wall time, the requests
+made per endpoint and the peak memory allocated by a render, measured
+with tracemalloc in a separate render so it does not skew the timings.
+
+Run it with an interpreter which has the charm's dependencies, for
+example from the top of the charm repository:
+
+    python3 benchmarks/render.py --images 10,1000,50000 --flavors 2000 \\
+        --latency 20
+"""
+
+import argparse
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+
+import mock
+import yaml
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCHMARKS)
+sys.path[:0] = [os.path.join(REPO, 'src', 'lib'), os.path.join(REPO, 'src'),
+                BENCHMARKS]
+
+import jinja2  # noqa: E402
+
+import charm.openstack.tempest as tempest  # noqa: E402
+import fake_openstack  # noqa: E402
+
+
+class FakeRelation(object):
+
+    """identity-admin relation of a keystone in the fake cloud"""
+
+    relation_name = 'identity-admin'
+    endpoint_name = 'identity-admin'
+    auto_accessors = []
+
+    def __init__(self, url, api_version):
+        self.url = urllib.parse.urlsplit(url)
+        self.api_version = api_version
+
+    def credentials(self):
+        return {
+            'service_hostname': self.url.hostname,
+            'service_port': str(self.url.port),
+            'service_username': 'admin',
+            'service_password': 'password',
+            'service_tenant_name': 'admin',
+            'service_region': 'RegionOne',
+            'api_version': self.api_version}
+
+
+class FakeCloud(object):
+
+    """fake_openstack.py running in a process of its own"""
+
+    def __init__(self, images, flavors, latency):
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.join(BENCHMARKS, 'fake_openstack.py'),
+             '--images', str(images), '--flavors', str(flavors),
+             '--latency', str(latency)],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        self.url = self.proc.stdout.readline().strip()
+
+    def stats(self, reset=False):
+        request = urllib.request.Request(
+            self.url + fake_openstack.STATS_PATH,
+            method='POST' if reset else 'GET')
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+def charm_config():
+    """Return the default charm options with the discovery cache disabled"""
+    with open(os.path.join(REPO, 'src', 'config.yaml')) as config_file:
+        options = yaml.safe_load(config_file)['options']
+    config = {name: option.get('default')
+              for name, option in options.items()}
+    config['discovery-cache-ttl'] = 0
+    return config
+
+
+def render(url, api_version):
+    """Discover the fake cloud and render tempest.conf from the results"""
+    adapter = tempest.TempestAdminAdapter(FakeRelation(url, api_version))
+    adapter.prefetch_discovery()
+    templates = jinja2.Environment(loader=jinja2.FileSystemLoader(
+        os.path.join(REPO, 'src', 'templates')))
+    return templates.get_template('tempest.conf').render(
+        identity_admin=adapter,
+        options=tempest.TempestConfigurationAdapter())
+
+
+def run_scenario(images, flavors, latency, api_version, repeat):
+    cloud = FakeCloud(images, flavors, latency)
+    try:
+        cloud.stats(reset=True)
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            render(cloud.url, api_version)
+            times.append(time.perf_counter() - start)
+        requests = {endpoint: count / float(repeat)
+                    for endpoint, count in cloud.stats(reset=True).items()}
+        tracemalloc.start()
+        try:
+            render(cloud.url, api_version)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    finally:
+        cloud.stop()
+    return {
+        'images': images,
+        'flavors': flavors,
+        'latency_ms': latency,
+        'seconds': statistics.median(times),
+        'min_seconds': min(times),
+        'requests': sum(requests.values()),
+        'requests_per_endpoint': requests,
+        'peak_bytes': peak,
+    }
+
+
+def sizes(value):
+    return [int(size) for size in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=sizes, default=[10],
+                        help='comma separated image catalogue sizes')
+    parser.add_argument('--flavors', type=sizes, default=[10],
+                        help='comma separated flavor catalogue sizes')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds the cloud takes per request')
+    parser.add_argument('--api-version', choices=['2', '3'], default='3',
+                        help='identity API version of the relation')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed renders per scenario')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args(argv)
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            mock.patch.object(tempest.hookenv, 'config',
+                              return_value=charm_config()), \
+            mock.patch.object(tempest.hookenv, 'action_get',
+                              return_value={}), \
+            mock.patch.object(tempest.hookenv, 'log'), \
+            mock.patch.object(tempest.TempestCharm, 'DISCOVERY_CACHE',
+                              new=os.path.join(tmpdir, 'discovery.json')):
+        for images, flavors in itertools.product(args.images, args.flavors):
+            results.append(run_scenario(images, flavors, args.latency,
+                                        args.api_version, args.repeat))
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print('{:>8} {:>8} {:>10} {:>10} {:>9} {:>9}'.format(
+        'images', 'flavors', 'median s', 'min s', 'requests', 'peak MiB'))
+    for result in results:
+        print('{:>8} {:>8} {:>10.3f} {:>10.3f} {:>9g} {:>9.1f}'.format(
+            result['images'], result['flavors'], result['seconds'],
+            result['min_seconds'], result['requests'],
+            result['peak_bytes'] / 1048576.0))
+        for endpoint, count in sorted(
+                result['requests_per_endpoint'].items()):
+            print('{:>20g}  {}'.format(count, endpoint))
+
+
+if __name__ == '__main__':
+    main()
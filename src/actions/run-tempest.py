@@ -21,4 +21,4 @@ if __name__ == '__main__':
             "The identity-admin interface is not available - bailing")
     else:
         tempest.render_configs([identity_int])
-        tempest.run_test('smoke')
+        tempest.run_test('smoke', [identity_int])
@@ -0,0 +1,15 @@
+#!/usr/local/sbin/charm-env python3
+import sys
+sys.path.append('lib')
+
+# Make sure that reactive is bootstrapped and all the states are setup
+# properly
+from charms.layer import basic
+basic.bootstrap_charm_deps()
+basic.init_config_states()
+
+import charm.openstack.tempest as tempest
+
+
+if __name__ == '__main__':
+    tempest.run_status()
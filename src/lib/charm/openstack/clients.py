@@ -0,0 +1,183 @@
+import threading
+
+import charm.openstack.discovery as discovery
+import charm.openstack.timing as timing
+
+# The OpenStack client libraries are imported where they are first used
+# rather than here, as every hook imports this module through the tempest
+# module and only discovery needs them.
+
+# Connections kept open per host, enough for every concurrent lookup
+POOL_SIZE = discovery.DISCOVERY_WORKERS * 2
+
+
+class ClientFactory(object):
+
+    """Hand out OpenStack clients which share one authenticated session
+
+    The keystoneauth plugin caches its token and only re-authenticates
+    when the token is about to expire, and the underlying requests session
+    keeps connections alive in a pool, so clients built here reuse both
+    the token and the TCP/TLS connections. One client is built per service
+    type and cached.
+    """
+
+    def __init__(self, api_version, credentials, region_name=None,
+                 timeout=None, http_stats=None):
+        """
+        :params api_version: string Identity API version, '2' or '3'
+        :params credentials: dict Keyword arguments for the keystoneauth
+                             Password plugin of the given version
+        :params region_name: string Region to pick endpoints from
+        :params timeout: int Seconds to allow each HTTP request
+        :params http_stats: timing.HTTPStats to record every request in,
+                            the running hook or action's by default
+        """
+        self.api_version = api_version
+        self.credentials = credentials
+        self.region_name = region_name
+        self.timeout = timeout
+        self.http_stats = http_stats or timing.HTTP
+        self._session = None
+        self._clients = {}
+        self._lock = threading.RLock()
+
+    @property
+    def session(self):
+        """Shared keystoneauth session, created on first use"""
+        with self._lock:
+            if not self._session:
+                self._session = self.new_session()
+        return self._session
+
+    def new_session(self):
+        import keystoneauth1.identity.v2 as keystoneauth1_v2
+        import keystoneauth1.identity.v3 as keystoneauth1_v3
+        import keystoneauth1.session as keystoneauth1_session
+        import requests
+        import requests.adapters
+
+        if self.api_version == '3':
+            auth = keystoneauth1_v3.Password(**self.credentials)
+        else:
+            auth = keystoneauth1_v2.Password(**self.credentials)
+        http = requests.Session()
+        pool = requests.adapters.HTTPAdapter(
+            pool_connections=POOL_SIZE,
+            pool_maxsize=POOL_SIZE)
+        http.mount('http://', pool)
+        http.mount('https://', pool)
+        http.hooks['response'].append(self.http_stats.hook)
+        return keystoneauth1_session.Session(
+            auth=auth,
+            session=http,
+            timeout=self.timeout)
+
+    def client(self, service_type):
+        """Return the cached client for service_type, building it if needed
+
+        :params service_type: string One of identity, image, compute, network
+        """
+        with self._lock:
+            if service_type not in self._clients:
+                build = getattr(self, '_{}_client'.format(service_type))
+                self._clients[service_type] = build()
+            return self._clients[service_type]
+
+    def _identity_client(self):
+        import keystoneclient.v2_0.client as keystoneclient_v2
+        import keystoneclient.v3.client as keystoneclient_v3
+
+        if self.api_version == '3':
+            return keystoneclient_v3.Client(
+                session=self.session,
+                region_name=self.region_name)
+        return keystoneclient_v2.Client(
+            session=self.session,
+            region_name=self.region_name)
+
+    def _image_client(self):
+        import glanceclient
+
+        return glanceclient.Client(
+            '2',
+            session=self.session,
+            region_name=self.region_name)
+
+    def _compute_client(self):
+        import novaclient.client as novaclient_client
+
+        return novaclient_client.Client(
+            2,
+            session=self.session,
+            region_name=self.region_name)
+
+    def _network_client(self):
+        import neutronclient.v2_0.client as neutronclient
+
+        return neutronclient.Client(
+            session=self.session,
+            region_name=self.region_name)
+
+
+class ServiceCatalogue(object):
+
+    """Index of the service catalogue carried by a keystone token
+
+    Services are indexed by type and name and endpoints by
+    (service type, interface, region) so presence checks and endpoint
+    lookups need no further requests to keystone. Both the v2 and v3
+    catalogue formats are understood.
+    """
+
+    interfaces = ['public', 'internal', 'admin']
+
+    def __init__(self, catalog):
+        """
+        :params catalog: list of service dicts from the token's catalogue
+        """
+        self.services_by_type = {}
+        self.services_by_name = {}
+        self.endpoints = {}
+        for service in catalog:
+            service_type = service.get('type')
+            self.services_by_type[service_type] = service
+            self.services_by_name[service.get('name')] = service
+            for endpoint in service.get('endpoints', []):
+                region = endpoint.get('region_id') or endpoint.get('region')
+                if 'interface' in endpoint:
+                    self.add_endpoint(service_type, endpoint['interface'],
+                                      region, endpoint.get('url'))
+                else:
+                    for interface in self.interfaces:
+                        self.add_endpoint(
+                            service_type, interface, region,
+                            endpoint.get('{}URL'.format(interface)))
+
+    @classmethod
+    def from_session(cls, session):
+        """Build the index from the token held by a keystoneauth session
+
+        The token is fetched if the session has not authenticated yet,
+        otherwise the cached token is used and no request is made.
+        """
+        access = session.auth.get_access(session)
+        return cls(access.service_catalog.catalog)
+
+    def add_endpoint(self, service_type, interface, region, url):
+        if not url:
+            return
+        self.endpoints.setdefault((service_type, interface, region), url)
+        # Also index the first endpoint seen for any region
+        self.endpoints.setdefault((service_type, interface, None), url)
+
+    def has_service(self, name):
+        return name in self.services_by_name
+
+    def service_names(self):
+        return sorted(self.services_by_name)
+
+    def url_for(self, service_type, interface='public', region=None):
+        """Return the endpoint url, or None if there is no such endpoint"""
+        return (self.endpoints.get((service_type, interface, region)) or
+                self.endpoints.get((service_type, interface, None)))
@@ -0,0 +1,233 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+
+import charmhelpers.core.hookenv as hookenv
+
+# Number of records to request per page when scanning a listing
+SCAN_PAGE_SIZE = 100
+# Upper bound on the number of lookups sent to the cloud at once
+DISCOVERY_WORKERS = 5
+
+
+def field(resource, name):
+    """Read an attribute from a client resource or a plain dict
+
+    glanceclient and novaclient return objects while neutronclient returns
+    dicts, so lookups need to cope with both.
+    """
+    if isinstance(resource, dict):
+        return resource.get(name)
+    return getattr(resource, name, None)
+
+
+def paginate(list_page, page_size=SCAN_PAGE_SIZE):
+    """Lazily walk a marker/limit paginated listing
+
+    :params list_page: callable(marker=, limit=) returning one page
+    :params page_size: int Number of records to request per page
+    @returns generator over all records, fetching pages only as needed
+    """
+    marker = None
+    while True:
+        page = list(list_page(marker=marker, limit=page_size))
+        for resource in page:
+            yield resource
+        if len(page) < page_size:
+            return
+        marker = field(page[-1], 'id')
+
+
+def resolve_names(names, lookup=None, scan=None, batch=False,
+                  kind='resource'):
+    """Resolve resource names to resources using as few requests as possible
+
+    Names are first resolved with a server side filtered lookup. Any name
+    whose lookup fails, or all names if no lookup is available, are then
+    resolved by scanning the listing, which stops as soon as every
+    outstanding name has been seen.
+
+    :params names: list of names to resolve, empty names are ignored
+    :params lookup: callable(list of names) returning matching resources
+    :params scan: callable() returning an iterable over all resources
+    :params batch: Boolean pass all names to one lookup call rather than
+                   one call per name
+    :params kind: string Resource type used when reporting unmatched names
+    @returns {name: resource, ...} for each name that was found
+    """
+    pending = sorted(set(name for name in names if name))
+    found = {}
+    fallback = set()
+    if lookup:
+        groups = [pending] if batch else [[name] for name in pending]
+        for group in groups:
+            if not group:
+                continue
+            try:
+                for resource in lookup(group):
+                    name = field(resource, 'name')
+                    if name in group and name not in found:
+                        found[name] = resource
+            except Exception as e:
+                hookenv.log(
+                    "Filtered {} lookup for {} failed, falling back to a "
+                    "scan: {}".format(kind, ', '.join(group), e),
+                    level=hookenv.WARNING)
+                fallback.update(group)
+    else:
+        fallback.update(pending)
+    fallback.difference_update(found)
+    if scan and fallback:
+        for resource in scan():
+            name = field(resource, 'name')
+            if name in fallback:
+                found[name] = resource
+                fallback.discard(name)
+                if not fallback:
+                    break
+    unmatched = [name for name in pending if name not in found]
+    if unmatched:
+        hookenv.log(
+            "Unable to find {} named: {}".format(kind, ', '.join(unmatched)),
+            level=hookenv.WARNING)
+    return found
+
+
+def parse_timeouts(value):
+    """Parse per lookup timeouts given as "key=seconds" pairs
+
+    Pairs are separated by commas or whitespace, pairs which do not parse
+    are logged and skipped.
+
+    @returns {key: seconds, ...}
+    """
+    timeouts = {}
+    for pair in (value or '').replace(',', ' ').split():
+        key, _, seconds = pair.partition('=')
+        try:
+            timeouts[key.strip()] = int(seconds)
+        except ValueError:
+            hookenv.log("Ignoring invalid discovery timeout {}".format(pair),
+                        level=hookenv.WARNING)
+    return timeouts
+
+
+def run_concurrently(lookups, timeouts=None, default_timeout=None,
+                     max_workers=DISCOVERY_WORKERS):
+    """Run independent lookups at the same time on a bounded thread pool
+
+    Each lookup has its own deadline, measured from when the batch was
+    started, so a slow endpoint only costs its own timeout and does not
+    hold up the results of the others. Lookups that fail or time out are
+    logged and left out of the results.
+
+    :params lookups: {key: callable, ...} lookups to run
+    :params timeouts: {key: seconds, ...} per lookup timeouts
+    :params default_timeout: seconds to allow lookups missing from timeouts,
+                             None waits indefinitely
+    :params max_workers: int Maximum number of lookups in flight at once
+    @returns {key: result, ...} for each lookup that completed
+    """
+    timeouts = timeouts or {}
+    results = {}
+    if not lookups:
+        return results
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max_workers, len(lookups)))
+    start = time.monotonic()
+    futures = {key: executor.submit(func) for key, func in lookups.items()}
+    try:
+        for key, future in futures.items():
+            timeout = timeouts.get(key, default_timeout)
+            if timeout is not None:
+                timeout = max(0, start + timeout - time.monotonic())
+            try:
+                results[key] = future.result(timeout=timeout)
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                hookenv.log(
+                    "Discovery of {} timed out".format(key),
+                    level=hookenv.WARNING)
+            except Exception as e:
+                hookenv.log(
+                    "Discovery of {} failed: {}".format(key, e),
+                    level=hookenv.WARNING)
+    finally:
+        # Do not wait on lookups that overran their timeout.
+        executor.shutdown(wait=False)
+    return results
+
+
+def fingerprint(*inputs):
+    """Return a stable digest of JSON serialisable inputs"""
+    data = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class DiscoveryCache(object):
+
+    """Discovery results persisted on disk between action runs
+
+    An entry is only used if it was stored for the same fingerprint of the
+    discovery inputs and is younger than the ttl. The file can hold ec2
+    credentials so it is only readable by its owner.
+    """
+
+    def __init__(self, path, fingerprint, ttl):
+        """
+        :params path: string File to store the cache in
+        :params fingerprint: string Digest of the inputs to discovery
+        :params ttl: int Seconds an entry stays valid, 0 disables the cache
+        """
+        self.path = path
+        self.fingerprint = fingerprint
+        self.ttl = ttl or 0
+
+    def read(self):
+        """Return the stored entry if it is within the ttl, else None
+
+        The entry is returned whatever inputs it was stored for.
+        """
+        if self.ttl <= 0 or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'r') as cache_file:
+                entry = json.load(cache_file)
+        except (IOError, ValueError) as e:
+            hookenv.log("Ignoring unreadable discovery cache {}: {}".format(
+                self.path, e), level=hookenv.WARNING)
+            return None
+        if time.time() - entry.get('created', 0) > self.ttl:
+            return None
+        return entry
+
+    def load(self):
+        """Return the cached snapshot or None if it is missing or stale"""
+        entry = self.read()
+        if not entry or entry.get('fingerprint') != self.fingerprint:
+            return None
+        return entry.get('snapshot')
+
+    def save(self, snapshot):
+        if self.ttl <= 0:
+            return
+        entry = {
+            'fingerprint': self.fingerprint,
+            'created': time.time(),
+            'snapshot': snapshot}
+        tmp_path = '{}.tmp'.format(self.path)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(entry, cache_file)
+            os.rename(tmp_path, self.path)
+        finally:
+            # Left behind only if the snapshot could not be written
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -0,0 +1,221 @@
+import argparse
+import fcntl
+import gzip
+import json
+import os
+import shutil
+import time
+
+# Suffix of a run file once it has been compressed
+COMPRESSED_SUFFIX = '.gz'
+# Run files which are compressed once the run has finished
+COMPRESSED_TYPES = ('.log', '.subunit')
+# Prefix of the names get_tempest_files gives the files of a run
+RUN_PREFIX = 'run_'
+# Index of the runs in a log directory
+INDEX_NAME = 'index.json'
+# Lock held while a log directory is rotated
+LOCK_NAME = '.rotate.lock'
+
+
+def run_id(name):
+    """Return the id of the run a file belongs to, None if it is not a run's
+
+    The files of a run share the stem of its log, run_<timestamp>.
+    """
+    if not name.startswith(RUN_PREFIX):
+        return None
+    return name.split('.', 1)[0]
+
+
+def open_log(path, mode='r'):
+    """Open a run file, reading its compressed copy if it has been rotated
+
+    :params path: string Path the file was written to
+    :params mode: string 'r' to read text or 'rb' to read bytes
+    """
+    compressed = path + COMPRESSED_SUFFIX
+    if not os.path.exists(path) and os.path.exists(compressed):
+        return gzip.open(compressed, mode if 'b' in mode else 'rt')
+    return open(path, mode)
+
+
+def compress(path):
+    """Replace path with a gzip compressed copy
+
+    The file is streamed through the compressor so large logs are never
+    read into memory, and the copy keeps the original's mtime.
+
+    @returns string Path of the compressed copy
+    """
+    target = path + COMPRESSED_SUFFIX
+    tmp_path = '{}.tmp'.format(target)
+    stat = os.stat(path)
+    with open(path, 'rb') as source, open(tmp_path, 'wb') as raw:
+        with gzip.GzipFile(filename=os.path.basename(path), mode='wb',
+                           fileobj=raw, mtime=stat.st_mtime) as copy:
+            shutil.copyfileobj(source, copy)
+    os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+    os.rename(tmp_path, target)
+    os.unlink(path)
+    return target
+
+
+def scan(logdir):
+    """Group the files in logdir by the run they belong to
+
+    @returns {run_id: {'files': [name, ...], 'bytes': int, 'mtime': float}}
+    """
+    runs = {}
+    for name in sorted(os.listdir(logdir)):
+        path = os.path.join(logdir, name)
+        if not run_id(name) or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        run = runs.setdefault(run_id(name),
+                              {'files': [], 'bytes': 0, 'mtime': 0})
+        run['files'].append(name)
+        run['bytes'] += stat.st_size
+        run['mtime'] = max(run['mtime'], stat.st_mtime)
+    return runs
+
+
+def expired(runs, max_runs=0, max_age=0, max_bytes=0, keep=(), now=None):
+    """Choose the runs to remove to bring logs within the retention limits
+
+    Runs are removed oldest first until every limit is met. Runs in keep
+    are never removed but still count towards the limits.
+
+    :params runs: {run_id: {'bytes': int, 'mtime': float}, ...} as scanned
+    :params max_runs: int Number of runs to keep, 0 for no limit
+    :params max_age: int Seconds to keep a run for, 0 for no limit
+    :params max_bytes: int Total size of the runs to keep, 0 for no limit
+    :params keep: list of ids of runs which must be kept
+    @returns list of the ids of the runs to remove, oldest first
+    """
+    now = now or time.time()
+    count = len(runs)
+    total = sum(run['bytes'] for run in runs.values())
+    removed = []
+    for rid in sorted(runs):
+        if rid in keep:
+            continue
+        run = runs[rid]
+        if ((max_runs and count > max_runs) or
+                (max_age and now - run['mtime'] > max_age) or
+                (max_bytes and total > max_bytes)):
+            removed.append(rid)
+            count -= 1
+            total -= run['bytes']
+    return removed
+
+
+class LogIndex(object):
+
+    """Runs in a log directory and their files, indexed in the directory
+
+    Looking a run up in the index saves listing a directory which can hold
+    the logs of hundreds of runs, and finds its files whether or not they
+    have been compressed since the run.
+    """
+
+    def __init__(self, logdir):
+        self.logdir = logdir
+        self.path = os.path.join(logdir, INDEX_NAME)
+
+    def load(self):
+        """Return the indexed runs, {} if there is no readable index"""
+        try:
+            with open(self.path, 'r') as index_file:
+                return json.load(index_file).get('runs', {})
+        except (IOError, ValueError):
+            return {}
+
+    def save(self, runs):
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as index_file:
+            json.dump({'updated': time.time(), 'runs': runs}, index_file)
+        os.rename(tmp_path, self.path)
+
+    def lookup(self, rid, suffix='.log'):
+        """Return the path of a run's file, None if it has been removed
+
+        Runs which finished since the index was last saved are looked for
+        in the directory.
+
+        :params rid: string Id of the run
+        :params suffix: string Type of file to find, .log or .subunit
+        """
+        names = [rid + suffix, rid + suffix + COMPRESSED_SUFFIX]
+        run = self.load().get(rid)
+        for name in names:
+            if run and name in run['files']:
+                return os.path.join(self.logdir, name)
+        for name in names:
+            path = os.path.join(self.logdir, name)
+            if os.path.exists(path):
+                return path
+        return None
+
+
+def rotate(logdir, active=(), max_runs=0, max_age=0, max_bytes=0,
+           runs_dir=None, now=None):
+    """Expire old runs, compress finished ones and reindex the directory
+
+    :params logdir: string Directory holding the runs' files
+    :params active: list of ids of runs still being written, which are
+                    neither removed nor compressed
+    :params runs_dir: string Directory of detached run jobs, the job of a
+                      removed run is removed with it
+    @returns list of the ids of the removed runs
+    """
+    runs = scan(logdir)
+    removed = expired(runs, max_runs=max_runs, max_age=max_age,
+                      max_bytes=max_bytes, keep=active, now=now)
+    for rid in removed:
+        for name in runs.pop(rid)['files']:
+            os.unlink(os.path.join(logdir, name))
+        if runs_dir:
+            shutil.rmtree(os.path.join(runs_dir, rid), ignore_errors=True)
+    for rid, run in runs.items():
+        if rid in active:
+            continue
+        for name in run['files']:
+            if name.endswith('.tmp'):
+                # Left behind by an interrupted compression
+                os.unlink(os.path.join(logdir, name))
+        for name in run['files']:
+            if os.path.splitext(name)[1] in COMPRESSED_TYPES:
+                compress(os.path.join(logdir, name))
+    LogIndex(logdir).save(scan(logdir))
+    return removed
+
+
+def main(argv=None):
+    """Rotate the log directory given on the command line
+
+    The charm starts this detached from its hooks and actions so that
+    compressing large logs does not hold them up. A rotation which finds
+    another already running leaves the directory to it.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('logdir')
+    parser.add_argument('--active', action='append', default=[])
+    parser.add_argument('--max-runs', type=int, default=0)
+    parser.add_argument('--max-days', type=int, default=0)
+    parser.add_argument('--max-megabytes', type=int, default=0)
+    parser.add_argument('--runs-dir')
+    args = parser.parse_args(argv)
+    with open(os.path.join(args.logdir, LOCK_NAME), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        rotate(args.logdir, active=args.active, max_runs=args.max_runs,
+               max_age=args.max_days * 86400,
+               max_bytes=args.max_megabytes * 1024 * 1024,
+               runs_dir=args.runs_dir)
+
+
+if __name__ == '__main__':
+    main()
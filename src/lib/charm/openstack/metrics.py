@@ -0,0 +1,251 @@
+import bisect
+import fcntl
+import json
+import os
+import time
+
+# Upper bounds in seconds of the buckets of each histogram, every histogram
+# also has a +Inf bucket
+TEST_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RUN_BUCKETS = (60, 300, 600, 900, 1800, 3600, 7200, 14400, 28800)
+PHASE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 14400)
+# File written to the node exporter's textfile collector directory
+TEXTFILE_NAME = 'tempest.prom'
+# Phase whose time is the duration of a run, as timed by timing.PhaseTimer
+RUN_PHASE = 'execute-tox'
+
+
+class Histogram(object):
+
+    """Counts of observations in fixed buckets, as a Prometheus histogram
+
+    Only the count in each bucket and the sum of the observations are kept
+    so a histogram takes the same space however many runs it covers.
+    """
+
+    def __init__(self, buckets, counts=None, total=0.0):
+        """
+        :params buckets: tuple of the upper bounds of the buckets, ascending
+        :params counts: list of counts per bucket as returned by dump(),
+                        ignored if the buckets have changed since
+        :params total: float Sum of the observations counted
+        """
+        self.buckets = tuple(buckets)
+        if counts and len(counts) == len(self.buckets) + 1:
+            self.counts = list(counts)
+            self.total = total
+        else:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def dump(self):
+        return {'counts': self.counts, 'sum': self.total}
+
+    def samples(self, name, labels):
+        """Return the exposition lines of the histogram
+
+        Buckets are reported cumulatively, each counting the observations
+        less than or equal to its bound.
+        """
+        lines = []
+        cumulative = 0
+        bounds = [format_value(bound) for bound in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, self.counts):
+            cumulative += count
+            lines.append(sample(name + '_bucket',
+                                dict(labels, le=bound), cumulative))
+        lines.append(sample(name + '_sum', labels, self.total))
+        lines.append(sample(name + '_count', labels, cumulative))
+        return lines
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def sample(name, labels, value):
+    """Return an exposition line for a sample"""
+    if labels:
+        name += '{{{}}}'.format(','.join(
+            '{}="{}"'.format(key, str(labels[key]).replace('\\', r'\\')
+                             .replace('"', r'\"').replace('\n', r'\n'))
+            for key in sorted(labels)))
+    return '{} {}'.format(name, format_value(value))
+
+
+class RunMetrics(object):
+
+    """Metrics of the tempest runs on this unit, kept in a JSON file
+
+    Counters and histograms accumulate over every run recorded and are
+    updated from each run's results as it finishes, they are never rebuilt
+    from the logs or results history. The last run of each tox target is
+    also kept so its totals, duration and phase times can be reported.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as state_file:
+                self.state = json.load(state_file)
+        except (IOError, ValueError):
+            self.state = {}
+        return self
+
+    def save(self):
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as state_file:
+            json.dump(self.state, state_file)
+        os.rename(tmp_path, self.path)
+
+    def observe(self, kind, key, buckets, values):
+        """Add values to the histogram of kind for key"""
+        stored = self.state.setdefault('histograms', {}).setdefault(kind, {})
+        data = stored.get(key) or {}
+        histogram = Histogram(buckets, data.get('counts'),
+                              data.get('sum', 0.0))
+        for value in values:
+            histogram.observe(value)
+        stored[key] = histogram.dump()
+
+    def record_run(self, target, counts, durations, phases=None, now=None):
+        """Add the results of a run
+
+        :params target: string tox target of the run
+        :params counts: {status: int, ...} as results.count_statuses
+        :params durations: iterable of the seconds each test took
+        :params phases: {name: seconds, ...} of the phases of the run
+        """
+        phases = phases or {}
+        self.state.setdefault('runs', {})
+        self.state['runs'][target] = self.state['runs'].get(target, 0) + 1
+        totals = self.state.setdefault('tests', {}).setdefault(target, {})
+        for status, count in counts.items():
+            totals[status] = totals.get(status, 0) + count
+        self.observe('test', target, TEST_BUCKETS, durations)
+        last_run = {'timestamp': now or time.time(), 'counts': dict(counts),
+                    'phases': dict(phases)}
+        if RUN_PHASE in phases:
+            last_run['duration'] = phases[RUN_PHASE]
+            self.observe('run', target, RUN_BUCKETS, [phases[RUN_PHASE]])
+        for name, seconds in phases.items():
+            self.observe('phase', name, PHASE_BUCKETS, [seconds])
+        self.state.setdefault('last_run', {})[target] = last_run
+
+    def exposition(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def family(name, kind, doc, samples):
+            if samples:
+                lines.append('# HELP {} {}'.format(name, doc))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                lines.extend(samples)
+
+        state = self.state
+        last_runs = sorted(state.get('last_run', {}).items())
+        histograms = state.get('histograms', {})
+        family('tempest_runs_total', 'counter', 'Tempest runs completed.',
+               [sample('tempest_runs_total', {'target': target}, runs)
+                for target, runs in sorted(state.get('runs', {}).items())])
+        family('tempest_tests_total', 'counter',
+               'Tests run by final status.',
+               [sample('tempest_tests_total',
+                       {'target': target, 'status': status}, count)
+                for target, totals in sorted(state.get('tests', {}).items())
+                for status, count in sorted(totals.items())])
+        family('tempest_last_run_tests', 'gauge',
+               'Tests of the last run by final status.',
+               [sample('tempest_last_run_tests',
+                       {'target': target, 'status': status}, count)
+                for target, run in last_runs
+                for status, count in sorted(run['counts'].items())])
+        family('tempest_last_run_timestamp_seconds', 'gauge',
+               'Time the last run finished.',
+               [sample('tempest_last_run_timestamp_seconds',
+                       {'target': target}, run['timestamp'])
+                for target, run in last_runs])
+        family('tempest_last_run_duration_seconds', 'gauge',
+               'Seconds the tests of the last run took.',
+               [sample('tempest_last_run_duration_seconds',
+                       {'target': target}, run['duration'])
+                for target, run in last_runs if 'duration' in run])
+        family('tempest_last_run_phase_seconds', 'gauge',
+               'Seconds each phase of the last run took.',
+               [sample('tempest_last_run_phase_seconds',
+                       {'target': target, 'phase': name}, seconds)
+                for target, run in last_runs
+                for name, seconds in sorted(run['phases'].items())])
+        for kind, name, doc, label, buckets in (
+                ('run', 'tempest_run_duration_seconds',
+                 'Seconds the tests of a run took.', 'target', RUN_BUCKETS),
+                ('test', 'tempest_test_duration_seconds',
+                 'Seconds a test took.', 'target', TEST_BUCKETS),
+                ('phase', 'tempest_phase_duration_seconds',
+                 'Seconds a phase of a run took.', 'phase', PHASE_BUCKETS)):
+            samples = []
+            for key, data in sorted(histograms.get(kind, {}).items()):
+                samples.extend(Histogram(
+                    buckets, data['counts'], data['sum']).samples(
+                        name, {label: key}))
+            family(name, 'histogram', doc, samples)
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+def write_textfile(text, directory):
+    """Atomically replace the metrics file in a textfile collector directory
+
+    The node exporter may read the directory at any time, so the file is
+    written under a name it ignores and renamed into place.
+
+    @returns string Path of the metrics file
+    """
+    path = os.path.join(directory, TEXTFILE_NAME)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as textfile:
+        textfile.write(text)
+    os.rename(tmp_path, path)
+    return path
+
+
+def record_run(path, store, target, phases=None, textfile_dir=None,
+               now=None):
+    """Add a run's results to the metrics at path and export them
+
+    Runs can finish in an action and in detached supervisors at the same
+    time, so the metrics are locked while they are updated.
+
+    :params path: string JSON file the metrics are kept in
+    :params store: results.TestRecordStore of the run's results
+    :params target: string tox target of the run
+    :params phases: {name: seconds, ...} of the phases of the run
+    :params textfile_dir: string Node exporter textfile collector directory
+                          to write the metrics to, skipped if it does not
+                          exist
+    @returns string Path of the metrics textfile or None if not written
+    """
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        metrics = RunMetrics(path).load()
+        metrics.record_run(
+            target, store.counts(),
+            (record.duration for record in store.records.values()
+             if record.duration is not None),
+            phases=phases, now=now)
+        metrics.save()
+        if textfile_dir and os.path.isdir(textfile_dir):
+            return write_textfile(metrics.exposition(), textfile_dir)
+    return None
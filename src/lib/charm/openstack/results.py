@@ -0,0 +1,417 @@
+import calendar
+import re
+import sqlite3
+import time
+
+# Match lines like: ' - Unexpected Success: 0'
+TOTALS_RE = re.compile(r'(.*)- (.*?):\s+(.*)', re.I)
+# Match per test lines like:
+# '{0} tempest.api.compute.test_x.Test.test_y [0.5s] ... ok'
+TEST_RE = re.compile(r'\{\d+\} (\S+(?: \(\S+\))?) ?(?:\[[^\]]*\] ?)*'
+                     r'\.\.\. (ok|FAILED|SKIPPED)')
+TEST_STATUSES = {
+    'ok': 'passed',
+    'FAILED': 'failed',
+    'SKIPPED': 'skipped',
+}
+# Final subunit v2 test statuses and the summary keys they are counted under
+SUBUNIT_STATUSES = {
+    'success': 'passed',
+    'fail': 'failed',
+    'skip': 'skipped',
+    'xfail': 'expected-fail',
+    'uxsuccess': 'unexpected-success',
+    'timeout': 'timed-out',
+}
+# Final subunit v2 test statuses which fail a run, timeout is recorded in
+# place of fail for tests stopped by their timeout
+FAILED_STATUSES = ('fail', 'uxsuccess', 'timeout')
+# Raised inside a test by the fixtures.Timeout tempest sets from
+# OS_TEST_TIMEOUT, matched by its full name as tempest.lib's own
+# TimeoutException is raised for API calls and waiters which time out
+TIMEOUT_MARKER = b'fixtures._fixtures.timeout.TimeoutException'
+# Match the ids given to class fixtures like: 'setUpClass (tempest.api.x.T)'
+FIXTURE_RE = re.compile(r'^\w+ \((\S+)\)$')
+
+
+class TempestOutputParser(object):
+
+    """Incremental parser for the console output of a tempest run
+
+    Lines are fed in as they are produced so pass, fail and skip counts
+    are kept up to date during the run and the summary is ready as soon as
+    the run ends, without reading the log back.
+    """
+
+    def __init__(self):
+        self.counts = {status: 0 for status in TEST_STATUSES.values()}
+        self.totals = {}
+        self.in_totals = False
+
+    def feed(self, line):
+        """Parse a line of output
+
+        @returns Boolean True if the line reported a completed test
+        """
+        stripped = line.strip()
+        if stripped == "Totals":
+            self.in_totals = True
+        elif stripped == "Worker Balance":
+            self.in_totals = False
+        elif self.in_totals:
+            match = TOTALS_RE.match(line)
+            if match:
+                key = match.group(2)
+                key = key.replace(' ', '-').replace(':', '').lower()
+                self.totals[key] = match.group(3)
+        elif ' ... ' in line:
+            match = TEST_RE.search(line)
+            if match:
+                self.counts[TEST_STATUSES[match.group(2)]] += 1
+                return True
+        return False
+
+    @property
+    def summary(self):
+        """Return the run's Totals block as a dict
+
+        If the run ended before printing its totals the running counts are
+        returned instead.
+        """
+        if self.totals:
+            return dict(self.totals)
+        return {key: str(value) for key, value in self.counts.items()}
+
+
+class TeeStream(object):
+
+    """Readable stream which copies everything read from it to a file"""
+
+    def __init__(self, source, copy):
+        self.source = source
+        self.copy = copy
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.copy.write(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.source.readline(size)
+        self.copy.write(data)
+        return data
+
+
+class TestRecord(object):
+
+    """Outcome and timing of a single test"""
+
+    __slots__ = ['test_id', 'status', 'start', 'stop', 'worker',
+                 'timed_out']
+
+    def __init__(self, test_id):
+        self.test_id = test_id
+        self.status = None
+        self.start = None
+        self.stop = None
+        self.worker = None
+        self.timed_out = False
+
+    @property
+    def duration(self):
+        if self.start is None or self.stop is None:
+            return None
+        return self.stop - self.start
+
+
+class TestRecordStore(object):
+
+    """Per test records decoded from a subunit v2 stream
+
+    This is a subunit StreamResult, it only keeps the id, final status,
+    start and stop times (as epoch seconds) and worker of each test, any
+    attachments in the stream are dropped. Failures caused by the test's
+    timeout are recorded with the timeout status.
+    """
+
+    def __init__(self):
+        self.records = {}
+
+    def status(self, test_id=None, test_status=None, test_tags=None,
+               runnable=True, file_name=None, file_bytes=None, eof=False,
+               mime_type=None, route_code=None, timestamp=None):
+        # subunit hands attachments over as memoryviews, which can not be
+        # searched for a byte string
+        timed_out = bool(file_bytes) and TIMEOUT_MARKER in bytes(file_bytes)
+        if not test_id or not (test_status or timed_out):
+            return
+        record = self.records.get(test_id)
+        if not record:
+            record = self.records[test_id] = TestRecord(test_id)
+        if timed_out:
+            record.timed_out = True
+        if not test_status:
+            return
+        when = None
+        if timestamp:
+            when = (calendar.timegm(timestamp.utctimetuple()) +
+                    timestamp.microsecond / 1e6)
+        if test_status == 'inprogress':
+            record.start = when
+        elif test_status in SUBUNIT_STATUSES:
+            record.status = test_status
+            if test_status == 'fail' and record.timed_out:
+                record.status = 'timeout'
+            record.stop = when
+        for tag in test_tags or []:
+            if tag.startswith('worker-'):
+                record.worker = tag
+
+    def feed(self, stream):
+        """Decode a subunit v2 byte stream into the store as it is read"""
+        # subunit pulls in testtools, so only import it to decode a stream
+        import subunit
+
+        subunit.ByteStreamToStreamResult(
+            stream, non_subunit_name='stdout').run(self)
+
+    def dump(self):
+        """Return the records as JSON serialisable data, see load()"""
+        return {test_id: [record.status, record.start, record.stop,
+                          record.worker]
+                for test_id, record in self.records.items()}
+
+    def load(self, data):
+        """Add records dumped by dump(), possibly from another unit"""
+        for test_id, (status, start, stop, worker) in data.items():
+            record = self.records[test_id] = TestRecord(test_id)
+            record.status = status
+            record.start = start
+            record.stop = stop
+            record.worker = worker
+
+    def counts(self):
+        return count_statuses(
+            record.status for record in self.records.values())
+
+    def slowest(self, count=10):
+        """Return the count longest running tests, longest first"""
+        timed = [record for record in self.records.values()
+                 if record.duration is not None]
+        timed.sort(key=lambda record: record.duration, reverse=True)
+        return timed[:count]
+
+
+def count_statuses(statuses):
+    """Count final subunit statuses under their summary keys"""
+    counts = {key: 0 for key in SUBUNIT_STATUSES.values()}
+    for status in statuses:
+        if status in SUBUNIT_STATUSES:
+            counts[SUBUNIT_STATUSES[status]] += 1
+    return counts
+
+
+def record_results(store, path, logfile=None, branch=None, target=None,
+                   rerun_of=None, slowest=10):
+    """Append a run's results to the history at path and summarise them
+
+    The summary of a rerun is that of the run it reran with the outcomes
+    of the reran tests updated.
+
+    :params store: TestRecordStore of the run's results
+    :params slowest: int Number of the longest running tests to list
+    @returns dict of action results
+    """
+    summary = {key: str(value) for key, value in store.counts().items()}
+    summary['slowest-tests'] = '\n'.join(
+        '{:.3f}s {}'.format(record.duration, record.test_id)
+        for record in store.slowest(int(slowest)))
+    history = ResultsHistory(path)
+    try:
+        summary['run-id'] = history.record_run(
+            store, logfile=logfile, branch=branch, target=target,
+            rerun_of=rerun_of)
+        if rerun_of:
+            _, statuses = history.run_outcome(rerun_of)
+            summary.update(
+                {key: str(value) for key, value in
+                 count_statuses(statuses.values()).items()})
+    finally:
+        history.close()
+    return summary
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of values, None if empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(-(-pct * len(ordered) // 100)))
+    return ordered[rank - 1]
+
+
+class ResultsHistory(object):
+
+    """Append only SQLite store of per test results across runs
+
+    Test ids are stored once in the tests table and results are keyed by
+    (test, run) so the durations of a test across runs are read from a
+    single index range. A run which reruns tests of an earlier run records
+    the id of the original run in rerun_of.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started REAL,
+            logfile TEXT,
+            branch TEXT,
+            target TEXT,
+            rerun_of INTEGER)""",
+        """CREATE TABLE IF NOT EXISTS tests (
+            test_key INTEGER PRIMARY KEY,
+            test_id TEXT UNIQUE)""",
+        """CREATE TABLE IF NOT EXISTS results (
+            test_key INTEGER,
+            run_id INTEGER,
+            status TEXT,
+            duration REAL,
+            worker TEXT,
+            PRIMARY KEY (test_key, run_id)) WITHOUT ROWID""",
+        """CREATE INDEX IF NOT EXISTS results_run ON results (run_id)""",
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        with self.db:
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+            columns = [row[1] for row in
+                       self.db.execute("PRAGMA table_info(runs)")]
+            if 'rerun_of' not in columns:
+                # Upgrade a history recorded before reruns were tracked
+                self.db.execute(
+                    "ALTER TABLE runs ADD COLUMN rerun_of INTEGER")
+
+    def close(self):
+        self.db.close()
+
+    def record_run(self, store, logfile=None, branch=None, target=None,
+                   rerun_of=None):
+        """Append the results of a run
+
+        :params store: TestRecordStore of the run's results
+        :params rerun_of: int Id of the run whose tests this run reran
+        @returns int run id
+        """
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO runs (started, logfile, branch, target, "
+                "rerun_of) VALUES (?, ?, ?, ?, ?)",
+                (time.time(), logfile, branch, target, rerun_of))
+            run_id = cursor.lastrowid
+            self.db.executemany(
+                "INSERT OR IGNORE INTO tests (test_id) VALUES (?)",
+                ((test_id,) for test_id in store.records))
+            self.db.executemany(
+                "INSERT INTO results "
+                "SELECT test_key, ?, ?, ?, ? FROM tests WHERE test_id = ?",
+                ((run_id, record.status, record.duration, record.worker,
+                  record.test_id)
+                 for record in store.records.values()))
+        return run_id
+
+    def recent_runs(self, runs):
+        """Return the ids of the last runs, newest first"""
+        return [row[0] for row in self.db.execute(
+            "SELECT run_id FROM runs ORDER BY run_id DESC LIMIT ?", (runs,))]
+
+    def run_outcome(self, run_id):
+        """Final status of each test of a run with its reruns applied
+
+        The outcome of a rerun is that of the run it reran, so any run in
+        a chain of reruns gives the same outcome.
+
+        @returns (id of the original run, {test_id: status, ...})
+        """
+        row = self.db.execute(
+            "SELECT rerun_of FROM runs WHERE run_id = ?", (run_id,)
+        ).fetchone()
+        if row and row[0]:
+            run_id = row[0]
+        statuses = {}
+        for test_id, status in self.db.execute(
+                "SELECT t.test_id, r.status FROM results r "
+                "JOIN tests t ON t.test_key = r.test_key "
+                "JOIN runs u ON u.run_id = r.run_id "
+                "WHERE u.run_id = ? OR u.rerun_of = ? ORDER BY r.run_id",
+                (run_id, run_id)):
+            statuses[test_id] = status
+        return run_id, statuses
+
+    def durations(self, test_id, runs=30):
+        """Durations of a test's successful results over the last runs"""
+        run_ids = self.recent_runs(runs)
+        if not run_ids:
+            return []
+        return [row[0] for row in self.db.execute(
+            "SELECT r.duration FROM results r "
+            "JOIN tests t ON t.test_key = r.test_key "
+            "WHERE t.test_id = ? AND r.run_id >= ? AND r.status = 'success' "
+            "AND r.duration IS NOT NULL",
+            (test_id, run_ids[-1]))]
+
+    def duration_percentile(self, test_id, pct=95, runs=30):
+        return percentile(self.durations(test_id, runs=runs), pct)
+
+    def median_durations(self, runs=30):
+        """Median successful duration of every test over the last runs
+
+        @returns {test_id: seconds, ...}
+        """
+        run_ids = self.recent_runs(runs)
+        if not run_ids:
+            return {}
+        durations = {}
+        for test_id, duration in self.db.execute(
+                "SELECT t.test_id, r.duration FROM results r "
+                "JOIN tests t ON t.test_key = r.test_key "
+                "WHERE r.run_id >= ? AND r.status = 'success' "
+                "AND r.duration IS NOT NULL",
+                (run_ids[-1],)):
+            durations.setdefault(test_id, []).append(duration)
+        return {test_id: percentile(values, 50)
+                for test_id, values in durations.items()}
+
+    def slower_tests(self, threshold=0.2, runs=30):
+        """Find tests whose latest duration regressed
+
+        The latest successful duration of each test is compared with the
+        median of its successful durations over the previous runs.
+
+        @returns [(test_id, baseline, latest), ...] slowest regression first
+        """
+        run_ids = self.recent_runs(runs + 1)
+        if len(run_ids) < 2:
+            return []
+        latest_run = run_ids[0]
+        history = {}
+        latest = {}
+        for test_id, run_id, duration in self.db.execute(
+                "SELECT t.test_id, r.run_id, r.duration FROM results r "
+                "JOIN tests t ON t.test_key = r.test_key "
+                "WHERE r.run_id >= ? AND r.status = 'success' "
+                "AND r.duration IS NOT NULL",
+                (run_ids[-1],)):
+            if run_id == latest_run:
+                latest[test_id] = duration
+            else:
+                history.setdefault(test_id, []).append(duration)
+        slower = []
+        for test_id, duration in latest.items():
+            baseline = percentile(history.get(test_id), 50)
+            if baseline and duration > baseline * (1 + threshold):
+                slower.append((test_id, baseline, duration))
+        slower.sort(key=lambda entry: entry[2] / entry[1], reverse=True)
+        return slower
@@ -0,0 +1,81 @@
+import heapq
+import re
+
+# Duration assumed for a test with no history when nothing else is known
+DEFAULT_DURATION = 1.0
+# Quota a single tempest worker may hold at once, by quota resource name
+WORKER_DEMAND = {
+    'instances': 2,
+    'cores': 2,
+    'network': 1,
+    'subnet': 1,
+    'router': 1,
+    'port': 4,
+    'floatingip': 1,
+    'security_group': 2,
+}
+
+
+def partition(test_ids, durations, workers):
+    """Split tests into balanced worker partitions
+
+    Uses longest-processing-time-first: tests are taken longest first and
+    each goes to the worker with the least scheduled time so far. Tests
+    with no recorded duration are assumed to take the median duration.
+
+    :params test_ids: list of test ids to schedule
+    :params durations: {test_id: seconds, ...} historical durations
+    :params workers: int Number of partitions to create
+    @returns [[test_id, ...], ...] one list of tests per worker
+    """
+    known = sorted(durations[test_id] for test_id in test_ids
+                   if durations.get(test_id) is not None)
+    default = known[len(known) // 2] if known else DEFAULT_DURATION
+
+    def cost(test_id):
+        duration = durations.get(test_id)
+        return default if duration is None else duration
+
+    ordered = sorted(test_ids, key=lambda test_id: (-cost(test_id), test_id))
+    workers = max(1, min(workers, len(ordered)))
+    partitions = [[] for _ in range(workers)]
+    loads = [(0.0, worker) for worker in range(workers)]
+    for test_id in ordered:
+        load, worker = heapq.heappop(loads)
+        partitions[worker].append(test_id)
+        heapq.heappush(loads, (load + cost(test_id), worker))
+    return [tests for tests in partitions if tests]
+
+
+def auto_concurrency(cpus, headroom, demand=None):
+    """Choose how many tempest workers to run
+
+    One worker per CPU, reduced so the resources every worker may hold at
+    once fit in the project's remaining quota.
+
+    :params cpus: int Number of CPUs on the unit
+    :params headroom: {resource: count, ...} quota left in the project,
+                      resources without a limit are left out
+    :params demand: {resource: count, ...} quota used per worker
+    @returns int Number of workers, at least one
+    """
+    demand = demand or WORKER_DEMAND
+    workers = cpus
+    for resource, left in headroom.items():
+        if demand.get(resource):
+            workers = min(workers, left // demand[resource])
+    return max(1, workers)
+
+
+def write_worker_file(partitions, path):
+    """Write partitions as an stestr --worker-file
+
+    Each test is matched by an anchored regex of its exact id.
+    """
+    with open(path, 'w') as worker_file:
+        for tests in partitions:
+            worker_file.write('- worker:\n')
+            for test_id in tests:
+                regex = '^{}$'.format(re.escape(test_id))
+                worker_file.write("  - '{}'\n".format(
+                    regex.replace("'", "''")))
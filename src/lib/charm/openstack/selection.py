@@ -0,0 +1,91 @@
+import json
+import os
+import re
+
+
+class TestIndex(object):
+
+    """Test ids of a tempest checkout cached on disk per git commit
+
+    Listing the tests imports the whole tempest test tree, so it is only
+    done once per commit and selections are matched against the stored
+    ids instead.
+    """
+
+    def __init__(self, path, head):
+        """
+        :params path: string File to store the index in
+        :params head: string Commit the checkout is at
+        """
+        self.path = path
+        self.head = head
+
+    def load(self):
+        """Return the indexed test ids, None if there is no index of head"""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'r') as index_file:
+                entry = json.load(index_file)
+        except (IOError, ValueError):
+            return None
+        if entry.get('head') != self.head:
+            return None
+        return entry.get('tests')
+
+    def save(self, test_ids):
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as index_file:
+            json.dump({'head': self.head, 'tests': test_ids}, index_file)
+        os.rename(tmp_path, self.path)
+
+
+def read_test_list(path):
+    """Read test ids or regexes, one per line, from path
+
+    Blank lines and lines starting with # are skipped.
+    """
+    with open(path, 'r') as list_file:
+        return [line.strip() for line in list_file
+                if line.strip() and not line.strip().startswith('#')]
+
+
+def select(test_ids, include=None, exclude=None, patterns=None):
+    """Select tests from an index of test ids
+
+    A test is selected if it matches include or any of patterns, or all
+    tests are if neither is given, and it does not match exclude. Regexes
+    are searched for in the test id as tempest run does.
+
+    Patterns which are ids in the index only select that test, tempest
+    ids are not valid regexes in general. Patterns which do not compile
+    are matched literally.
+
+    :params test_ids: list of test ids to select from
+    :params include: string Regex of tests to run
+    :params exclude: string Regex of tests to skip
+    :params patterns: list of test ids or regexes of tests to run
+    @returns list of the selected test ids, in index order
+    @raises re.error if include or exclude is an invalid regex
+    """
+    includes = [re.compile(include)] if include else []
+    indexed = set(test_ids)
+    exact = set()
+    for pattern in patterns or []:
+        if pattern in indexed:
+            exact.add(pattern)
+            continue
+        try:
+            includes.append(re.compile(pattern))
+        except re.error:
+            includes.append(re.compile(re.escape(pattern)))
+    exclude = re.compile(exclude) if exclude else None
+    selected = []
+    for test_id in test_ids:
+        if ((includes or exact) and test_id not in exact and
+                not any(regex.search(test_id) for regex in includes)):
+            continue
+        if exclude and exclude.search(test_id):
+            continue
+        selected.append(test_id)
+    return selected
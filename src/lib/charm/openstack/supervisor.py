@@ -0,0 +1,312 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import charm.openstack.metrics as metrics
+import charm.openstack.results as results
+import charm.openstack.timing as timing
+import charm.openstack.workspace as workspace
+
+# Minimum seconds between progress updates of the job's state
+PROGRESS_INTERVAL = 5
+# States of a job which has stopped
+FINAL_STATES = ('finished', 'cancelled', 'failed')
+# Seconds a torn down run is given to exit before it is killed
+TEARDOWN_GRACE = 10
+# Seconds a run is given to build its virtualenv and discover its tests
+# before the per test watchdog is armed by the first completed test
+STARTUP_GRACE = 1800
+
+
+def stop_process_group(proc, grace=TEARDOWN_GRACE):
+    """Stop a process started in its own session and all its children
+
+    The group is sent SIGTERM and then SIGKILL if the process has not
+    exited after grace seconds.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class Watchdog(object):
+
+    """Tear down a tempest run which overruns its time limits
+
+    The run is stopped once it has run for run_timeout seconds, or when no
+    test has completed for twice test_timeout, meaning a hung test has not
+    been stopped by the timeout tempest enforces inside the test. Until the
+    first test completes the run is also allowed startup_grace seconds for
+    tox to build its virtualenv and stestr to discover the tests. In both
+    cases the output up to that point is still parsed.
+    """
+
+    def __init__(self, proc, run_timeout=None, test_timeout=None,
+                 interval=1, startup_grace=STARTUP_GRACE):
+        self.proc = proc
+        self.run_timeout = run_timeout
+        self.test_timeout = test_timeout
+        self.interval = interval
+        self.startup_grace = startup_grace
+        self.started = time.monotonic()
+        self.last_test = None
+        self.reason = None
+        self.finished = threading.Event()
+        self.thread = threading.Thread(target=self.watch)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        if self.run_timeout or self.test_timeout:
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.finished.set()
+
+    def test_done(self):
+        self.last_test = time.monotonic()
+
+    def overrun(self, now):
+        if self.run_timeout and now - self.started > self.run_timeout:
+            return 'run'
+        if self.test_timeout:
+            if self.last_test is None:
+                idle = now - self.started - self.startup_grace
+            else:
+                idle = now - self.last_test
+            if idle > 2 * self.test_timeout:
+                return 'test'
+        return None
+
+    def watch(self):
+        while not self.finished.wait(self.interval):
+            self.reason = self.overrun(time.monotonic())
+            if self.reason:
+                stop_process_group(self.proc)
+                return
+
+
+def stream_output(proc, logfile, parser, progress=None, watchdog=None):
+    """Copy a process' output to logfile, parsing it as it streams past
+
+    :params proc: subprocess.Popen with stdout piped
+    :params logfile: string File to write the output to
+    :params parser: results.TempestOutputParser to feed each line to
+    :params progress: callable(parser) called after each line
+    :params watchdog: Watchdog to tell when a test completes
+    """
+    with open(logfile, "w") as f:
+        for raw_line in proc.stdout:
+            line = raw_line.decode('utf-8', 'replace')
+            f.write(line)
+            if parser.feed(line) and watchdog:
+                watchdog.test_done()
+            if progress:
+                progress(parser)
+        proc.wait()
+
+
+def collect_subunit(cmd, cwd, subunit_file):
+    """Save the subunit v2 stream printed by cmd and decode it
+
+    A run whose stestr can not be found, as when tox failed to build its
+    virtualenv, has no results rather than failing the job.
+
+    @return results.TestRecordStore of the stream's tests
+    """
+    store = results.TestRecordStore()
+    try:
+        with open(subunit_file, 'wb') as f:
+            proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE)
+            store.feed(results.TeeStream(proc.stdout, f))
+            proc.wait()
+    except OSError as e:
+        # Outside a hook this goes to the job's supervisor.log
+        print("Unable to collect subunit results: {}".format(e),
+              file=sys.stderr)
+    return store
+
+
+class RunState(object):
+
+    """State of a detached run, shared through a JSON file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as state_file:
+            return json.load(state_file)
+
+    def update(self, **values):
+        state = self.load()
+        state.update(values)
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(tmp_path, self.path)
+        return state
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def describe(state, now=None):
+    """Summarise a job's state for action_set
+
+    The ETA assumes the remaining tests take as long on average as the
+    tests done so far.
+    """
+    now = now or time.time()
+    status = state.get('status', 'unknown')
+    if (status not in FINAL_STATES and state.get('pid') and
+            not process_alive(state['pid'])):
+        status = 'died'
+    info = {'status': status}
+    done = state.get('done', 0)
+    total = state.get('total')
+    info['progress'] = '{}/{}'.format(done, total or '?')
+    for key, value in (state.get('counts') or {}).items():
+        info[key] = str(value)
+    if state.get('started'):
+        elapsed = (state.get('finished') or now) - state['started']
+        info['elapsed'] = '{:.0f}s'.format(elapsed)
+        if status == 'running' and done and total and total > done:
+            info['eta'] = '{:.0f}s'.format(elapsed * (total - done) / done)
+    if state.get('error'):
+        info['error'] = state['error']
+    for key, value in (state.get('result') or {}).items():
+        info.setdefault(key, value)
+    return info
+
+
+class Supervisor(object):
+
+    """Run the tempest command of a job and record its results"""
+
+    def __init__(self, job_dir):
+        self.job_dir = job_dir
+        with open(os.path.join(job_dir, 'spec.json'), 'r') as spec_file:
+            self.spec = json.load(spec_file)
+        self.state = RunState(os.path.join(job_dir, 'state.json'))
+        self.proc = None
+        self.cancelled = False
+        self.last_progress = 0
+
+    def cancel(self, signum=None, frame=None):
+        self.cancelled = True
+        if self.proc and self.proc.poll() is None:
+            # tempest leads its own process group, stop its workers too
+            os.killpg(self.proc.pid, signal.SIGTERM)
+
+    def progress(self, parser, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_progress < PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        self.state.update(done=sum(parser.counts.values()),
+                          counts=parser.counts)
+
+    def run(self):
+        spec = self.spec
+        self.state.update(status='running', pid=os.getpid(),
+                          started=time.time(), total=spec.get('total'))
+        signal.signal(signal.SIGTERM, self.cancel)
+        # Carry on timing from the phases the action timed before detaching
+        phases = timing.PhaseTimer(spec.get('timing', {}).get('phases'))
+        try:
+            if spec.get('prepare'):
+                # A peer's shard checks out tempest and builds its
+                # virtualenv here rather than in the hook which started it
+                with phases.phase('prepare'):
+                    workspace.prepare(spec['prepare'])
+                if self.cancelled:
+                    self.state.update(status='cancelled',
+                                      finished=time.time(),
+                                      result=dict(spec.get('action_info') or
+                                                  {}))
+                    return
+            parser = results.TempestOutputParser()
+            with phases.phase('execute-tox'):
+                self.proc = subprocess.Popen(
+                    spec['cmd'], cwd=spec['cwd'], stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT, env=spec['env'],
+                    start_new_session=True)
+                with Watchdog(self.proc, spec.get('run_timeout'),
+                              spec.get('test_timeout')) as watchdog:
+                    stream_output(self.proc, spec['logfile'], parser,
+                                  self.progress, watchdog)
+            self.progress(parser, force=True)
+            result = dict(spec.get('action_info') or {})
+            result.update(parser.summary)
+            if watchdog.reason:
+                result['timed-out'] = watchdog.reason
+            # stestr only stores a run which completes, after a torn down
+            # or cancelled run stestr last would return the results of the
+            # previous run so only the output streamed from this run is
+            # reported
+            recorded = not (watchdog.reason or self.cancelled)
+            if recorded:
+                with phases.phase('parse-results'):
+                    store = collect_subunit(
+                        spec['subunit_cmd'], spec['cwd'],
+                        spec['subunit_file'])
+                    if store.records:
+                        result['subunit-file'] = spec['subunit_file']
+                        result.update({key: str(value) for key, value in
+                                       store.counts().items()})
+                    if store.records and spec.get('results_db'):
+                        result.update(results.record_results(
+                            store, spec['results_db'],
+                            logfile=spec['logfile'],
+                            branch=spec.get('branch'),
+                            target=spec.get('target'),
+                            rerun_of=spec.get('rerun_of'),
+                            slowest=spec.get('slowest_tests', 10)))
+            result.update(timing.report(
+                phases, timing.HTTPStats(spec.get('timing', {}).get('http')),
+                path=spec.get('timing_file')))
+            if recorded and spec.get('metrics'):
+                metrics.record_run(
+                    spec['metrics']['state'], store, spec.get('target'),
+                    phases=phases.summary(),
+                    textfile_dir=spec['metrics'].get('textfile_dir'))
+        except Exception as e:
+            self.state.update(status='failed', error=str(e),
+                              finished=time.time())
+            raise
+        self.state.update(
+            status='cancelled' if self.cancelled else 'finished',
+            finished=time.time(), result=result)
+
+
+def main(argv=None):
+    """Supervise the job in the directory given on the command line
+
+    The run-tempest action starts this detached from the action as
+    python3 -m charm.openstack.supervisor JOB_DIR, so nothing here may use
+    the juju hook tools.
+    """
+    argv = argv if argv is not None else sys.argv[1:]
+    Supervisor(argv[0]).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,31 @@
+import configparser
+import hashlib
+import json
 import os
 import re
+import shlex
+import shutil
+import signal
 import subprocess
+import sys
+import tarfile
 import time
 import urllib
 
-import glanceclient
-import keystoneauth1
-import keystoneauth1.identity.v2 as keystoneauth1_v2
-import keystoneauth1.session as keystoneauth1_session
-import keystoneclient.v2_0.client as keystoneclient_v2
-import keystoneclient.v3.client as keystoneclient_v3
-import keystoneclient.auth.identity.v3 as keystone_id_v3
-import keystoneclient.session as session
-import neutronclient.v2_0.client as neutronclient
-import novaclient.client as novaclient_client
-
+import charm.openstack.clients as clients
+import charm.openstack.discovery as discovery
+import charm.openstack.logs as logs
+import charm.openstack.metrics as metrics
+import charm.openstack.results as results
+import charm.openstack.scheduling as scheduling
+import charm.openstack.selection as selection
+import charm.openstack.supervisor as supervisor
+import charm.openstack.timing as timing
+import charm.openstack.workspace as workspace
 import charms_openstack.charm as charm
 import charms_openstack.adapters as adapters
 import charmhelpers.core.hookenv as hookenv
 import charmhelpers.core.host as host
-import charmhelpers.fetch as fetch
 
 
 def install():
@@ -35,15 +41,55 @@ def render_configs(interfaces_list):
     """
     if not os.path.isdir(TempestCharm.TEMPEST_LOGDIR):
         os.makedirs(TempestCharm.TEMPEST_LOGDIR)
-    TempestCharm.singleton.render_with_interfaces(interfaces_list)
+    with timing.PHASES.phase('render'):
+        TempestCharm.singleton.render_if_changed(interfaces_list)
     TempestCharm.singleton.assess_status()
 
 
-def run_test(tox_target):
+def run_test(tox_target, interfaces_list=None):
     """Use the singleton from the TempestCharm to install the packages on the
     unit
     """
-    TempestCharm.singleton.run_test(tox_target)
+    TempestCharm.singleton.run_test(tox_target, interfaces_list)
+
+
+def run_status():
+    """Use the singleton from the TempestCharm to report on a detached run
+    """
+    TempestCharm.singleton.run_status()
+
+
+def cancel_run():
+    """Use the singleton from the TempestCharm to cancel a detached run
+    """
+    TempestCharm.singleton.cancel_run()
+
+
+def sync_shards(interfaces_list=None):
+    """Use the singleton from the TempestCharm to run and merge the shards
+    of sharded runs
+    """
+    TempestCharm.singleton.sync_shards(interfaces_list)
+
+
+def invalidate_discovery():
+    """Use the singleton from the TempestCharm to drop the discovery cache
+    """
+    TempestCharm.singleton.invalidate_discovery()
+
+
+def rotate_logs():
+    """Use the singleton from the TempestCharm to compress and expire the
+    logs of finished runs
+    """
+    TempestCharm.singleton.rotate_logs()
+
+
+def query_history():
+    """Use the singleton from the TempestCharm to report on the results
+    history
+    """
+    TempestCharm.singleton.query_history()
 
 
 def assess_status():
@@ -53,18 +99,48 @@ def assess_status():
     TempestCharm.singleton.assess_status()
 
 
+def action_arg(name, default=None):
+    """Return an action parameter, or default outside of an action context
+    """
+    try:
+        return hookenv.action_get().get(name, default)
+    except Exception:
+        return default
+
+
 class TempestAdminAdapter(adapters.OpenStackRelationAdapter):
 
     """Inspect relations and provide properties that can be used when
        rendering templates"""
 
     interface_type = "identity-admin"
+    """Properties populated by OpenStack lookups, see discovered()"""
+    discovery_keys = ['ec2_creds', 'image_info', 'network_info',
+                      'compute_info', 'service_info', 'quota_headroom']
+    """Discovery results which are persisted between action runs, the
+       quota headroom sizes the concurrency of the runs which reuse them
+    """
+    cached_discovery_keys = ['ec2_creds', 'image_info', 'network_info',
+                             'compute_info', 'quota_headroom']
+    """Charm options which change the result of discovery"""
+    discovery_options = ['glance-image-name', 'glance-alt-image-name',
+                         'image-ssh-user', 'image-alt-ssh-user',
+                         'flavor-name', 'flavor-alt-name', 'router-name',
+                         'network-name', 'floating-network-name']
+    """Nova absolute limits giving the limit and usage of compute quotas"""
+    compute_quotas = {
+        'instances': ('maxTotalInstances', 'totalInstancesUsed'),
+        'cores': ('maxTotalCores', 'totalCoresUsed'),
+    }
 
     def __init__(self, relation):
         """Initialise a keystone client and collect user defined config"""
         self.kc = None
         self.keystone_session = None
+        self.client_factory = None
+        self.catalogue = None
         self.api_version = '2'
+        self._discovery = {}
         super(TempestAdminAdapter, self).__init__(relation)
         self.init_keystone_client()
         self.uconfig = hookenv.config()
@@ -103,26 +179,44 @@ class TempestAdminAdapter(adapters.OpenStackRelationAdapter):
         )
 
     def resolve_endpoint(self, service_type, interface):
-        if self.api_version == '2':
-            ep = self.ks_client.service_catalog.url_for(
-                service_type=service_type,
-                endpoint_type='{}URL'.format(interface)
-            )
-        else:
-            svc_id = self.ks_client.services.find(type=service_type).id
-            ep = self.ks_client.endpoints.find(
-                service_id=svc_id,
-                interface=interface).url
-        return ep
+        self.init_keystone_client()
+        return self.catalogue.url_for(
+            service_type,
+            interface=interface,
+            region=self.keystone_info.get('service_region'))
+
+    def set_keystone_client(self, api_version, credentials):
+        """Set up the shared client factory and keystone client
+
+        :params api_version: string Identity API version, '2' or '3'
+        :params credentials: dict keystoneauth Password plugin arguments
+        """
+        self.client_factory = clients.ClientFactory(
+            api_version,
+            credentials,
+            region_name=self.keystone_info.get('service_region'),
+            timeout=hookenv.config().get('discovery-timeout'))
+        self.keystone_session = self.client_factory.session
+        self.kc = self.client_factory.client('identity')
 
     def set_keystone_v2_client(self):
-        self.keystone_session = None
-        self.kc = keystoneclient_v2.Client(**self.admin_creds_v2)
+        creds = self.admin_creds_v2
+        del creds['region_name']
+        self.set_keystone_client('2', creds)
+        # Authenticate up front so that a keystone which only accepts v3
+        # is detected here, the token is then reused by every client.
+        self.keystone_session.get_token()
 
     def set_keystone_v3_client(self):
-        auth = keystone_id_v3.Password(**self.admin_creds_v3)
-        self.keystone_session = session.Session(auth=auth)
-        self.kc = keystoneclient_v3.Client(session=self.keystone_session)
+        self.set_keystone_client('3', self.admin_creds_v3)
+
+    def get_client(self, service_type):
+        """Return the shared client for an OpenStack service type
+
+        :params service_type: string One of identity, image, compute, network
+        """
+        self.init_keystone_client()
+        return self.client_factory.client(service_type)
 
     def init_keystone_client(self):
         """Initialise keystone client"""
@@ -135,13 +229,17 @@ class TempestAdminAdapter(adapters.OpenStackRelationAdapter):
             # XXX Temporarily catching the Unauthorized exception to deal with
             # the case (pre-17.02) where the keystone charm maybe in v3 mode
             # without telling charms via the identity-admin relation
+            import keystoneauth1.exceptions
+
             try:
                 self.set_keystone_v2_client()
                 self.api_version = '2'
             except keystoneauth1.exceptions.http.Unauthorized:
                 self.set_keystone_v3_client()
                 self.api_version = '3'
-        self.kc.services.list()
+        # Reading the token's catalogue also validates the credentials
+        self.catalogue = clients.ServiceCatalogue.from_session(
+            self.keystone_session)
 
     def admin_creds_base(self, api_version):
         return {
@@ -170,56 +268,171 @@ class TempestAdminAdapter(adapters.OpenStackRelationAdapter):
                 'Default')
             return creds
 
+    def discovered(self, key):
+        """Return the discovery result for key from the snapshot
+
+        Templates read the same discovery properties many times per render,
+        so each lookup is run once and memoized for the life of the adapter.
+
+        :params key: string Name of the discovery property, eg 'image_info'
+        @returns The memoized result of get_<key>()
+        """
+        if key not in self._discovery:
+            self._discovery[key] = getattr(self, 'get_{}'.format(key))()
+        return self._discovery[key]
+
+    def prefetch_discovery(self):
+        """Populate the discovery snapshot with concurrent lookups
+
+        The lookups are independent so they are sent out together over one
+        shared keystone session. A lookup which fails or exceeds its
+        timeout from discovery-timeouts, or else discovery-timeout, leaves
+        an empty result in the snapshot so the render carries on without
+        it.
+
+        Results from a previous action run are reused from the discovery
+        cache while they are within discovery-cache-ttl, unless the
+        refresh-discovery action parameter is set.
+        """
+        cache = self.discovery_cache()
+        if action_arg('refresh-discovery', False):
+            self.invalidate_discovery()
+        cached = cache.load()
+        if cached and self.cached_discovery_valid(cached):
+            for key in self.cached_discovery_keys:
+                if key in cached:
+                    self._discovery.setdefault(key, cached[key])
+        lookups = {
+            key: getattr(self, 'get_{}'.format(key))
+            for key in self.discovery_keys
+            if key not in self._discovery}
+        results = discovery.run_concurrently(
+            lookups,
+            timeouts=discovery.parse_timeouts(
+                self.uconfig.get('discovery-timeouts')),
+            default_timeout=self.uconfig.get('discovery-timeout'))
+        for key in lookups:
+            self._discovery[key] = results.get(key, {})
+        # Only persist a complete snapshot, a failed lookup should be
+        # retried next run rather than cached.
+        refreshed = set(lookups).intersection(self.cached_discovery_keys)
+        if refreshed and refreshed.issubset(results):
+            cache.save({
+                key: self._discovery[key]
+                for key in self.cached_discovery_keys})
+
+    def discovery_cache(self):
+        """Return the on disk cache for the current discovery inputs"""
+        inputs = {
+            option: self.uconfig.get(option)
+            for option in self.discovery_options}
+        return discovery.DiscoveryCache(
+            TempestCharm.DISCOVERY_CACHE,
+            discovery.fingerprint(self.keystone_info, inputs),
+            self.uconfig.get('discovery-cache-ttl'))
+
+    def cached_discovery_valid(self, snapshot):
+        """Check a cached snapshot still matches the cloud
+
+        Images are the resources most likely to be replaced between runs so
+        a single request for the cached image is used as the check.
+
+        @returns Boolean: True if the snapshot can be used
+        """
+        image_id = snapshot.get('image_info', {}).get('image_id')
+        if not image_id:
+            return True
+        try:
+            self.get_client('image').images.get(image_id)
+        except Exception as e:
+            hookenv.log("Discarding discovery cache, image {} is no longer "
+                        "available: {}".format(image_id, e))
+            return False
+        return True
+
+    def invalidate_discovery(self):
+        """Drop the discovery snapshot and the discovery cache so the next
+        read queries OpenStack
+        """
+        self._discovery = {}
+        self.discovery_cache().clear()
+
     @property
     def ec2_creds(self):
+        return self.discovered('ec2_creds')
+
+    @property
+    def image_info(self):
+        return self.discovered('image_info')
+
+    @property
+    def network_info(self):
+        return self.discovered('network_info')
+
+    @property
+    def compute_info(self):
+        return self.discovered('compute_info')
+
+    @property
+    def service_info(self):
+        return self.discovered('service_info')
+
+    @property
+    def quota_headroom(self):
+        return self.discovered('quota_headroom')
+
+    def get_ec2_creds(self):
         """Generate EC2 style tokens or return existing EC2 tokens
 
         @returns {'access_token' token1, 'secret_token': token2}
         """
         _ec2creds = {}
         if self.api_version == '2':
-            current_creds = self.ks_client.ec2.list(self.ks_client.user_id)
+            user_id = self.keystone_session.get_user_id()
+            current_creds = self.ks_client.ec2.list(user_id)
             if current_creds:
-                _ec2creds = current_creds[0]
+                creds = current_creds[0]
             else:
                 creds = self.ks_client.ec2.create(
-                    self.ks_client.user_id,
-                    self.ks_client.tenant_id)
-                _ec2creds = {
-                    'access_token': creds.access,
-                    'secret_token': creds.secret}
+                    user_id,
+                    self.keystone_session.get_project_id())
+            # Only the tokens are kept, the keystoneclient resource can not
+            # be stored in the discovery cache
+            _ec2creds = {
+                'access_token': creds.access,
+                'secret_token': creds.secret}
         return _ec2creds
 
-    @property
-    def image_info(self):
+    def get_image_info(self):
         """Return image ids for the user-defined image names
 
         @returns {'image_id' id1, 'image_alt_id': id2}
         """
         image_info = {}
         if self.service_present('glance'):
-            if self.keystone_session:
-                glance_client = glanceclient.Client(
-                    '2', session=self.keystone_session)
-            else:
-                glance_ep = self.resolve_endpoint('image', 'public')
-                glance_client = glanceclient.Client(
-                    '2', glance_ep, token=self.ks_client.auth_token)
-            for image in glance_client.images.list():
-                if self.uconfig.get('glance-image-name') == image.name:
-                    image_info['image_id'] = image.id
-                if self.uconfig.get('image-ssh-user'):
-                    image_info['image_ssh_user'] = \
-                        self.uconfig.get('image-ssh-user')
-                if self.uconfig.get('glance-alt-image-name') == image.name:
-                    image_info['image_alt_id'] = image.id
-                if self.uconfig.get('image-alt-ssh-user'):
-                    image_info['image_alt_ssh_user'] = \
-                        self.uconfig.get('image-alt-ssh-user')
+            glance_client = self.get_client('image')
+            image_name = self.uconfig.get('glance-image-name')
+            alt_image_name = self.uconfig.get('glance-alt-image-name')
+            images = discovery.resolve_names(
+                [image_name, alt_image_name],
+                lookup=lambda names: glance_client.images.list(
+                    filters={'name': names[0]}),
+                scan=lambda: glance_client.images.list(
+                    page_size=discovery.SCAN_PAGE_SIZE),
+                kind='image')
+            if image_name in images:
+                image_info['image_id'] = images[image_name].id
+            if alt_image_name in images:
+                image_info['image_alt_id'] = images[alt_image_name].id
+            if self.uconfig.get('image-ssh-user'):
+                image_info['image_ssh_user'] = \
+                    self.uconfig.get('image-ssh-user')
+            if self.uconfig.get('image-alt-ssh-user'):
+                image_info['image_alt_ssh_user'] = \
+                    self.uconfig.get('image-alt-ssh-user')
         return image_info
 
-    @property
-    def network_info(self):
+    def get_network_info(self):
         """Return public network and router ids for user-defined router and
            network names
 
@@ -227,37 +440,31 @@ class TempestAdminAdapter(adapters.OpenStackRelationAdapter):
         """
         network_info = {}
         if self.service_present('neutron'):
-            if self.keystone_session:
-                neutron_client = neutronclient.Client(
-                    session=self.keystone_session)
-            else:
-                neutron_ep = self.ks_client.service_catalog.url_for(
-                    service_type='network',
-                    endpoint_type='publicURL')
-                neutron_client = neutronclient.Client(
-                    endpoint_url=neutron_ep,
-                    token=self.ks_client.auth_token)
-            routers = neutron_client.list_routers(
-                name=self.uconfig['router-name'])
-            if len(routers['routers']) == 0:
-                hookenv.log("Router not found")
-            else:
-                router = routers['routers'][0]
-                network_info['router_id'] = router['id']
-            networks = neutron_client.list_networks(
-                name=self.uconfig['network-name'])
-            if len(networks['networks']) == 0:
-                hookenv.log("network not found")
-            else:
-                network = networks['networks'][0]
-                network_info['public_network_id'] = network['id']
-            networks = neutron_client.list_networks(
-                name=self.uconfig['floating-network-name'])
-            if len(networks['networks']) == 0:
-                hookenv.log("Floating network name not found")
-            else:
-                network_info['floating_network_name'] = \
-                    self.uconfig['floating-network-name']
+            neutron_client = self.get_client('network')
+            router_name = self.uconfig['router-name']
+            routers = discovery.resolve_names(
+                [router_name],
+                lookup=lambda names: neutron_client.list_routers(
+                    name=names)['routers'],
+                batch=True,
+                kind='router')
+            if router_name in routers:
+                network_info['router_id'] = routers[router_name]['id']
+            # The public and floating networks are frequently the same
+            # network so resolve both with a single request.
+            network_name = self.uconfig['network-name']
+            floating_network_name = self.uconfig['floating-network-name']
+            networks = discovery.resolve_names(
+                [network_name, floating_network_name],
+                lookup=lambda names: neutron_client.list_networks(
+                    name=names)['networks'],
+                batch=True,
+                kind='network')
+            if network_name in networks:
+                network_info['public_network_id'] = \
+                    networks[network_name]['id']
+            if floating_network_name in networks:
+                network_info['floating_network_name'] = floating_network_name
         return network_info
 
     def service_present(self, service):
@@ -266,52 +473,71 @@ class TempestAdminAdapter(adapters.OpenStackRelationAdapter):
         :params service: string Service type
         @returns Boolean: True if service is registered
         """
-        return service in self.get_present_services()
-
-    def get_nova_client(self):
-        if not self.keystone_session:
-            auth = keystoneauth1_v2.Password(
-                auth_url=self.keystone_auth_url(),
-                username=self.keystone_info['service_username'],
-                password=self.keystone_info['service_password'],
-                tenant_name=self.keystone_info['service_tenant_name'])
-            self.keystone_session = keystoneauth1_session.Session(auth=auth)
-        return novaclient_client.Client(
-            2, session=self.keystone_session)
+        self.init_keystone_client()
+        return self.catalogue.has_service(service)
 
-    @property
-    def compute_info(self):
+    def get_compute_info(self):
         """Return flavor ids for user-defined flavors
 
         @returns {'flavor_id' id1, 'flavor_alt_id': id2}
         """
         compute_info = {}
         if self.service_present('nova'):
-            nova_client = self.get_nova_client()
+            nova_client = self.get_client('compute')
             nova_ep = self.resolve_endpoint('compute', 'public')
-            url = urllib.parse.urlparse(nova_ep)
-            compute_info['nova_base'] = '{}://{}'.format(
-                url.scheme,
-                url.netloc.split(':')[0])
-            for flavor in nova_client.flavors.list():
-                if self.uconfig['flavor-name'] == flavor.name:
-                    compute_info['flavor_id'] = flavor.id
-                if self.uconfig['flavor-alt-name'] == flavor.name:
-                    compute_info['flavor_alt_id'] = flavor.id
+            if nova_ep:
+                url = urllib.parse.urlparse(nova_ep)
+                compute_info['nova_base'] = '{}://{}'.format(
+                    url.scheme,
+                    url.netloc.split(':')[0])
+            # Nova has no server side name filter for flavors so page
+            # through the listing, stopping once both names are found.
+            flavor_name = self.uconfig['flavor-name']
+            flavor_alt_name = self.uconfig['flavor-alt-name']
+            flavors = discovery.resolve_names(
+                [flavor_name, flavor_alt_name],
+                scan=lambda: discovery.paginate(nova_client.flavors.list),
+                kind='flavor')
+            if flavor_name in flavors:
+                compute_info['flavor_id'] = flavors[flavor_name].id
+            if flavor_alt_name in flavors:
+                compute_info['flavor_alt_id'] = flavors[flavor_alt_name].id
         return compute_info
 
+    def get_quota_headroom(self):
+        """Return the quota left in the project tempest runs in
+
+        @returns {resource: count, ...} for the compute and network quotas
+                 which are limited, keyed by neutron quota names and nova's
+                 instances and cores
+        """
+        headroom = {}
+        if self.service_present('nova'):
+            limits = self.get_client('compute').limits.get()
+            absolute = {limit.name: limit.value for limit in limits.absolute}
+            for resource, (limit_key, used_key) in self.compute_quotas.items():
+                limit = absolute.get(limit_key)
+                if limit is not None and limit >= 0:
+                    headroom[resource] = limit - absolute.get(used_key, 0)
+        if self.service_present('neutron'):
+            quota = self.get_client('network').show_quota_details(
+                self.keystone_session.get_project_id())['quota']
+            for resource, detail in quota.items():
+                if detail.get('limit', -1) >= 0:
+                    headroom[resource] = (detail['limit'] -
+                                          detail.get('used', 0) -
+                                          detail.get('reserved', 0))
+        return headroom
+
     def get_present_services(self):
         """Query keystone catalogue for a list for registered services
 
         @returns [svc1, svc2, ...]: List of registered services
         """
-        services = [svc.name
-                    for svc in self.ks_client.services.list()
-                    if svc.enabled]
-        return services
+        self.init_keystone_client()
+        return self.catalogue.service_names()
 
-    @property
-    def service_info(self):
+    def get_service_info(self):
         """Assemble a list of services tempest should tests
 
         Compare the list of keystone registered services with the services the
@@ -326,17 +552,12 @@ class TempestAdminAdapter(adapters.OpenStackRelationAdapter):
                               'sahara', 'swift', 'trove', 'zaqar', 'neutron']
         present_svcs = self.get_present_services()
         # If not running in an action context asssume auto mode
-        try:
-            action_args = hookenv.action_get()
-        except Exception:
-            action_args = {'service-whitelist': 'auto'}
-        if action_args['service-whitelist'] == 'auto':
+        white_list = action_arg('service-whitelist', 'auto')
+        if white_list == 'auto':
             white_list = []
             for svc in present_svcs:
                 if svc in tempest_candidates:
                     white_list.append(svc)
-        else:
-            white_list = action_args['service-whitelist']
         for svc in tempest_candidates:
             if svc in white_list:
                 service_info[svc] = 'true'
@@ -357,6 +578,9 @@ class TempestAdapters(adapters.OpenStackRelationAdapters):
         super(TempestAdapters, self).__init__(
             relations,
             options=TempestConfigurationAdapter)
+        identity_admin = getattr(self, 'identity_admin', None)
+        if identity_admin:
+            identity_admin.prefetch_discovery()
 
 
 class TempestConfigurationAdapter(adapters.ConfigurationAdapter):
@@ -377,8 +601,41 @@ class TempestCharm(charm.OpenStackCharm):
     TEMPEST_ROOT = '/var/lib/tempest'
     TEMPEST_LOGDIR = TEMPEST_ROOT + '/logs'
     TEMPEST_CONF = TEMPEST_ROOT + '/tempest.conf'
+    DISCOVERY_CACHE = TEMPEST_ROOT + '/discovery-cache.json'
+    """Bare mirror of tempest-source shared by the per branch worktrees"""
+    TEMPEST_MIRROR = TEMPEST_ROOT + '/tempest.git'
+    """Unpacked tempest-bundle resource for offline installs"""
+    TEMPEST_BUNDLE = TEMPEST_ROOT + '/bundle'
+    """Per test results of every run"""
+    RESULTS_DB = TEMPEST_ROOT + '/results.db'
+    """Counters and histograms of the runs exported as metrics"""
+    METRICS_STATE = TEMPEST_ROOT + '/metrics.json'
+    RUNS_DIR = TEMPEST_ROOT + '/runs'
+    SHARDS_DIR = TEMPEST_ROOT + '/shards'
+    PEER_RELATION = 'cluster'
+    RENDER_FINGERPRINT = TEMPEST_CONF + '.fingerprint'
     """pip.conf for proxy settings etc"""
     PIP_CONF = '/root/.pip/pip.conf'
+    """Seconds tempest's tox.ini allows each test of the run targets when
+       OS_TEST_TIMEOUT is unset, applied to runs from the virtualenv too
+    """
+    TOX_TEST_TIMEOUT = 1200
+    """tempest run arguments equivalent to the tox targets in tempest's
+       tox.ini, targets not listed here are run through tox
+    """
+    TOX_TARGET_ARGS = {
+        'smoke': ['--smoke'],
+        'full': ['--regex',
+                 r'(?!.*\[.*\bslow\b.*\])(^tempest\.(api|scenario))'],
+    }
+
+    """Regexes selecting the same tests as TOX_TARGET_ARGS, used to pick
+       the tests of a target from the test index for scheduling
+    """
+    TOX_TARGET_REGEX = {
+        'smoke': r'\[.*\bsmoke\b.*\]',
+        'full': r'(?!.*\[.*\bslow\b.*\])(^tempest\.(api|scenario))',
+    }
 
     """List of packages charm should install
        XXX The install hook is currently installing most packages ahead of
@@ -395,7 +652,7 @@ class TempestCharm(charm.OpenStackCharm):
         'python3-keystoneclient', 'python3-neutronclient',
         'python3-novaclient', 'python3-swiftclient',
         'python3-ceilometerclient', 'openvswitch-common', 'libffi-dev',
-        'libssl-dev', 'python-dev', 'python-cffi'
+        'libssl-dev', 'python-dev', 'python-cffi', 'python3-venv'
     ]
 
     """Use the Tempest specific adapters"""
@@ -422,28 +679,485 @@ class TempestCharm(charm.OpenStackCharm):
             if not os.path.exists(tempest_dir):
                 os.mkdir(tempest_dir)
 
-    def setup_git(self, branch, git_dir):
-        """Clone tempest and symlink in rendered tempest.conf"""
+    def render_fingerprint(self, interfaces_list):
+        """Digest of the inputs to the rendered configs
+
+        The cloud's state is represented by the discovery cache, so without
+        a current cache entry the inputs are unknown.
+
+        @return string digest or None if the inputs can not be determined
+        """
         conf = hookenv.config()
-        if not os.path.exists(git_dir):
-            git_url = conf['tempest-source']
-            fetch.install_remote(str(git_url), dest=str(git_dir),
-                                 branch=str(branch), depth=str(1))
-        conf_symlink = git_dir + '/tempest/etc/tempest.conf'
-        if not os.path.exists(conf_symlink):
-            os.symlink(self.TEMPEST_CONF, conf_symlink)
-
-    def execute_tox(self, run_dir, logfile, tox_target):
-        """Trigger tempest run through tox setting proxies if needed"""
+        snapshot = discovery.DiscoveryCache(
+            self.DISCOVERY_CACHE,
+            None,
+            conf.get('discovery-cache-ttl')).read()
+        if not snapshot:
+            return None
+        templates = {}
+        templates_dir = os.path.join(hookenv.charm_dir(), 'templates')
+        for template in sorted(os.listdir(templates_dir)):
+            with open(os.path.join(templates_dir, template), 'r') as f:
+                templates[template] = f.read()
+        return discovery.fingerprint(
+            [interface.credentials() for interface in interfaces_list],
+            dict(conf),
+            action_arg('service-whitelist', 'auto'),
+            snapshot,
+            templates)
+
+    def render_if_changed(self, interfaces_list):
+        """Render the configs unless their inputs match the last render
+
+        Skipping the render also skips the OpenStack lookups behind it. The
+        force-render and refresh-discovery action parameters always render.
+        """
+        forced = (action_arg('force-render', False) or
+                  action_arg('refresh-discovery', False))
+        fingerprint = self.render_fingerprint(interfaces_list)
+        if (fingerprint and not forced and
+                os.path.exists(self.TEMPEST_CONF) and
+                os.path.exists(self.RENDER_FINGERPRINT)):
+            with open(self.RENDER_FINGERPRINT, 'r') as f:
+                if f.read().strip() == fingerprint:
+                    hookenv.log("Render inputs unchanged, skipping render of "
+                                "{}".format(self.TEMPEST_CONF))
+                    return
+        self.render_with_interfaces(interfaces_list)
+        # Rendering may have refreshed the discovery cache
+        fingerprint = self.render_fingerprint(interfaces_list)
+        if fingerprint:
+            with open(self.RENDER_FINGERPRINT, 'w') as f:
+                f.write(fingerprint)
+        elif os.path.exists(self.RENDER_FINGERPRINT):
+            os.unlink(self.RENDER_FINGERPRINT)
+
+    def tempest_bundle(self):
+        """Path of the unpacked tempest-bundle resource or None"""
+        if not hasattr(self, '_tempest_bundle'):
+            self._tempest_bundle = self.unpack_tempest_bundle()
+        return self._tempest_bundle
+
+    def unpack_tempest_bundle(self):
+        """Unpack the tempest-bundle resource if one is attached
+
+        The bundle is a tarball holding a bare tempest git repository,
+        tempest.git, and a wheelhouse of its requirements, wheelhouse/. It
+        is only unpacked again when the attached resource changes.
+
+        @return path of the unpacked bundle or None if there is no bundle
+        """
+        resource = hookenv.resource_get('tempest-bundle')
+        if not resource or not os.path.getsize(resource):
+            return None
+        digest = hashlib.sha256()
+        with open(resource, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        stamp = os.path.join(self.TEMPEST_BUNDLE, '.resource-hash')
+        if os.path.exists(stamp):
+            with open(stamp, 'r') as f:
+                if f.read().strip() == digest.hexdigest():
+                    return self.TEMPEST_BUNDLE
+        if os.path.exists(self.TEMPEST_BUNDLE):
+            shutil.rmtree(self.TEMPEST_BUNDLE)
+        with tarfile.open(resource) as bundle:
+            for member in bundle.getmembers():
+                paths = [member.name]
+                if member.issym():
+                    paths.append(os.path.join(os.path.dirname(member.name),
+                                              member.linkname))
+                elif member.islnk():
+                    paths.append(member.linkname)
+                if not all(map(self.bundle_path_is_safe, paths)):
+                    raise ValueError(
+                        "Refusing to unpack {} from tempest-bundle".format(
+                            member.name))
+            if hasattr(tarfile, 'data_filter'):
+                bundle.extractall(self.TEMPEST_BUNDLE, filter='data')
+            else:
+                bundle.extractall(self.TEMPEST_BUNDLE)
+        with open(stamp, 'w') as f:
+            f.write(digest.hexdigest())
+        return self.TEMPEST_BUNDLE
+
+    @staticmethod
+    def bundle_path_is_safe(path):
+        """Check a path in the tempest-bundle stays inside the bundle"""
+        path = os.path.normpath(path)
+        return not (os.path.isabs(path) or path == '..' or
+                    path.startswith('..' + os.sep))
+
+    def workspace(self):
+        """Return the tempest mirror and checkouts with proxies applied"""
+        return workspace.Workspace(self.TEMPEST_MIRROR, env=self.proxy_env())
+
+    def git_url(self):
+        """Return the URL the tempest mirror is fetched from"""
+        bundle = self.tempest_bundle()
+        if bundle:
+            return os.path.join(bundle, 'tempest.git')
+        return str(hookenv.config()['tempest-source'])
+
+    def mirror_is_stale(self):
+        """Apply the tempest-source-refresh-interval policy to the mirror
+
+        @return Boolean: True if the mirror should be fetched
+        """
+        interval = hookenv.config().get('tempest-source-refresh-interval', 0)
+        if self.tempest_bundle():
+            # Fetching from the local bundle is cheap
+            return True
+        if interval < 0:
+            return False
+        fetch_head = os.path.join(self.TEMPEST_MIRROR, 'FETCH_HEAD')
+        if not os.path.exists(fetch_head):
+            return True
+        return time.time() - os.path.getmtime(fetch_head) >= interval
+
+    def prepare_spec(self, branch, run_dir, venv_dir):
+        """Return the inputs workspace.prepare needs to check out branch
+
+        The mirror, its fetch policy, the bundle and proxies are resolved
+        here so a detached supervisor can prepare the checkout without the
+        hook tools.
+        """
+        return {'mirror': self.TEMPEST_MIRROR,
+                'git_url': self.git_url(),
+                'fetch': self.mirror_is_stale(),
+                'run_dir': run_dir,
+                'ref': branch,
+                'conf': self.TEMPEST_CONF,
+                'venv_dir': venv_dir,
+                'bundle': self.tempest_bundle(),
+                'env': self.proxy_env()}
+
+    def update_mirror(self):
+        """Create the bare tempest mirror or fetch any new objects into it
+        """
+        self.workspace().update_mirror(
+            self.git_url(),
+            fetch=(os.path.exists(self.TEMPEST_MIRROR) and
+                   self.mirror_is_stale()))
+
+    def setup_git(self, branch, git_dir):
+        """Check out tempest and symlink in rendered tempest.conf
+
+        Each branch or tag is a detached worktree of a shared bare mirror
+        so switching refs only needs objects which have not been fetched
+        before.
+        """
+        self.update_mirror()
+        self.workspace().worktree(git_dir + '/tempest', branch,
+                                  conf=self.TEMPEST_CONF)
+
+    def proxy_env(self):
+        """Return a copy of the environment with proxies set if needed"""
         env = os.environ.copy()
         conf = hookenv.config()
         if conf.get('http-proxy'):
             env['http_proxy'] = conf['http-proxy']
         if conf.get('https-proxy'):
             env['https_proxy'] = conf['https-proxy']
-        cmd = ['tox', '-e', tox_target]
-        f = open(logfile, "w")
-        subprocess.call(cmd, cwd=run_dir, stdout=f, stderr=f, env=env)
+        return env
+
+    def constraints_file(self, run_dir):
+        """Return the upper-constraints tox installs a checkout's deps with
+        """
+        return workspace.constraints_file(run_dir,
+                                          bundle=self.tempest_bundle())
+
+    def venv_dir(self, branch):
+        return '{}/venv-{}'.format(self.TEMPEST_ROOT, branch)
+
+    def setup_venv(self, branch, run_dir):
+        """Build the persistent tempest virtualenv for a branch
+
+        The virtualenv is reused by every run until the checkout's
+        requirements change, keeping the pip install out of the run. With a
+        tempest-bundle attached only its wheelhouse is used.
+
+        @return venv_dir or None if the virtualenv could not be built
+        """
+        venv_dir = self.venv_dir(branch)
+        if workspace.venv_current(venv_dir, run_dir):
+            return venv_dir
+        if os.path.exists(venv_dir):
+            hookenv.log("Requirements changed, rebuilding {}".format(
+                venv_dir))
+        try:
+            self.workspace().build_venv(venv_dir, run_dir,
+                                        bundle=self.tempest_bundle())
+        except subprocess.CalledProcessError as e:
+            hookenv.log("Unable to build {}, falling back to tox: {}".format(
+                venv_dir, e), level=hookenv.WARNING)
+            return None
+        return venv_dir
+
+    def venv_env(self, run_dir, venv_dir):
+        """Return the environment to run tempest from venv_dir with"""
+        env = self.proxy_env()
+        env['VIRTUAL_ENV'] = venv_dir
+        env['PATH'] = '{}:{}'.format(
+            os.path.join(venv_dir, 'bin'), env.get('PATH', ''))
+        env['TEMPEST_CONFIG_DIR'] = os.path.join(run_dir, 'etc')
+        return env
+
+    def tempest_cmd(self, run_dir, tox_target, venv_dir=None,
+                    worker_file=None, run_args=None, concurrency=None,
+                    load_list=None, test_timeout=None):
+        """Return the command and environment to run tox_target with
+
+        Runs go straight to tempest in venv_dir when the target has a
+        tempest run equivalent, otherwise through tox. A worker_file runs
+        the tests through stestr with the partitions it lists.
+
+        :params run_args: list of tempest run arguments replacing the
+                          target's test selection, passed on to tox
+        :params concurrency: int Number of workers to run
+        :params load_list: string File listing the ids of the tests to run
+                           in place of the target's test selection
+        :params test_timeout: int Seconds after which tempest fails a test
+        """
+        args = []
+        if load_list:
+            args.extend(['--load-list', load_list])
+        args.extend(run_args or [])
+        if concurrency:
+            args.extend(['--concurrency', str(concurrency)])
+        if venv_dir and tox_target in self.TOX_TARGET_ARGS:
+            env = self.venv_env(run_dir, venv_dir)
+            env['OS_TEST_TIMEOUT'] = str(test_timeout or
+                                         self.TOX_TEST_TIMEOUT)
+            if worker_file:
+                cmd = [os.path.join(venv_dir, 'bin', 'stestr'), 'run',
+                       '--worker-file', worker_file]
+            else:
+                cmd = [os.path.join(venv_dir, 'bin', 'tempest'), 'run']
+                if not (load_list or run_args):
+                    cmd.extend(self.TOX_TARGET_ARGS[tox_target])
+                cmd.extend(args)
+        else:
+            env = self.proxy_env()
+            if test_timeout:
+                env['OS_TEST_TIMEOUT'] = str(test_timeout)
+            cmd = ['tox', '-e', tox_target]
+            if worker_file:
+                args = ['--worker-file', worker_file] + args
+            if args:
+                cmd.append('--')
+                cmd.extend(args)
+        return cmd, env
+
+    def git_head(self, run_dir):
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=run_dir).decode('utf-8').strip()
+
+    def list_tests(self, run_dir, venv_dir):
+        """List the ids of every test in the checkout
+
+        @return list of test ids, empty if they could not be listed
+        """
+        cmd = [os.path.join(venv_dir, 'bin', 'stestr'), 'list']
+        try:
+            output = subprocess.check_output(
+                cmd, cwd=run_dir, env=self.venv_env(run_dir, venv_dir))
+        except (OSError, subprocess.CalledProcessError) as e:
+            hookenv.log("Unable to list tests: {}".format(e),
+                        level=hookenv.WARNING)
+            return []
+        return [line.strip() for line in output.decode('utf-8').splitlines()
+                if line.strip()]
+
+    def test_index(self, git_dir, run_dir, venv_dir):
+        """Return the ids of every test in the checkout
+
+        Tests are only listed again when the checkout's HEAD has moved
+        since the index was built.
+        """
+        index = selection.TestIndex(os.path.join(git_dir, 'test-index.json'),
+                                    self.git_head(run_dir))
+        test_ids = index.load()
+        if test_ids is None:
+            test_ids = self.list_tests(run_dir, venv_dir)
+            if test_ids:
+                index.save(test_ids)
+        return test_ids
+
+    def select_tests(self, action_args, git_dir, run_dir, tox_target,
+                     venv_dir=None):
+        """Resolve the test selection action parameters to test ids
+
+        Without selection parameters, runs of a target scheduled by
+        duration still pick the target's tests from the index.
+
+        @return list of test ids to run, None to run the target as usual
+        @raises ValueError if the selection can not be resolved
+        """
+        include = action_args.get('include-regex')
+        exclude = action_args.get('exclude-regex')
+        list_file = action_args.get('test-list')
+        if not (include or exclude or list_file):
+            if (action_args.get('schedule') != 'duration' or
+                    action_args.get('run-tempest-args') or not venv_dir or
+                    tox_target not in self.TOX_TARGET_REGEX):
+                return None
+            include = self.TOX_TARGET_REGEX[tox_target]
+        if not venv_dir:
+            raise ValueError("Selecting tests needs the tempest virtualenv")
+        try:
+            patterns = None
+            if list_file:
+                patterns = selection.read_test_list(list_file)
+            return selection.select(
+                self.test_index(git_dir, run_dir, venv_dir),
+                include=include, exclude=exclude, patterns=patterns)
+        except (IOError, re.error) as e:
+            raise ValueError("Invalid test selection: {}".format(e))
+
+    def failed_tests(self, git_dir, run_dir, venv_dir=None):
+        """Find the tests which failed in the last recorded run
+
+        Reruns count towards the run they reran, so rerunning again only
+        runs the tests which are still failing. A failed class fixture
+        reruns every test of the class found in the test index.
+
+        @return (id of the original run, [test_id, ...]), the run id is
+                None if no run has been recorded
+        """
+        if not os.path.exists(self.RESULTS_DB):
+            return None, []
+        history = results.ResultsHistory(self.RESULTS_DB)
+        try:
+            run_ids = history.recent_runs(1)
+            if not run_ids:
+                return None, []
+            run_id, statuses = history.run_outcome(run_ids[0])
+        finally:
+            history.close()
+        failed = set()
+        fixtures = []
+        for test_id, status in statuses.items():
+            if status not in results.FAILED_STATUSES:
+                continue
+            match = results.FIXTURE_RE.match(test_id)
+            if match:
+                fixtures.append(match.group(1) + '.')
+            else:
+                failed.add(test_id)
+        if fixtures and venv_dir:
+            failed.update(
+                test_id for test_id in self.test_index(git_dir, run_dir,
+                                                       venv_dir)
+                if test_id.startswith(tuple(fixtures)))
+        elif fixtures:
+            hookenv.log("Unable to rerun failed class fixtures without the "
+                        "tempest virtualenv", level=hookenv.WARNING)
+        return run_id, sorted(failed)
+
+    def recorded_durations(self):
+        """Median durations of tests in the results history
+
+        @return {test_id: seconds, ...}
+        """
+        if not os.path.exists(self.RESULTS_DB):
+            return {}
+        history = results.ResultsHistory(self.RESULTS_DB)
+        try:
+            return history.median_durations()
+        finally:
+            history.close()
+
+    def schedule_tests(self, test_ids, logfile, workers=None):
+        """Partition tests by their recorded durations
+
+        The partitions are written next to logfile as an stestr worker
+        file, one per worker or per CPU if workers is not given, so the
+        workers finish at about the same time.
+
+        @return path of the worker file
+        """
+        partitions = scheduling.partition(
+            test_ids, self.recorded_durations(),
+            workers or os.cpu_count() or 1)
+        worker_file = os.path.splitext(logfile)[0] + '.workers.yaml'
+        scheduling.write_worker_file(partitions, worker_file)
+        return worker_file
+
+    def execute_tox(self, run_dir, logfile, tox_target, venv_dir=None,
+                    worker_file=None, run_args=None, concurrency=None,
+                    load_list=None, run_timeout=None, test_timeout=None):
+        """Trigger tempest run through tox setting proxies if needed
+
+        The output is written to logfile and parsed as it streams past.
+        A run which overruns its timeouts is torn down and the summary of
+        the tests it completed is returned, with timed-out set.
+
+        @return dict: Dictonary of summary data
+        """
+        cmd, env = self.tempest_cmd(run_dir, tox_target, venv_dir=venv_dir,
+                                    worker_file=worker_file,
+                                    run_args=run_args,
+                                    concurrency=concurrency,
+                                    load_list=load_list,
+                                    test_timeout=test_timeout)
+        parser = results.TempestOutputParser()
+        proc = subprocess.Popen(cmd, cwd=run_dir, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, env=env,
+                                start_new_session=True)
+        with supervisor.Watchdog(proc, run_timeout, test_timeout) as watchdog:
+            supervisor.stream_output(proc, logfile, parser,
+                                     watchdog=watchdog)
+        summary = parser.summary
+        if watchdog.reason:
+            hookenv.log("Tempest run exceeded its {} timeout".format(
+                watchdog.reason), level=hookenv.WARNING)
+            summary['timed-out'] = watchdog.reason
+        return summary
+
+    def tox_envdir(self, run_dir, tox_target):
+        """Return the virtualenv tox runs tox_target in
+
+        tempest's tox.ini shares one envdir between its run targets, so
+        the envdir is read from the checkout's tox.ini.
+        """
+        toxworkdir = os.path.join(run_dir, '.tox')
+        parser = configparser.ConfigParser(interpolation=None, strict=False)
+        try:
+            parser.read(os.path.join(run_dir, 'tox.ini'))
+            envdir = (
+                parser.get('testenv:' + tox_target, 'envdir', fallback='') or
+                parser.get('testenv', 'envdir', fallback=''))
+        except configparser.Error as e:
+            hookenv.log("Unable to read the tox.ini of {}: {}".format(
+                run_dir, e), level=hookenv.WARNING)
+            envdir = ''
+        envdir = envdir.strip().replace('{toxworkdir}', toxworkdir).replace(
+            '{toxinidir}', run_dir).replace('{envname}', tox_target)
+        if not envdir:
+            return os.path.join(toxworkdir, tox_target)
+        return os.path.join(run_dir, envdir)
+
+    def subunit_cmd(self, run_dir, tox_target, venv_dir=None):
+        """Return the command printing the subunit stream of the last run"""
+        if venv_dir:
+            bin_dir = os.path.join(venv_dir, 'bin')
+        else:
+            bin_dir = os.path.join(self.tox_envdir(run_dir, tox_target),
+                                   'bin')
+        return [os.path.join(bin_dir, 'stestr'), 'last', '--subunit']
+
+    def collect_subunit(self, run_dir, subunit_file, tox_target,
+                        venv_dir=None):
+        """Save the subunit v2 stream of the last run and decode it
+
+        The stream is decoded as it is read from stestr, in the same pass
+        as it is written to subunit_file.
+
+        @return results.TestRecordStore of the run's tests
+        """
+        cmd = self.subunit_cmd(run_dir, tox_target, venv_dir=venv_dir)
+        return supervisor.collect_subunit(cmd, run_dir, subunit_file)
 
     def get_tempest_files(self, branch_name):
         """Prepare tempest files and directories
@@ -461,34 +1175,680 @@ class TempestCharm(charm.OpenStackCharm):
 
         @return dict: Dictonary of summary data
         """
-        summary = {}
-        with open(logfile, 'r') as tempest_log:
-            summary_line = False
+        parser = results.TempestOutputParser()
+        with logs.open_log(logfile, 'r') as tempest_log:
             for line in tempest_log:
-                if line.strip() == "Totals":
-                    summary_line = True
-                if line.strip() == "Worker Balance":
-                    summary_line = False
-                if summary_line:
-                    # Match lines like: ' - Unexpected Success: 0'
-                    matchObj = re.match(
-                        r'(.*)- (.*?):\s+(.*)', line, re.M | re.I)
-                    if matchObj:
-                        key = matchObj.group(2)
-                        key = key.replace(' ', '-').replace(':', '').lower()
-                        summary[key] = matchObj.group(3)
-        return summary
+                parser.feed(line)
+        return parser.summary
+
+    def resolve_timeouts(self, action_args):
+        """Return the run and per test timeouts in seconds, None if unset
 
-    def run_test(self, tox_target):
+        The run-timeout and test-timeout action parameters override the
+        charm options of the same names.
+        """
+        timeouts = []
+        for key in ('run-timeout', 'test-timeout'):
+            timeout = (action_args.get(key) or
+                       hookenv.config().get(key) or 0)
+            timeouts.append(int(timeout) if int(timeout) > 0 else None)
+        return tuple(timeouts)
+
+    def resolve_concurrency(self, interfaces_list=None):
+        """Return the number of workers to run tempest with
+
+        The concurrency action parameter overrides the charm option. In
+        auto mode there is one worker per CPU, reduced to fit the quota
+        left in the project when the identity-admin interface is given.
+        The quota left is read with the rest of the discovery when the
+        configs are rendered and reused from the discovery cache, so the
+        cloud is only queried for it here when there is no cached value.
+        """
+        value = str(action_arg('concurrency') or
+                    hookenv.config().get('concurrency') or 'auto')
+        if value != 'auto':
+            try:
+                return max(1, int(value))
+            except ValueError:
+                hookenv.log("Invalid concurrency {}, using auto".format(
+                    value), level=hookenv.WARNING)
+        headroom = None
+        if interfaces_list:
+            headroom = self.cached_quota_headroom()
+            if headroom is None:
+                try:
+                    headroom = TempestAdminAdapter(
+                        interfaces_list[0]).get_quota_headroom()
+                except Exception as e:
+                    hookenv.log("Unable to read project quotas: {}".format(
+                        e), level=hookenv.WARNING)
+        return scheduling.auto_concurrency(os.cpu_count() or 1,
+                                           headroom or {})
+
+    def cached_quota_headroom(self):
+        """Return the quota left from the discovery cache, None if unknown
+
+        The configs are rendered before each run, which refreshes the cache
+        whenever its inputs change, so any current entry is for this cloud.
+        """
+        entry = discovery.DiscoveryCache(
+            self.DISCOVERY_CACHE,
+            None,
+            hookenv.config().get('discovery-cache-ttl')).read()
+        if not entry:
+            return None
+        return (entry.get('snapshot') or {}).get('quota_headroom')
+
+    def run_test(self, tox_target, interfaces_list=None):
         """Run smoke tests"""
         action_args = hookenv.action_get()
-        branch_name = action_args['branch']
+        try:
+            if action_args.get('shard'):
+                action_info = self.start_sharded_run(
+                    tox_target, action_args, interfaces_list)
+            else:
+                action_info = self.start_run(
+                    tox_target, action_args, interfaces_list)
+        except ValueError as e:
+            hookenv.action_fail(str(e))
+            return
+        hookenv.action_set(action_info)
+        self.rotate_logs()
+
+    def prepare_checkout(self, branch_name):
+        """Check out branch_name and build its virtualenv
+
+        @return git_dir, logfile, run_dir, venv_dir
+        """
         git_dir, logfile, run_dir = self.get_tempest_files(branch_name)
         self.setup_directories()
-        self.setup_git(branch_name, git_dir)
-        self.execute_tox(run_dir, logfile, tox_target)
-        action_info = self.parse_tempest_log(logfile)
-        action_info['tempest-logfile'] = logfile
+        with timing.PHASES.phase('setup-git'):
+            self.setup_git(branch_name, git_dir)
+        with timing.PHASES.phase('setup-venv'):
+            venv_dir = self.setup_venv(branch_name, run_dir)
+        return git_dir, logfile, run_dir, venv_dir
+
+    def start_run(self, tox_target, action_args, interfaces_list=None,
+                  checkout=None, test_ids=None, shard_of=None,
+                  prepare=None):
+        """Run tempest with the run-tempest parameters in action_args
+
+        :params checkout: (git_dir, logfile, run_dir, venv_dir) of a
+                          checkout prepared by prepare_checkout
+        :params prepare: dict from prepare_spec of a checkout the detached
+                         run prepares itself, test_ids must be set
+        :params test_ids: list of test ids to run in place of the
+                          selection in action_args
+        :params shard_of: string Id of the sharded run this run is a shard
+                          of, shards are always detached and their results
+                          are merged by the leader rather than recorded
+        @return dict of action results
+        @raises ValueError if the run can not be started
+        """
+        branch_name = action_args['branch']
+        git_dir, logfile, run_dir, venv_dir = (
+            checkout or self.prepare_checkout(branch_name))
+        with timing.PHASES.phase('resolve-concurrency'):
+            concurrency = self.resolve_concurrency(interfaces_list)
+        run_timeout, test_timeout = self.resolve_timeouts(action_args)
+        run_args = shlex.split(action_args.get('run-tempest-args') or '')
+        rerun_of = None
+        if test_ids is None and action_args.get('rerun-failed'):
+            with timing.PHASES.phase('select-tests'):
+                rerun_of, test_ids = self.failed_tests(git_dir, run_dir,
+                                                       venv_dir=venv_dir)
+            if rerun_of is None:
+                raise ValueError("No previous run to rerun tests from")
+            if not test_ids:
+                return {'rerun-of': rerun_of, 'rerun-tests': 0}
+        elif test_ids is None:
+            with timing.PHASES.phase('select-tests'):
+                test_ids = self.select_tests(action_args, git_dir, run_dir,
+                                             tox_target, venv_dir=venv_dir)
+            if test_ids is not None and not test_ids:
+                raise ValueError("No tests match the selection")
+        worker_file = None
+        load_list = None
+        if test_ids and action_args.get('schedule') == 'duration':
+            worker_file = self.schedule_tests(test_ids, logfile,
+                                              workers=concurrency)
+        elif test_ids:
+            load_list = os.path.splitext(logfile)[0] + '.tests'
+            with open(load_list, 'w') as f:
+                f.writelines('{}\n'.format(test_id) for test_id in test_ids)
+        run_info = {'tempest-logfile': logfile, 'concurrency': concurrency}
+        if rerun_of:
+            run_info['rerun-of'] = rerun_of
+            run_info['rerun-tests'] = len(test_ids)
+        elif test_ids:
+            run_info['selected-tests'] = len(test_ids)
+        if worker_file:
+            run_info['worker-file'] = worker_file
+        subunit_file = os.path.splitext(logfile)[0] + '.subunit'
+        timing_file = os.path.splitext(logfile)[0] + '.timing.json'
+        if action_args.get('detach') or shard_of:
+            cmd, env = self.tempest_cmd(
+                run_dir, tox_target, venv_dir=venv_dir,
+                worker_file=worker_file, run_args=run_args,
+                concurrency=concurrency, load_list=load_list,
+                test_timeout=test_timeout)
+            total = len(test_ids) if test_ids else None
+            if (total is None and venv_dir and not run_args and
+                    tox_target in self.TOX_TARGET_REGEX):
+                total = len(selection.select(
+                    self.test_index(git_dir, run_dir, venv_dir),
+                    include=self.TOX_TARGET_REGEX[tox_target]))
+            run_info['job-id'] = self.start_detached({
+                'cmd': cmd,
+                'env': env,
+                'cwd': run_dir,
+                'logfile': logfile,
+                'subunit_cmd': self.subunit_cmd(run_dir, tox_target,
+                                                venv_dir=venv_dir),
+                'subunit_file': subunit_file,
+                'results_db': None if shard_of else self.RESULTS_DB,
+                'branch': branch_name,
+                'target': tox_target,
+                'rerun_of': rerun_of,
+                'slowest_tests': int(action_args.get('slowest-tests', 10)),
+                'total': total,
+                'run_timeout': run_timeout,
+                'test_timeout': test_timeout,
+                'timing': {'phases': timing.PHASES.summary(),
+                           'http': timing.HTTP.summary()},
+                'timing_file': timing_file,
+                'metrics': None if shard_of else self.metrics_spec(),
+                'prepare': prepare,
+                'action_info': run_info})
+            return run_info
+        with timing.PHASES.phase('execute-tox'):
+            action_info = self.execute_tox(run_dir, logfile, tox_target,
+                                           venv_dir=venv_dir,
+                                           worker_file=worker_file,
+                                           run_args=run_args,
+                                           concurrency=concurrency,
+                                           load_list=load_list,
+                                           run_timeout=run_timeout,
+                                           test_timeout=test_timeout)
+        action_info.update(run_info)
+        # stestr only stores a run which completes, after a torn down run
+        # stestr last would return the results of the previous run
+        recorded = 'timed-out' not in action_info
+        if recorded:
+            with timing.PHASES.phase('parse-results'):
+                store = self.collect_subunit(run_dir, subunit_file,
+                                             tox_target, venv_dir=venv_dir)
+                if store.records:
+                    action_info['subunit-file'] = subunit_file
+                    action_info.update(results.record_results(
+                        store, self.RESULTS_DB, logfile=logfile,
+                        branch=branch_name, target=tox_target,
+                        rerun_of=rerun_of,
+                        slowest=action_args.get('slowest-tests', 10)))
+        action_info.update(timing.report(timing.PHASES, timing.HTTP,
+                                         path=timing_file))
+        if recorded:
+            metrics.record_run(
+                self.METRICS_STATE, store, tox_target,
+                phases=timing.PHASES.summary(),
+                textfile_dir=self.metrics_spec()['textfile_dir'])
+        return action_info
+
+    def metrics_spec(self):
+        """Return where the metrics of a run are kept and exported
+
+        @return {'state': string, 'textfile_dir': string or None}
+        """
+        return {'state': self.METRICS_STATE,
+                'textfile_dir': hookenv.config('metrics-textfile-dir') or None}
+
+    def start_detached(self, spec):
+        """Start a supervised tempest run which outlives the action
+
+        The supervisor runs in its own session so it is not stopped when
+        the action ends, and is given everything it needs in the job's
+        spec.json as it can not use the hook tools.
+
+        @return string Id of the job
+        """
+        job_id = os.path.splitext(os.path.basename(spec['logfile']))[0]
+        job_dir = os.path.join(self.RUNS_DIR, job_id)
+        os.makedirs(job_dir)
+        with open(os.path.join(job_dir, 'spec.json'), 'w') as f:
+            json.dump(spec, f)
+        supervisor.RunState(os.path.join(job_dir, 'state.json')).update(
+            status='starting', total=spec.get('total'))
+        with open(os.path.join(job_dir, 'supervisor.log'), 'w') as log:
+            subprocess.Popen(
+                [sys.executable, '-m', 'charm.openstack.supervisor', job_dir],
+                cwd=job_dir, env=self.lib_env(), stdin=subprocess.DEVNULL,
+                stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        return job_id
+
+    def lib_env(self):
+        """Return the environment for running the charm's modules directly
+        """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.join(hookenv.charm_dir(), 'lib')
+        return env
+
+    def active_runs(self):
+        """Return the ids of the detached runs still writing their logs"""
+        active = []
+        if os.path.isdir(self.RUNS_DIR):
+            for job_id in sorted(os.listdir(self.RUNS_DIR)):
+                _, state = self.job_state(job_id)
+                if state and supervisor.describe(state.load())['status'] in (
+                        'starting', 'running'):
+                    active.append(job_id)
+        return active
+
+    def rotate_logs(self):
+        """Compress and expire the logs of finished runs in the background
+
+        Runs are kept within the log-retention-runs, log-retention-days and
+        log-retention-size limits, the logs of detached runs which are
+        still going are left alone.
+        """
+        if not os.path.isdir(self.TEMPEST_LOGDIR):
+            return
+        config = hookenv.config()
+        cmd = [sys.executable, '-m', 'charm.openstack.logs',
+               self.TEMPEST_LOGDIR, '--runs-dir', self.RUNS_DIR,
+               '--max-runs', str(config.get('log-retention-runs') or 0),
+               '--max-days', str(config.get('log-retention-days') or 0),
+               '--max-megabytes', str(config.get('log-retention-size') or 0)]
+        for job_id in self.active_runs():
+            cmd.extend(['--active', job_id])
+        log_path = os.path.join(self.TEMPEST_LOGDIR, 'rotate.log')
+        with open(log_path, 'w') as log:
+            subprocess.Popen(
+                cmd, cwd=self.TEMPEST_LOGDIR, env=self.lib_env(),
+                stdin=subprocess.DEVNULL, stdout=log,
+                stderr=subprocess.STDOUT, start_new_session=True)
+
+    def job_state(self, job_id=None):
+        """Return the state of a detached run, the latest if job_id is unset
+
+        @return (job id, supervisor.RunState) or (None, None)
+        """
+        if not job_id:
+            jobs = []
+            if os.path.isdir(self.RUNS_DIR):
+                jobs = sorted(os.listdir(self.RUNS_DIR))
+            if not jobs:
+                return None, None
+            job_id = jobs[-1]
+        path = os.path.join(self.RUNS_DIR, os.path.basename(job_id),
+                            'state.json')
+        if not os.path.exists(path):
+            return None, None
+        return job_id, supervisor.RunState(path)
+
+    def run_status(self):
+        """Report the progress of a detached run"""
+        job_id, state = self.job_state(action_arg('job-id'))
+        job_id = job_id or action_arg('job-id')
+        shard = self.shard_state(job_id) if job_id else None
+        if not state and not shard:
+            hookenv.action_fail("No such tempest run")
+            return
+        if state:
+            action_info = supervisor.describe(state.load())
+        else:
+            # A sharded run the leader has no shard of
+            action_info = {'status': 'finished' if 'result' in shard.load()
+                           else 'running'}
+        action_info['job-id'] = job_id
+        index = logs.LogIndex(self.TEMPEST_LOGDIR)
+        for key, suffix in (('tempest-logfile', '.log'),
+                            ('subunit-file', '.subunit')):
+            path = action_info.get(key)
+            if path and not os.path.exists(path):
+                # The run's files have been rotated since it finished
+                action_info[key] = index.lookup(job_id, suffix) or 'expired'
+        if shard and shard.load().get('role') == 'leader':
+            current = shard.load()
+            if 'result' in current:
+                action_info.update(current['result'])
+                action_info['shards'] = 'merged'
+            else:
+                action_info['shards'] = '{}/{} units done'.format(
+                    sum(1 for records in current['units'].values()
+                        if records is not None),
+                    len(current['units']))
+        hookenv.action_set(action_info)
+
+    def cancel_run(self):
+        """Stop a detached run
+
+        The counts of the tests it completed are still reported but, as
+        stestr does not store an unfinished run, nothing is recorded.
+        """
+        job_id, state = self.job_state(action_arg('job-id'))
+        if not state:
+            hookenv.action_fail("No such tempest run")
+            return
+        current = state.load()
+        if current.get('status') != 'running':
+            hookenv.action_fail("Tempest run {} is {}".format(
+                job_id, current.get('status')))
+            return
+        try:
+            os.kill(current['pid'], signal.SIGTERM)
+        except ProcessLookupError:
+            hookenv.action_fail("Tempest run {} has died".format(job_id))
+            return
+        hookenv.action_set({'job-id': job_id, 'status': 'cancelling'})
+
+    def peer_relation_id(self):
+        relation_ids = hookenv.relation_ids(self.PEER_RELATION)
+        return relation_ids[0] if relation_ids else None
+
+    def peer_units(self):
+        relation_id = self.peer_relation_id()
+        if not relation_id:
+            return []
+        return sorted(hookenv.related_units(relation_id))
+
+    def shard_state(self, shard_id):
+        path = os.path.join(self.SHARDS_DIR,
+                            '{}.json'.format(os.path.basename(shard_id)))
+        if not os.path.exists(path):
+            return None
+        return supervisor.RunState(path)
+
+    def new_shard_state(self, shard_id, **values):
+        if not os.path.isdir(self.SHARDS_DIR):
+            os.makedirs(self.SHARDS_DIR)
+        path = os.path.join(self.SHARDS_DIR, '{}.json'.format(shard_id))
+        state = supervisor.RunState(path)
+        state.update(**values)
+        return state
+
+    def job_records(self, job_id):
+        """Decode the subunit results of a finished detached run
+
+        @return results.TestRecordStore
+        """
+        store = results.TestRecordStore()
+        job_dir = os.path.join(self.RUNS_DIR, job_id)
+        with open(os.path.join(job_dir, 'spec.json'), 'r') as f:
+            subunit_file = json.load(f)['subunit_file']
+        try:
+            with logs.open_log(subunit_file, 'rb') as f:
+                store.feed(f)
+        except FileNotFoundError:
+            pass
+        return store
+
+    def start_sharded_run(self, tox_target, action_args,
+                          interfaces_list=None):
+        """Split a run across this unit and its peers by test duration
+
+        The leader partitions the selected tests, or the tests of the
+        target, between the units by their recorded durations, publishes
+        the shards on the peer relation and starts its own shard. Peers
+        start theirs when they see the request and publish their results
+        back for the leader to merge, see sync_shards.
+
+        @return dict of action results
+        @raises ValueError if the run can not be sharded
+        """
+        if not hookenv.is_leader():
+            raise ValueError("Sharded runs can only be started on the "
+                             "leader")
+        peers = self.peer_units()
+        if not peers:
+            hookenv.log("No peers to shard the run across, running it on "
+                        "this unit", level=hookenv.WARNING)
+            return self.start_run(tox_target, action_args, interfaces_list)
+        checkout = self.prepare_checkout(action_args['branch'])
+        git_dir, logfile, run_dir, venv_dir = checkout
+        test_ids = self.select_tests(
+            dict(action_args, schedule='duration'), git_dir, run_dir,
+            tox_target, venv_dir=venv_dir)
+        if not test_ids:
+            raise ValueError("No tests to shard, sharded runs need the "
+                             "tempest virtualenv and a test selection or a "
+                             "target the charm can list the tests of")
+        # Units left without a test, if there are fewer tests than units,
+        # are not sent a shard. The leader comes first so it always runs
+        # one.
+        local_unit = hookenv.local_unit()
+        units = ([local_unit] + sorted(peers))[:len(test_ids)]
+        shards = dict(zip(units, scheduling.partition(
+            test_ids, self.recorded_durations(), len(units))))
+        shard_id = os.path.splitext(os.path.basename(logfile))[0]
+        self.new_shard_state(
+            shard_id, role='leader', branch=action_args['branch'],
+            target=tox_target, job_id=shard_id, started=time.time(),
+            units={unit: None for unit in shards})
+        hookenv.relation_set(
+            relation_id=self.peer_relation_id(),
+            relation_settings={'shard-request': json.dumps({
+                'id': shard_id,
+                'branch': action_args['branch'],
+                'target': tox_target,
+                'shards': shards})})
+        if shards.get(local_unit):
+            run_info = self.start_run(
+                tox_target, action_args, interfaces_list, checkout=checkout,
+                test_ids=shards[local_unit], shard_of=shard_id)
+        else:
+            run_info = {'job-id': shard_id}
+        run_info['shard-units'] = len(shards)
+        return run_info
+
+    def sync_shards(self, interfaces_list=None):
+        """Move sharded runs along from the peer relation and update-status
+
+        Peers start the shards the leader assigned them and publish the
+        results or failures of finished shards, the leader merges the
+        results once every unit has published or shard-timeout has passed.
+        """
+        if not self.peer_relation_id():
+            return
+        if hookenv.is_leader():
+            self.merge_shard_results()
+        else:
+            self.start_peer_shard(interfaces_list)
+            self.publish_shard_results()
+
+    def shard_request(self):
+        relation_id = self.peer_relation_id()
+        for unit in self.peer_units():
+            request = hookenv.relation_get('shard-request', unit,
+                                           relation_id)
+            if request:
+                return json.loads(request)
+        return None
+
+    def start_peer_shard(self, interfaces_list=None):
+        """Start this unit's shard of the leader's latest sharded run
+
+        Only the config is rendered in the hook, the checkout and its
+        virtualenv are prepared by the shard's detached supervisor. A shard
+        which can not be started is published to the leader as failed.
+        """
+        request = self.shard_request()
+        if not request or self.shard_state(request['id']):
+            return
+        test_ids = request['shards'].get(hookenv.local_unit())
+        if not test_ids or not interfaces_list:
+            return
+        branch = request['branch']
+        try:
+            render_configs(interfaces_list)
+            git_dir, logfile, run_dir = self.get_tempest_files(branch)
+            self.setup_directories()
+            venv_dir = self.venv_dir(branch)
+            run_info = self.start_run(
+                request['target'], {'branch': branch}, interfaces_list,
+                checkout=(git_dir, logfile, run_dir, venv_dir),
+                test_ids=test_ids, shard_of=request['id'],
+                prepare=self.prepare_spec(branch, run_dir, venv_dir))
+        except Exception as e:
+            hookenv.log("Unable to start shard of {}: {}".format(
+                request['id'], e), level=hookenv.WARNING)
+            self.new_shard_state(request['id'], role='peer', job_id=None,
+                                 error=str(e), published=False)
+            return
+        self.new_shard_state(request['id'], role='peer',
+                             job_id=run_info['job-id'], published=False)
+
+    def shard_error(self, job_id):
+        """Check the detached run of a shard for a failure
+
+        @return (finished, error) where error is None if the shard's results
+                can be used
+        """
+        if not job_id:
+            return True, "Shard was not started"
+        _, job = self.job_state(job_id)
+        if not job:
+            return True, "Shard run {} no longer exists".format(job_id)
+        info = supervisor.describe(job.load())
+        if info.get('status') in ('died', 'cancelled'):
+            return True, "Shard run {} {}".format(job_id, info['status'])
+        if info.get('status') == 'failed':
+            return True, info.get('error') or "Shard run {} failed".format(
+                job_id)
+        return info.get('status') in supervisor.FINAL_STATES, None
+
+    def publish_shard_results(self):
+        """Publish the results of finished or failed shards to the leader"""
+        if not os.path.isdir(self.SHARDS_DIR):
+            return
+        for name in sorted(os.listdir(self.SHARDS_DIR)):
+            shard_id = os.path.splitext(name)[0]
+            shard = self.shard_state(shard_id)
+            current = shard.load()
+            if current.get('role') != 'peer' or current.get('published'):
+                continue
+            error = current.get('error')
+            if not error:
+                finished, error = self.shard_error(current['job_id'])
+                if not finished:
+                    continue
+            result = {'id': shard_id, 'records': {}}
+            if error:
+                result['error'] = error
+            else:
+                result['records'] = self.job_records(
+                    current['job_id']).dump()
+            hookenv.relation_set(
+                relation_id=self.peer_relation_id(),
+                relation_settings={'shard-result': json.dumps(result)})
+            shard.update(published=True)
+
+    def merge_shard_results(self, now=None):
+        """Gather the shard results of sharded runs and merge them
+
+        The merged results are recorded in the leader's results history
+        as a single run. Failed shards count as done without results and
+        once shard-timeout has passed the shards still missing are given
+        up on, both are listed with the merged results.
+        """
+        if not os.path.isdir(self.SHARDS_DIR):
+            return
+        relation_id = self.peer_relation_id()
+        local_unit = hookenv.local_unit()
+        shard_timeout = hookenv.config().get('shard-timeout') or 0
+        now = now or time.time()
+        for name in sorted(os.listdir(self.SHARDS_DIR)):
+            shard_id = os.path.splitext(name)[0]
+            shard = self.shard_state(shard_id)
+            current = shard.load()
+            if current.get('role') != 'leader' or 'result' in current:
+                continue
+            units = current['units']
+            errors = current.get('errors') or {}
+            for unit in units:
+                if units[unit] is not None:
+                    continue
+                if unit == local_unit:
+                    finished, error = self.shard_error(current['job_id'])
+                    if error:
+                        units[unit], errors[unit] = {}, error
+                    elif finished:
+                        units[unit] = self.job_records(
+                            current['job_id']).dump()
+                    continue
+                published = hookenv.relation_get('shard-result', unit,
+                                                 relation_id)
+                if published:
+                    published = json.loads(published)
+                    if published.get('id') == shard_id:
+                        units[unit] = published['records']
+                        if published.get('error'):
+                            errors[unit] = published['error']
+            missing = sorted(unit for unit, records in units.items()
+                             if records is None)
+            expired = (shard_timeout > 0 and
+                       now - current.get('started', now) >= shard_timeout)
+            if missing and not expired:
+                shard.update(units=units, errors=errors)
+                continue
+            store = results.TestRecordStore()
+            for records in units.values():
+                store.load(records or {})
+            result = {}
+            if store.records:
+                result.update(results.record_results(
+                    store, self.RESULTS_DB, branch=current.get('branch'),
+                    target=current.get('target')))
+                metrics.record_run(
+                    self.METRICS_STATE, store, current.get('target'),
+                    textfile_dir=self.metrics_spec()['textfile_dir'])
+            if errors:
+                result['failed-shards'] = '\n'.join(
+                    '{}: {}'.format(unit, errors[unit])
+                    for unit in sorted(errors))
+            if missing:
+                hookenv.log("Merging {} without the shards of {} after "
+                            "{}s".format(shard_id, ', '.join(missing),
+                                         shard_timeout),
+                            level=hookenv.WARNING)
+                result['missing-shards'] = ', '.join(missing)
+            shard.update(units=units, errors=errors, result=result)
+
+    def invalidate_discovery(self):
+        """Drop the discovery cache when the identity-admin relation changes
+
+        The cache is keyed on the credentials so a new keystone would not
+        use it, but it can hold the ec2 credentials of the old one and
+        lookups of a cloud which has been redeployed behind the same
+        keystone, so the next run discovers the cloud afresh.
+        """
+        discovery.DiscoveryCache(self.DISCOVERY_CACHE, None, 0).clear()
+
+    def query_history(self):
+        """Report duration trends from the results history"""
+        action_args = hookenv.action_get()
+        if not os.path.exists(self.RESULTS_DB):
+            hookenv.action_fail("No tempest results have been recorded")
+            return
+        runs = int(action_args.get('runs', 30))
+        history = results.ResultsHistory(self.RESULTS_DB)
+        try:
+            action_info = {}
+            test_id = action_args.get('test')
+            if test_id:
+                pct = int(action_args.get('percentile', 95))
+                duration = history.duration_percentile(
+                    test_id, pct=pct, runs=runs)
+                action_info['percentile'] = (
+                    'p{} {:.3f}s'.format(pct, duration)
+                    if duration is not None else 'no results')
+            slower = history.slower_tests(
+                threshold=float(action_args.get('threshold', 20)) / 100,
+                runs=runs)
+            action_info['slower-tests'] = '\n'.join(
+                '{:.3f}s -> {:.3f}s {}'.format(baseline, latest, test)
+                for test, baseline, latest in slower)
+        finally:
+            history.close()
         hookenv.action_set(action_info)
 
 
@@ -504,7 +1864,8 @@ class TempestCharmRocky(TempestCharm):
         'python3-keystoneclient', 'python3-neutronclient',
         'python3-novaclient', 'python3-swiftclient',
         'python3-ceilometerclient', 'openvswitch-test', 'openvswitch-common',
-        'libffi-dev', 'libssl-dev', 'python3-dev', 'python3-cffi'
+        'libffi-dev', 'libssl-dev', 'python3-dev', 'python3-cffi',
+        'python3-venv'
     ]
 
     purge_packages = [
@@ -0,0 +1,134 @@
+import contextlib
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+# Match path segments which are resource ids: uuids, hex ids or numbers
+ID_RE = re.compile(r'^(?:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                   r'[0-9a-f]{12}|[0-9a-f]{32}|\d+)$', re.I)
+
+
+def endpoint(method, url):
+    """Return the endpoint a request was made to, without ids or query
+
+    Ids in the path are replaced with {id} so requests for different
+    resources of the same kind are counted together.
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = '/'.join('{id}' if ID_RE.match(segment) else segment
+                    for segment in parts.path.split('/'))
+    return '{} {}{}'.format(method, parts.netloc, path)
+
+
+class PhaseTimer(object):
+
+    """Wall clock time spent in each phase of a hook or action
+
+    Phases are reported in the order they were first entered, a phase
+    entered more than once accumulates its time.
+    """
+
+    def __init__(self, phases=None):
+        """
+        :params phases: {name: seconds, ...} of phases already timed
+        """
+        self.phases = dict(phases or {})
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = (self.phases.get(name, 0) +
+                                 time.monotonic() - start)
+
+    def summary(self):
+        return dict(self.phases)
+
+    def report(self):
+        return '\n'.join('{} {:.3f}s'.format(name, seconds)
+                         for name, seconds in self.phases.items())
+
+
+class HTTPStats(object):
+
+    """Requests, bytes and latency per endpoint of the HTTP calls made
+
+    hook() is installed as a requests response hook on the session the
+    OpenStack clients share, so every call the clients make, including
+    authentication, is counted. Discovery makes calls from several threads
+    at once so updates are locked.
+    """
+
+    def __init__(self, endpoints=None):
+        """
+        :params endpoints: {endpoint: stats, ...} as returned by summary()
+        """
+        self.endpoints = {key: dict(stats)
+                          for key, stats in (endpoints or {}).items()}
+        self.lock = threading.Lock()
+
+    def record(self, method, url, status, size, seconds):
+        key = endpoint(method, url)
+        with self.lock:
+            stats = self.endpoints.setdefault(key, {
+                'requests': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0})
+            stats['requests'] += 1
+            stats['bytes'] += size
+            stats['seconds'] += seconds
+            if status >= 400:
+                stats['errors'] += 1
+
+    def hook(self, response, *args, **kwargs):
+        """requests response hook recording the response"""
+        size = response.headers.get('Content-Length')
+        if size is None and not kwargs.get('stream'):
+            size = len(response.content)
+        self.record(response.request.method, response.request.url,
+                    response.status_code, int(size or 0),
+                    response.elapsed.total_seconds())
+        return response
+
+    def summary(self):
+        with self.lock:
+            return {key: dict(stats) for key, stats in self.endpoints.items()}
+
+    def report(self):
+        """Return one line per endpoint, the slowest in total first"""
+        lines = []
+        for key, stats in sorted(self.summary().items(),
+                                 key=lambda item: -item[1]['seconds']):
+            line = '{} requests {:.3f}s {}B {}'.format(
+                stats['requests'], stats['seconds'], stats['bytes'], key)
+            if stats['errors']:
+                line += ' ({} failed)'.format(stats['errors'])
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+def report(phases, http, path=None):
+    """Return the phase times and HTTP statistics as action results
+
+    :params phases: PhaseTimer of the run
+    :params http: HTTPStats of the calls made to OpenStack
+    :params path: string File to also write the report to as JSON
+    @returns dict of action results
+    """
+    info = {'phase-times': phases.report()}
+    if http.endpoints:
+        info['http-requests'] = http.report()
+    if path:
+        with open(path, 'w') as timing_file:
+            json.dump({'phases': phases.summary(), 'http': http.summary()},
+                      timing_file, indent=2, sort_keys=True)
+        info['timing-file'] = path
+    return info
+
+
+# Phases timed and HTTP calls made by the running hook or action, every
+# hook and action runs in a process of its own
+PHASES = PhaseTimer()
+HTTP = HTTPStats()
@@ -0,0 +1,160 @@
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+
+# Files in a tempest checkout which determine its virtualenv, tox.ini names
+# the upper-constraints the requirements are installed with
+REQUIREMENTS_FILES = ['requirements.txt', 'setup.cfg', 'tox.ini']
+# Upper-constraints file of a tempest-bundle
+BUNDLE_CONSTRAINTS = 'upper-constraints.txt'
+# Match the default upper-constraints in a checkout's tox.ini like:
+# -c{env:TOX_CONSTRAINTS_FILE:https://releases.openstack.org/...}
+CONSTRAINTS_RE = re.compile(
+    r'-c\s*\{env:(?:TOX|UPPER)_CONSTRAINTS_FILE:([^}]+)\}')
+# File in a virtualenv holding the requirements hash it was built for
+VENV_STAMP = '.requirements-hash'
+
+
+def requirements_hash(run_dir):
+    """Digest of the files in a checkout which determine its virtualenv"""
+    digest = hashlib.sha256()
+    for name in REQUIREMENTS_FILES:
+        path = os.path.join(run_dir, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def constraints_file(run_dir, bundle=None):
+    """Return the upper-constraints tox installs a checkout's deps with
+
+    The default named in the checkout's tox.ini is used, with a
+    tempest-bundle the bundle's own upper-constraints.txt.
+
+    :params bundle: string Path of the unpacked tempest-bundle
+    @return path or URL of the constraints or None if there are none
+    """
+    if bundle:
+        path = os.path.join(bundle, BUNDLE_CONSTRAINTS)
+        return path if os.path.exists(path) else None
+    try:
+        with open(os.path.join(run_dir, 'tox.ini'), 'r') as f:
+            match = CONSTRAINTS_RE.search(f.read())
+    except IOError:
+        return None
+    return match.group(1).strip() if match else None
+
+
+def venv_current(venv_dir, run_dir):
+    """Check a virtualenv was built for the checkout's requirements
+
+    @return Boolean True if the virtualenv can be reused
+    """
+    stamp = os.path.join(venv_dir, VENV_STAMP)
+    if not os.path.exists(stamp):
+        return False
+    with open(stamp, 'r') as f:
+        return f.read().strip() == requirements_hash(run_dir)
+
+
+class Workspace(object):
+
+    """The tempest mirror, its worktrees and their virtualenvs
+
+    Nothing here uses the juju hook tools, so a detached supervisor can
+    prepare a checkout from the inputs the charm resolved for it.
+    """
+
+    def __init__(self, mirror, env=None):
+        """
+        :params mirror: string Path of the bare tempest mirror
+        :params env: dict Environment for git and pip, with any proxies
+        """
+        self.mirror = mirror
+        self.env = env
+
+    def git(self, *args, cwd=None):
+        subprocess.check_call(['git'] + list(args), cwd=cwd, env=self.env)
+
+    def update_mirror(self, git_url, fetch=True):
+        """Create the bare mirror or, if fetch is set, fetch into it"""
+        if not os.path.exists(self.mirror):
+            self.git('clone', '--bare', git_url, self.mirror)
+            self.git('config', 'remote.origin.fetch',
+                     '+refs/heads/*:refs/heads/*', cwd=self.mirror)
+        elif fetch:
+            self.git('remote', 'set-url', 'origin', git_url, cwd=self.mirror)
+            self.git('fetch', '--prune', '--tags', 'origin', cwd=self.mirror)
+
+    def worktree(self, run_dir, ref, conf=None):
+        """Check out ref in run_dir and symlink in the rendered conf
+
+        Each branch or tag is a detached worktree of the mirror so switching
+        refs only needs objects which have not been fetched before.
+        """
+        if os.path.isdir(run_dir + '/.git'):
+            # A standalone clone from before the mirror was introduced
+            shutil.rmtree(run_dir)
+        if not os.path.exists(run_dir + '/.git'):
+            self.git('worktree', 'prune', cwd=self.mirror)
+            self.git('worktree', 'add', '--force', '--detach', run_dir,
+                     str(ref), cwd=self.mirror)
+        else:
+            self.git('checkout', '--force', '--detach', str(ref),
+                     cwd=run_dir)
+        conf_symlink = run_dir + '/etc/tempest.conf'
+        if conf and not os.path.exists(conf_symlink):
+            os.symlink(conf, conf_symlink)
+
+    def build_venv(self, venv_dir, run_dir, bundle=None):
+        """Build a virtualenv for the checkout, replacing any existing one
+
+        With a tempest-bundle only its wheelhouse is used. A virtualenv
+        which fails to build is removed.
+
+        @raises subprocess.CalledProcessError if the build fails
+        """
+        req_hash = requirements_hash(run_dir)
+        if os.path.exists(venv_dir):
+            shutil.rmtree(venv_dir)
+        pip = [os.path.join(venv_dir, 'bin', 'pip'), 'install']
+        if bundle:
+            pip.extend(['--no-index', '--find-links',
+                        os.path.join(bundle, 'wheelhouse')])
+        try:
+            subprocess.check_call(['python3', '-m', 'venv', venv_dir])
+            if not bundle:
+                subprocess.check_call(pip + ['--upgrade', 'pip'],
+                                      env=self.env)
+            # Install the requirements first so that tempest's own build
+            # requirements are already satisfied from them. Tempest itself
+            # is left out of the constraints as they may pin another
+            # release of it.
+            constraints = constraints_file(run_dir, bundle=bundle)
+            subprocess.check_call(
+                pip + (['-c', constraints] if constraints else []) +
+                ['-r', os.path.join(run_dir, 'requirements.txt')],
+                env=self.env)
+            subprocess.check_call(pip + ['-e', run_dir], env=self.env)
+        except subprocess.CalledProcessError:
+            shutil.rmtree(venv_dir, ignore_errors=True)
+            raise
+        with open(os.path.join(venv_dir, VENV_STAMP), 'w') as f:
+            f.write(req_hash)
+
+
+def prepare(spec):
+    """Prepare the checkout and virtualenv a detached run needs
+
+    :params spec: dict with the mirror, git_url, fetch, run_dir, ref, conf,
+                  venv_dir, bundle and env resolved by the charm
+    """
+    workspace = Workspace(spec['mirror'], env=spec.get('env'))
+    workspace.update_mirror(spec['git_url'], fetch=spec.get('fetch', True))
+    workspace.worktree(spec['run_dir'], spec['ref'], conf=spec.get('conf'))
+    if not venv_current(spec['venv_dir'], spec['run_dir']):
+        workspace.build_venv(spec['venv_dir'], spec['run_dir'],
+                             bundle=spec.get('bundle'))
@@ -1,4 +1,5 @@
 import charms.reactive as reactive
+import charms.reactive.relations as relations
 import charm.openstack.tempest as tempest
 
 # config is rendered when the run tempest action is called
@@ -13,3 +14,20 @@ def install_packages():
 @reactive.when('charm.installed')
 def assess_status():
     tempest.assess_status()
+
+
+@reactive.hook('cluster-relation-changed', 'update-status')
+def sync_shards():
+    identity_int = relations.endpoint_from_flag('identity-admin.available')
+    tempest.sync_shards([identity_int] if identity_int else None)
+
+
+@reactive.hook('identity-admin-relation-changed',
+               'identity-admin-relation-departed')
+def invalidate_discovery():
+    tempest.invalidate_discovery()
+
+
+@reactive.hook('update-status')
+def rotate_logs():
+    tempest.rotate_logs()
@@ -30,9 +30,11 @@ sys.modules['glanceclient'] = glanceclient
 
 keystoneauth1 = mock.MagicMock()
 sys.modules['keystoneauth1'] = keystoneauth1
+sys.modules['keystoneauth1.exceptions'] = keystoneauth1.exceptions
 sys.modules['keystoneauth1.identity'] = keystoneauth1.identity
 sys.modules['keystoneauth1.identity.v1'] = keystoneauth1.identity.v1
 sys.modules['keystoneauth1.identity.v2'] = keystoneauth1.identity.v2
+sys.modules['keystoneauth1.identity.v3'] = keystoneauth1.identity.v3
 sys.modules['keystoneauth1.session'] = keystoneauth1.session
 
 keystoneclient = mock.MagicMock()
@@ -55,3 +57,10 @@ sys.modules['neutronclient.v2_0.client'] = neutronclient.v2_0.client
 novaclient = mock.MagicMock()
 sys.modules['novaclient'] = novaclient
 sys.modules['novaclient.client'] = novaclient.client
+
+# Decode real subunit streams when python-subunit is installed
+try:
+    import subunit  # noqa
+except ImportError:
+    subunit = mock.MagicMock()
+    sys.modules['subunit'] = subunit
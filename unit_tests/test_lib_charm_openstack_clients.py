@@ -0,0 +1,115 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+import glanceclient
+import keystoneauth1.identity.v2 as keystoneauth1_v2
+import keystoneauth1.identity.v3 as keystoneauth1_v3
+import keystoneauth1.session as keystoneauth1_session
+import requests
+import requests.adapters
+
+import charms_openstack.test_utils as test_utils
+import charm.openstack.clients as clients
+
+
+class TestClientFactory(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(keystoneauth1_session, 'Session')
+        self.patch_object(requests, 'Session', name='http_session')
+        self.patch_object(requests.adapters, 'HTTPAdapter')
+
+    def test_session_v2(self):
+        self.patch_object(keystoneauth1_v2, 'Password')
+        factory = clients.ClientFactory('2', {'username': 'user1'},
+                                        timeout=30)
+        self.assertEqual(factory.session, self.Session.return_value)
+        self.assertEqual(factory.session, self.Session.return_value)
+        self.Password.assert_called_once_with(username='user1')
+        self.HTTPAdapter.assert_called_once_with(
+            pool_connections=clients.POOL_SIZE,
+            pool_maxsize=clients.POOL_SIZE)
+        self.Session.assert_called_once_with(
+            auth=self.Password.return_value,
+            session=self.http_session.return_value,
+            timeout=30)
+        self.http_session.return_value.hooks['response'].append.\
+            assert_called_once_with(clients.timing.HTTP.hook)
+
+    def test_session_v3(self):
+        self.patch_object(keystoneauth1_v3, 'Password')
+        factory = clients.ClientFactory('3', {'username': 'user1'})
+        factory.session
+        self.Password.assert_called_once_with(username='user1')
+
+    def test_client_cached(self):
+        self.patch_object(glanceclient, 'Client')
+        factory = clients.ClientFactory('3', {}, region_name='reg1')
+        self.assertEqual(factory.client('image'), self.Client.return_value)
+        self.assertEqual(factory.client('image'), self.Client.return_value)
+        self.Client.assert_called_once_with(
+            '2',
+            session=self.Session.return_value,
+            region_name='reg1')
+
+
+class TestServiceCatalogue(test_utils.PatchHelper):
+
+    def test_v2_catalogue(self):
+        catalogue = clients.ServiceCatalogue([{
+            'name': 'nova',
+            'type': 'compute',
+            'endpoints': [{
+                'region': 'reg1',
+                'publicURL': 'http://nova1:8774/v2.1',
+                'adminURL': 'http://nova1-admin:8774/v2.1'}, {
+                'region': 'reg2',
+                'publicURL': 'http://nova2:8774/v2.1'}]}])
+        self.assertTrue(catalogue.has_service('nova'))
+        self.assertFalse(catalogue.has_service('glance'))
+        self.assertEqual(
+            catalogue.url_for('compute', region='reg2'),
+            'http://nova2:8774/v2.1')
+        self.assertEqual(
+            catalogue.url_for('compute', interface='admin', region='reg2'),
+            'http://nova1-admin:8774/v2.1')
+        self.assertIsNone(catalogue.url_for('compute', interface='internal'))
+
+    def test_v3_catalogue(self):
+        catalogue = clients.ServiceCatalogue([{
+            'name': 'glance',
+            'type': 'image',
+            'endpoints': [{
+                'interface': 'public',
+                'region_id': 'reg1',
+                'url': 'http://glance:9292'}]}, {
+            'name': 'neutron',
+            'type': 'network',
+            'endpoints': []}])
+        self.assertEqual(catalogue.service_names(), ['glance', 'neutron'])
+        self.assertEqual(
+            catalogue.url_for('image', region='reg1'),
+            'http://glance:9292')
+        self.assertIsNone(catalogue.url_for('network'))
+
+    def test_from_session(self):
+        session = mock.MagicMock()
+        session.auth.get_access.return_value.service_catalog.catalog = [
+            {'name': 'nova', 'type': 'compute'}]
+        catalogue = clients.ServiceCatalogue.from_session(session)
+        session.auth.get_access.assert_called_once_with(session)
+        self.assertEqual(catalogue.service_names(), ['nova'])
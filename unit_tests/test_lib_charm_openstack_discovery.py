@@ -0,0 +1,170 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import charms_openstack.test_utils as test_utils
+import charm.openstack.discovery as discovery
+
+
+class TestResolveNames(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(discovery.hookenv, 'log')
+
+    def test_paginate(self):
+        records = [{'id': str(i)} for i in range(5)]
+
+        def list_page(marker=None, limit=None):
+            start = 0 if marker is None else int(marker) + 1
+            return records[start:start + limit]
+
+        list_page = mock.MagicMock(side_effect=list_page)
+        self.assertEqual(
+            list(discovery.paginate(list_page, page_size=2)), records)
+        list_page.assert_has_calls([
+            mock.call(marker=None, limit=2),
+            mock.call(marker='1', limit=2),
+            mock.call(marker='3', limit=2)])
+
+    def test_resolve_names_lookup(self):
+        lookup = mock.MagicMock(
+            side_effect=lambda names: [{'name': names[0], 'id': 'x'}])
+        scan = mock.MagicMock()
+        self.assertEqual(
+            discovery.resolve_names(['img1', 'img1', None], lookup, scan),
+            {'img1': {'name': 'img1', 'id': 'x'}})
+        lookup.assert_called_once_with(['img1'])
+        self.assertFalse(scan.called)
+
+    def test_resolve_names_batch(self):
+        lookup = mock.MagicMock(return_value=[{'name': 'n1'}])
+        self.assertEqual(
+            discovery.resolve_names(['n2', 'n1'], lookup, batch=True,
+                                    kind='network'),
+            {'n1': {'name': 'n1'}})
+        lookup.assert_called_once_with(['n1', 'n2'])
+        self.log.assert_called_once_with(
+            'Unable to find network named: n2',
+            level=discovery.hookenv.WARNING)
+
+    def test_resolve_names_scan_stops_early(self):
+        consumed = []
+
+        def scan():
+            for name in ['a', 'b', 'c', 'd']:
+                consumed.append(name)
+                yield {'name': name}
+
+        lookup = mock.MagicMock(side_effect=Exception('no filters'))
+        self.assertEqual(
+            discovery.resolve_names(['b', 'a'], lookup, scan),
+            {'a': {'name': 'a'}, 'b': {'name': 'b'}})
+        self.assertEqual(consumed, ['a', 'b'])
+
+
+class TestRunConcurrently(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(discovery.hookenv, 'log')
+
+    def test_run_concurrently(self):
+        def fail():
+            raise Exception('boom')
+
+        self.assertEqual(
+            discovery.run_concurrently({
+                'a': lambda: 1,
+                'b': fail,
+                'c': lambda: {'x': 'y'}}),
+            {'a': 1, 'c': {'x': 'y'}})
+        self.log.assert_called_once_with(
+            'Discovery of b failed: boom',
+            level=discovery.hookenv.WARNING)
+
+    def test_run_concurrently_timeout(self):
+        event = threading.Event()
+        results = discovery.run_concurrently(
+            {'slow': event.wait, 'fast': lambda: 'ok'},
+            timeouts={'slow': 0.01})
+        event.set()
+        self.assertEqual(results, {'fast': 'ok'})
+        self.log.assert_called_once_with(
+            'Discovery of slow timed out',
+            level=discovery.hookenv.WARNING)
+
+    def test_parse_timeouts(self):
+        self.assertEqual(discovery.parse_timeouts(''), {})
+        self.assertEqual(discovery.parse_timeouts(None), {})
+        self.assertEqual(
+            discovery.parse_timeouts('image_info=120, network_info=90 x=y'),
+            {'image_info': 120, 'network_info': 90})
+        self.log.assert_called_once_with(
+            'Ignoring invalid discovery timeout x=y',
+            level=discovery.hookenv.WARNING)
+
+
+class TestDiscoveryCache(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache.json')
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            discovery.fingerprint({'a': 1, 'b': 2}),
+            discovery.fingerprint({'b': 2, 'a': 1}))
+        self.assertNotEqual(
+            discovery.fingerprint({'a': 1}),
+            discovery.fingerprint({'a': 2}))
+
+    def test_save_load(self):
+        cache = discovery.DiscoveryCache(self.path, 'fp1', 60)
+        self.assertIsNone(cache.load())
+        cache.save({'image_info': {'image_id': 'img1'}})
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        self.assertEqual(cache.load(), {'image_info': {'image_id': 'img1'}})
+        self.assertIsNone(
+            discovery.DiscoveryCache(self.path, 'fp2', 60).load())
+        cache.clear()
+        self.assertIsNone(cache.load())
+
+    def test_save_fails(self):
+        cache = discovery.DiscoveryCache(self.path, 'fp1', 60)
+        self.assertRaises(TypeError, cache.save, {'ec2_creds': object()})
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_load_expired(self):
+        cache = discovery.DiscoveryCache(self.path, 'fp1', 60)
+        cache.save({})
+        self.patch_object(discovery.time, 'time',
+                          return_value=time.time() + 120)
+        self.assertIsNone(cache.load())
+
+    def test_disabled(self):
+        cache = discovery.DiscoveryCache(self.path, 'fp1', 0)
+        cache.save({})
+        self.assertFalse(os.path.exists(self.path))
@@ -0,0 +1,135 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl
+import gzip
+import os
+import shutil
+import tempfile
+
+import charms_openstack.test_utils as test_utils
+import charm.openstack.logs as logs
+
+
+class TestLogs(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, name, data='x', mtime=None):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_run_id(self):
+        self.assertEqual(logs.run_id('run_1.log'), 'run_1')
+        self.assertEqual(logs.run_id('run_1.workers.yaml'), 'run_1')
+        self.assertEqual(logs.run_id('run_1.log.gz'), 'run_1')
+        self.assertIsNone(logs.run_id('index.json'))
+
+    def test_compress_open_log(self):
+        path = self.write('run_1.log', 'line 1\nline 2\n', mtime=1000)
+        self.assertEqual(logs.compress(path), path + '.gz')
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(os.stat(path + '.gz').st_mtime, 1000)
+        with gzip.open(path + '.gz', 'rt') as f:
+            self.assertEqual(f.read(), 'line 1\nline 2\n')
+        with logs.open_log(path) as f:
+            self.assertEqual(f.readlines(), ['line 1\n', 'line 2\n'])
+        with logs.open_log(path, 'rb') as f:
+            self.assertEqual(f.read(), b'line 1\nline 2\n')
+        plain = self.write('run_2.log', 'plain')
+        with logs.open_log(plain) as f:
+            self.assertEqual(f.read(), 'plain')
+        self.assertRaises(FileNotFoundError, logs.open_log,
+                          os.path.join(self.tmpdir, 'run_3.log'))
+
+    def test_scan(self):
+        self.write('run_1.log', 'abc', mtime=1000)
+        self.write('run_1.subunit', 'de', mtime=1010)
+        self.write('run_2.log', 'f', mtime=2000)
+        self.write('index.json', '{}')
+        os.mkdir(os.path.join(self.tmpdir, 'run_3'))
+        self.assertEqual(logs.scan(self.tmpdir), {
+            'run_1': {'files': ['run_1.log', 'run_1.subunit'], 'bytes': 5,
+                      'mtime': 1010},
+            'run_2': {'files': ['run_2.log'], 'bytes': 1, 'mtime': 2000}})
+
+    def test_expired(self):
+        runs = {'run_{}'.format(i): {'bytes': 10, 'mtime': 100.0 * i}
+                for i in range(1, 6)}
+        self.assertEqual(logs.expired(runs), [])
+        self.assertEqual(logs.expired(runs, max_runs=3),
+                         ['run_1', 'run_2'])
+        self.assertEqual(logs.expired(runs, max_age=250, now=500.0),
+                         ['run_1', 'run_2'])
+        self.assertEqual(logs.expired(runs, max_bytes=25),
+                         ['run_1', 'run_2', 'run_3'])
+        self.assertEqual(
+            logs.expired(runs, max_runs=3, keep=['run_1']),
+            ['run_2', 'run_3'])
+
+    def test_rotate(self):
+        runs_dir = os.path.join(self.tmpdir, 'runs')
+        os.makedirs(os.path.join(runs_dir, 'run_1'))
+        self.write('run_1.log', mtime=1000)
+        self.write('run_2.log', mtime=2000)
+        self.write('run_2.subunit', mtime=2000)
+        self.write('run_2.workers.yaml', mtime=2000)
+        self.write('run_2.log.gz.tmp', mtime=2000)
+        self.write('run_3.log', mtime=3000)
+        removed = logs.rotate(self.tmpdir, active=['run_3'], max_runs=2,
+                              runs_dir=runs_dir)
+        self.assertEqual(removed, ['run_1'])
+        self.assertFalse(os.path.exists(os.path.join(runs_dir, 'run_1')))
+        self.assertEqual(
+            sorted(os.listdir(self.tmpdir)),
+            ['index.json', 'run_2.log.gz', 'run_2.subunit.gz',
+             'run_2.workers.yaml', 'run_3.log', 'runs'])
+        index = logs.LogIndex(self.tmpdir)
+        self.assertEqual(sorted(index.load()), ['run_2', 'run_3'])
+        self.assertEqual(index.lookup('run_2'),
+                         os.path.join(self.tmpdir, 'run_2.log.gz'))
+        self.assertEqual(index.lookup('run_2', '.subunit'),
+                         os.path.join(self.tmpdir, 'run_2.subunit.gz'))
+        self.assertEqual(index.lookup('run_3'),
+                         os.path.join(self.tmpdir, 'run_3.log'))
+        self.assertIsNone(index.lookup('run_1'))
+
+    def test_lookup_unindexed(self):
+        index = logs.LogIndex(self.tmpdir)
+        self.assertEqual(index.load(), {})
+        path = self.write('run_1.log')
+        self.assertEqual(index.lookup('run_1'), path)
+
+    def test_main(self):
+        self.write('run_1.log', mtime=1000)
+        self.write('run_2.log', mtime=2000)
+        logs.main([self.tmpdir, '--max-runs', '1', '--active', 'run_2'])
+        self.assertEqual(sorted(logs.LogIndex(self.tmpdir).load()),
+                         ['run_2'])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmpdir, 'run_2.log')))
+
+    def test_main_locked(self):
+        self.patch_object(logs, 'rotate')
+        with open(os.path.join(self.tmpdir, logs.LOCK_NAME), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            logs.main([self.tmpdir])
+        self.assertFalse(self.rotate.called)
@@ -0,0 +1,116 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import charms_openstack.test_utils as test_utils
+import charm.openstack.metrics as metrics
+import charm.openstack.results as results
+
+
+class TestMetrics(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram((1, 2.5))
+        for value in (0.5, 1, 2, 7):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.samples('t', {'target': 'smoke'}), [
+            't_bucket{le="1",target="smoke"} 2',
+            't_bucket{le="2.5",target="smoke"} 3',
+            't_bucket{le="+Inf",target="smoke"} 4',
+            't_sum{target="smoke"} 10.5',
+            't_count{target="smoke"} 4'])
+        # Counts stored with other buckets are dropped
+        self.assertEqual(metrics.Histogram((1,), [1, 2, 3], 4.0).counts,
+                         [0, 0])
+
+    def test_sample(self):
+        self.assertEqual(metrics.sample('m', {}, 2.0), 'm 2')
+        self.assertEqual(metrics.sample('m', {'a': 'x"y\n'}, 0.5),
+                         'm{a="x\\"y\\n"} 0.5')
+
+    def test_record_run(self):
+        run_metrics = metrics.RunMetrics(
+            os.path.join(self.tmpdir, 'metrics.json'))
+        run_metrics.record_run(
+            'smoke', {'passed': 2, 'failed': 1}, [0.2, 0.3, 45],
+            phases={'render': 2.0, 'execute-tox': 120.0}, now=100)
+        run_metrics.record_run('smoke', {'passed': 3, 'failed': 0}, [0.2],
+                               now=200)
+        run_metrics.save()
+        state = metrics.RunMetrics(run_metrics.path).load().state
+        self.assertEqual(state['runs'], {'smoke': 2})
+        self.assertEqual(state['tests'], {'smoke': {'passed': 5, 'failed': 1}})
+        self.assertEqual(state['histograms']['test']['smoke']['counts'],
+                         [0, 2, 1, 0, 0, 0, 0, 0, 1, 0, 0, 0])
+        self.assertEqual(state['histograms']['run']['smoke']['sum'], 120.0)
+        self.assertEqual(state['histograms']['phase']['render']['sum'], 2.0)
+        self.assertEqual(state['last_run']['smoke'], {
+            'timestamp': 200, 'counts': {'passed': 3, 'failed': 0},
+            'phases': {}})
+        text = run_metrics.exposition()
+        self.assertIn('# TYPE tempest_runs_total counter\n'
+                      'tempest_runs_total{target="smoke"} 2\n', text)
+        self.assertIn(
+            'tempest_tests_total{status="passed",target="smoke"} 5\n', text)
+        self.assertIn(
+            'tempest_last_run_tests{status="failed",target="smoke"} 0\n',
+            text)
+        self.assertIn(
+            'tempest_test_duration_seconds_bucket{le="0.5",target="smoke"} '
+            '3\n', text)
+        self.assertIn(
+            'tempest_phase_duration_seconds_count{phase="render"} 1\n', text)
+        # Only the last run's duration and phases are reported as gauges
+        self.assertNotIn('tempest_last_run_duration_seconds', text)
+        self.assertEqual(metrics.RunMetrics('/nonexistent').exposition(), '')
+
+    def test_record_run_textfile(self):
+        store = results.TestRecordStore()
+        store.status(test_id='t1', test_status='success')
+        record = store.records['t1']
+        record.start, record.stop = 10.0, 11.5
+        store.status(test_id='t2', test_status='skip')
+        path = os.path.join(self.tmpdir, 'metrics.json')
+        textfile_dir = os.path.join(self.tmpdir, 'textfile')
+        self.assertIsNone(metrics.record_run(
+            path, store, 'smoke', textfile_dir=textfile_dir))
+        os.mkdir(textfile_dir)
+        textfile = metrics.record_run(
+            path, store, 'smoke', phases={'execute-tox': 30.0},
+            textfile_dir=textfile_dir)
+        self.assertEqual(textfile,
+                         os.path.join(textfile_dir, 'tempest.prom'))
+        self.assertEqual(os.listdir(textfile_dir), ['tempest.prom'])
+        with open(textfile) as f:
+            text = f.read()
+        self.assertIn('tempest_runs_total{target="smoke"} 2\n', text)
+        self.assertIn(
+            'tempest_tests_total{status="skipped",target="smoke"} 2\n', text)
+        self.assertIn(
+            'tempest_test_duration_seconds_count{target="smoke"} 2\n', text)
+        self.assertIn(
+            'tempest_last_run_duration_seconds{target="smoke"} 30\n', text)
+        self.assertIn(
+            'tempest_run_duration_seconds_bucket{le="60",target="smoke"} 1\n',
+            text)
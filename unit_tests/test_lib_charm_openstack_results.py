@@ -0,0 +1,256 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import io
+import json
+import mock
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import subunit
+
+import charms_openstack.test_utils as test_utils
+import charm.openstack.results as results
+import unit_tests.tempest_output
+
+
+class TestTempestOutputParser(test_utils.PatchHelper):
+
+    def test_totals(self):
+        parser = results.TempestOutputParser()
+        for line in unit_tests.tempest_output.TEMPEST_OUT.splitlines(True):
+            parser.feed(line)
+        self.assertEqual(
+            parser.summary,
+            {'expected-fail': '0',
+             'failed': '0',
+             'passed': '21',
+             'skipped': '41',
+             'unexpected-success': '0'})
+
+    def test_running_counts(self):
+        parser = results.TempestOutputParser()
+        for line in [
+                '{0} tempest.api.compute.test_a.TestA.test_1 '
+                '[0.123s] ... ok\n',
+                '{1} tempest.api.compute.test_a.TestA.test_2'
+                '[id-1234,smoke] [1.5s] ... FAILED\n',
+                '{0} setUpClass (tempest.api.volume.test_b.TestB) '
+                '... SKIPPED: Cinder not available\n',
+                'Traceback (most recent call last):\n']:
+            parser.feed(line)
+        self.assertEqual(parser.counts,
+                         {'passed': 1, 'failed': 1, 'skipped': 1})
+        self.assertEqual(parser.summary,
+                         {'passed': '1', 'failed': '1', 'skipped': '1'})
+
+
+class TestTestRecordStore(test_utils.PatchHelper):
+
+    def time(self, seconds):
+        return datetime.datetime(2020, 1, 1, 0, 0, seconds,
+                                 tzinfo=datetime.timezone.utc)
+
+    def test_status(self):
+        store = results.TestRecordStore()
+        store.status(test_id='t1', test_status='inprogress',
+                     test_tags={'worker-0'}, timestamp=self.time(0))
+        store.status(test_id='t1', file_name='traceback', file_bytes=b'x')
+        store.status(test_id='t1', test_status='success',
+                     test_tags={'worker-0'}, timestamp=self.time(5))
+        store.status(test_id='t2', test_status='inprogress',
+                     test_tags={'worker-1'}, timestamp=self.time(1))
+        store.status(test_id='t2', test_status='fail',
+                     timestamp=self.time(3))
+        store.status(test_id='t3', test_status='skip')
+        record = store.records['t1']
+        self.assertEqual(record.status, 'success')
+        self.assertEqual(record.worker, 'worker-0')
+        self.assertEqual(record.duration, 5)
+        self.assertEqual(store.records['t2'].worker, 'worker-1')
+        self.assertIsNone(store.records['t3'].duration)
+        self.assertEqual(
+            store.counts(),
+            {'passed': 1, 'failed': 1, 'skipped': 1, 'expected-fail': 0,
+             'unexpected-success': 0, 'timed-out': 0})
+        self.assertEqual(
+            [r.test_id for r in store.slowest(5)], ['t1', 't2'])
+        self.assertEqual(
+            [r.test_id for r in store.slowest(1)], ['t1'])
+
+    def test_status_timeout(self):
+        store = results.TestRecordStore()
+        store.status(test_id='t1', test_status='inprogress')
+        store.status(test_id='t1', file_name='traceback',
+                     file_bytes=memoryview(b'fixtures._fixtures.timeout.'
+                                           b'TimeoutException'))
+        store.status(test_id='t1', test_status='fail')
+        store.status(test_id='t2', file_name='traceback',
+                     file_bytes=b'AssertionError')
+        store.status(test_id='t2', test_status='fail')
+        store.status(test_id='t3', file_name='traceback',
+                     file_bytes=b'tempest.lib.exceptions.TimeoutException: '
+                                b'Request timed out')
+        store.status(test_id='t3', test_status='fail')
+        self.assertEqual(store.records['t1'].status, 'timeout')
+        self.assertEqual(store.records['t2'].status, 'fail')
+        self.assertEqual(store.records['t3'].status, 'fail')
+        self.assertEqual(store.counts()['timed-out'], 1)
+        self.assertEqual(store.counts()['failed'], 2)
+
+    def test_feed(self):
+        self.patch_object(subunit, 'ByteStreamToStreamResult')
+        store = results.TestRecordStore()
+        store.feed('stream')
+        self.ByteStreamToStreamResult.assert_called_once_with(
+            'stream', non_subunit_name='stdout')
+        self.ByteStreamToStreamResult.return_value.run.assert_called_once_with(
+            store)
+
+    def test_feed_timeout(self):
+        if isinstance(subunit, mock.MagicMock):
+            self.skipTest("python-subunit is not installed")
+        stream = io.BytesIO()
+        output = subunit.StreamResultToBytes(stream)
+        output.status(test_id='t1', test_status='inprogress')
+        output.status(test_id='t1', file_name='traceback',
+                      file_bytes=b'Traceback (most recent call last):\n'
+                                 b'fixtures._fixtures.timeout.'
+                                 b'TimeoutException\n',
+                      mime_type='text/x-traceback; charset=utf8')
+        output.status(test_id='t1', test_status='fail')
+        output.status(test_id='t2', test_status='success')
+        stream.seek(0)
+        store = results.TestRecordStore()
+        store.feed(stream)
+        self.assertEqual(store.records['t1'].status, 'timeout')
+        self.assertEqual(store.counts()['timed-out'], 1)
+        self.assertEqual(store.counts()['passed'], 1)
+
+    def test_dump_load(self):
+        store = results.TestRecordStore()
+        store.status(test_id='t1', test_status='success')
+        store.records['t1'].start, store.records['t1'].stop = 1.0, 3.0
+        store.records['t1'].worker = 'worker-0'
+        data = json.loads(json.dumps(store.dump()))
+        merged = results.TestRecordStore()
+        merged.load(data)
+        merged.load({'t2': ['fail', None, None, None]})
+        self.assertEqual(merged.records['t1'].duration, 2.0)
+        self.assertEqual(merged.records['t1'].worker, 'worker-0')
+        self.assertEqual(merged.counts()['failed'], 1)
+        self.assertEqual(merged.counts()['passed'], 1)
+
+    def test_tee_stream(self):
+        copy = io.BytesIO()
+        tee = results.TeeStream(io.BytesIO(b'abc\ndef'), copy)
+        self.assertEqual(tee.readline(), b'abc\n')
+        self.assertEqual(tee.read(2), b'de')
+        self.assertEqual(copy.getvalue(), b'abc\nde')
+
+
+class TestResultsHistory(test_utils.PatchHelper):
+
+    def record_run(self, history, durations, rerun_of=None):
+        store = results.TestRecordStore()
+        for test_id, duration in durations.items():
+            record = results.TestRecord(test_id)
+            record.status = 'success' if duration is not None else 'fail'
+            record.start, record.stop = 0.0, duration
+            store.records[test_id] = record
+        return history.record_run(store, branch='master', target='smoke',
+                                  rerun_of=rerun_of)
+
+    def test_percentile(self):
+        self.assertIsNone(results.percentile([], 95))
+        self.assertEqual(results.percentile([3, 1, 2], 50), 2)
+        self.assertEqual(results.percentile(list(range(1, 101)), 95), 95)
+        self.assertEqual(results.percentile([5], 95), 5)
+
+    def test_durations(self):
+        history = results.ResultsHistory(':memory:')
+        self.addCleanup(history.close)
+        self.assertEqual(history.durations('t1'), [])
+        for duration in [1.0, 2.0, None, 4.0]:
+            self.record_run(history, {'t1': duration, 't2': 1.0})
+        self.assertEqual(history.durations('t1'), [1.0, 2.0, 4.0])
+        self.assertEqual(history.durations('t1', runs=2), [4.0])
+        self.assertEqual(history.duration_percentile('t1', pct=50), 2.0)
+        self.assertEqual(
+            history.recent_runs(10), [4, 3, 2, 1])
+
+    def test_slower_tests(self):
+        history = results.ResultsHistory(':memory:')
+        self.addCleanup(history.close)
+        self.record_run(history, {'t1': 1.0, 't2': 1.0, 't3': 1.0})
+        self.assertEqual(history.slower_tests(), [])
+        self.record_run(history, {'t1': 1.0, 't2': 1.1, 't3': 1.2})
+        self.record_run(history, {'t1': 1.5, 't2': 1.0, 't3': 3.0})
+        self.assertEqual(
+            history.slower_tests(threshold=0.2),
+            [('t3', 1.0, 3.0), ('t1', 1.0, 1.5)])
+        self.assertEqual(
+            history.slower_tests(threshold=0.2, runs=1),
+            [('t3', 1.2, 3.0), ('t1', 1.0, 1.5)])
+
+    def test_median_durations(self):
+        history = results.ResultsHistory(':memory:')
+        self.addCleanup(history.close)
+        self.assertEqual(history.median_durations(), {})
+        self.record_run(history, {'t1': 1.0, 't2': 5.0})
+        self.record_run(history, {'t1': 3.0, 't2': None})
+        self.record_run(history, {'t1': 2.0})
+        self.assertEqual(history.median_durations(),
+                         {'t1': 2.0, 't2': 5.0})
+        self.assertEqual(history.median_durations(runs=1), {'t1': 2.0})
+
+    def test_run_outcome(self):
+        history = results.ResultsHistory(':memory:')
+        self.addCleanup(history.close)
+        run_id = self.record_run(history, {'t1': 1.0, 't2': None, 't3': None})
+        self.assertEqual(
+            history.run_outcome(run_id),
+            (run_id, {'t1': 'success', 't2': 'fail', 't3': 'fail'}))
+        rerun_id = self.record_run(history, {'t2': 1.0, 't3': None},
+                                   rerun_of=run_id)
+        self.record_run(history, {'t3': 2.0}, rerun_of=run_id)
+        expected = (run_id, {'t1': 'success', 't2': 'success',
+                             't3': 'success'})
+        self.assertEqual(history.run_outcome(run_id), expected)
+        self.assertEqual(history.run_outcome(rerun_id), expected)
+
+    def test_upgrade(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'results.db')
+        db = sqlite3.connect(path)
+        db.execute("CREATE TABLE runs (run_id INTEGER PRIMARY KEY "
+                   "AUTOINCREMENT, started REAL, logfile TEXT, branch TEXT, "
+                   "target TEXT)")
+        db.commit()
+        db.close()
+        history = results.ResultsHistory(path)
+        self.addCleanup(history.close)
+        self.assertEqual(self.record_run(history, {'t1': 1.0}, rerun_of=3),
+                         1)
+
+    def test_count_statuses(self):
+        self.assertEqual(
+            results.count_statuses(
+                ['success', 'fail', 'success', None, 'timeout']),
+            {'passed': 2, 'failed': 1, 'skipped': 0, 'expected-fail': 0,
+             'unexpected-success': 0, 'timed-out': 1})
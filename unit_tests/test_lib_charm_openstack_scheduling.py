@@ -0,0 +1,68 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import shutil
+import tempfile
+
+import charms_openstack.test_utils as test_utils
+import charm.openstack.scheduling as scheduling
+
+
+class TestScheduling(test_utils.PatchHelper):
+
+    def test_partition(self):
+        durations = {'t1': 8.0, 't2': 5.0, 't3': 4.0, 't4': 3.0, 't5': 2.0}
+        self.assertEqual(
+            scheduling.partition(sorted(durations), durations, 2),
+            [['t1', 't4'], ['t2', 't3', 't5']])
+
+    def test_partition_unknown_durations(self):
+        # t3 has no history and is costed at the median of the rest
+        durations = {'t1': 1.0, 't2': 5.0, 't4': 9.0}
+        self.assertEqual(
+            scheduling.partition(['t1', 't2', 't3', 't4'], durations, 2),
+            [['t4', 't1'], ['t2', 't3']])
+        self.assertEqual(
+            scheduling.partition(['t1', 't2'], {}, 2), [['t1'], ['t2']])
+
+    def test_partition_more_workers_than_tests(self):
+        self.assertEqual(
+            scheduling.partition(['t1', 't2'], {}, 8), [['t1'], ['t2']])
+        self.assertEqual(scheduling.partition([], {}, 4), [])
+
+    def test_auto_concurrency(self):
+        self.assertEqual(scheduling.auto_concurrency(8, {}), 8)
+        self.assertEqual(
+            scheduling.auto_concurrency(8, {'instances': 7, 'port': 100}), 3)
+        self.assertEqual(
+            scheduling.auto_concurrency(8, {'floatingip': 0}), 1)
+        self.assertEqual(
+            scheduling.auto_concurrency(8, {'other': 0}), 8)
+
+    def test_write_worker_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'workers.yaml')
+        test_id = "tempest.api.Test.test_x[id-1,smoke]"
+        scheduling.write_worker_file([[test_id], ["t'2"]], path)
+        with open(path) as worker_file:
+            lines = worker_file.read().splitlines()
+        self.assertEqual(lines[0], '- worker:')
+        self.assertEqual(lines[2], '- worker:')
+        self.assertEqual(lines[3], "  - '^t''2$'")
+        regex = lines[1][len("  - '"):-1]
+        self.assertTrue(re.match(regex, test_id))
+        self.assertFalse(re.match(regex, test_id + 'y'))
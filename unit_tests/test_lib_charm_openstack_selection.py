@@ -0,0 +1,80 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import charms_openstack.test_utils as test_utils
+import charm.openstack.selection as selection
+
+
+class TestSelection(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_test_index(self):
+        path = os.path.join(self.tmpdir, 'index.json')
+        index = selection.TestIndex(path, 'abc')
+        self.assertIsNone(index.load())
+        index.save(['t1', 't2'])
+        self.assertEqual(index.load(), ['t1', 't2'])
+        self.assertEqual(selection.TestIndex(path, 'abc').load(),
+                         ['t1', 't2'])
+        self.assertIsNone(selection.TestIndex(path, 'def').load())
+
+    def test_read_test_list(self):
+        path = os.path.join(self.tmpdir, 'tests')
+        with open(path, 'w') as f:
+            f.write('# compute\ntempest.api.compute\n\n  t2  \n')
+        self.assertEqual(selection.read_test_list(path),
+                         ['tempest.api.compute', 't2'])
+
+    def test_select(self):
+        tests = ['tempest.api.compute.a', 'tempest.api.network.b',
+                 'tempest.scenario.c']
+        self.assertEqual(selection.select(tests), tests)
+        self.assertEqual(
+            selection.select(tests, include='api'),
+            ['tempest.api.compute.a', 'tempest.api.network.b'])
+        self.assertEqual(
+            selection.select(tests, include='compute',
+                             patterns=['scenario']),
+            ['tempest.api.compute.a', 'tempest.scenario.c'])
+        self.assertEqual(
+            selection.select(tests, exclude='network|scenario'),
+            ['tempest.api.compute.a'])
+
+    def test_select_test_ids(self):
+        tests = [
+            'tempest.api.compute.test_servers.ListServers.test_list_servers'
+            '[id-9a438d88-10c6-4bcd-8b5b-5b6e25e1346f,smoke]',
+            'tempest.api.compute.test_servers.ListServers.test_list_servers'
+            '_detail[id-b5b5b5b5-10c6-4bcd-8b5b-5b6e25e1346f]',
+            'tempest.api.network.test_ports.Ports.test_list_ports'
+            '[id-cf95b358-3e92-4a29-a148-52445e1ac50e]']
+        # Index entries are selected on their own, not as regexes
+        self.assertEqual(selection.select(tests, patterns=[tests[0]]),
+                         [tests[0]])
+        # Ids missing from the index which are not regexes are literal
+        self.assertEqual(
+            selection.select(tests, patterns=[
+                'test_list_ports[id-cf95b358-3e92-4a29-a148-52445e1ac50e]',
+                'test_list_servers[id-9a438d88']),
+            [tests[0], tests[2]])
+        self.assertRaises(selection.re.error, selection.select, tests,
+                          include='[d-9]')
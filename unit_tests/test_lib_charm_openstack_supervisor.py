@@ -0,0 +1,235 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import charms_openstack.test_utils as test_utils
+import charm.openstack.supervisor as supervisor
+
+
+class TestSupervisor(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_run_state(self):
+        state = supervisor.RunState(os.path.join(self.tmpdir, 'state.json'))
+        self.assertEqual(state.load(), {})
+        state.update(status='running', done=1)
+        self.assertEqual(state.update(done=2),
+                         {'status': 'running', 'done': 2})
+        self.assertEqual(state.load(), {'status': 'running', 'done': 2})
+
+    def test_describe(self):
+        self.patch_object(supervisor, 'process_alive', return_value=True)
+        info = supervisor.describe({
+            'status': 'running', 'pid': 10, 'started': 100.0,
+            'done': 10, 'total': 40, 'counts': {'passed': 9, 'failed': 1}},
+            now=160.0)
+        self.assertEqual(info, {
+            'status': 'running',
+            'progress': '10/40',
+            'passed': '9',
+            'failed': '1',
+            'elapsed': '60s',
+            'eta': '180s'})
+        self.process_alive.return_value = False
+        info = supervisor.describe({'status': 'running', 'pid': 10})
+        self.assertEqual(info['status'], 'died')
+        self.assertEqual(info['progress'], '0/?')
+
+    def test_describe_finished(self):
+        info = supervisor.describe({
+            'status': 'finished', 'pid': 10, 'started': 100.0,
+            'finished': 130.0, 'done': 3, 'total': 3,
+            'result': {'passed': '3', 'run-id': 2}})
+        self.assertEqual(info['status'], 'finished')
+        self.assertEqual(info['elapsed'], '30s')
+        self.assertEqual(info['run-id'], 2)
+        self.assertNotIn('eta', info)
+
+    def test_run(self):
+        job_dir = os.path.join(self.tmpdir, 'job')
+        os.mkdir(job_dir)
+        output = ('{0} tempest.a.Test.test_1 [0.1s] ... ok\\n'
+                  '{0} tempest.a.Test.test_2 [0.1s] ... FAILED\\n')
+        with open(os.path.join(job_dir, 'spec.json'), 'w') as f:
+            json.dump({
+                'cmd': [sys.executable, '-c',
+                        'print("{}", end="")'.format(output)],
+                'env': dict(os.environ),
+                'cwd': self.tmpdir,
+                'logfile': os.path.join(self.tmpdir, 'run.log'),
+                'subunit_cmd': [sys.executable, '-c', 'pass'],
+                'subunit_file': os.path.join(self.tmpdir, 'run.subunit'),
+                'results_db': os.path.join(self.tmpdir, 'results.db'),
+                'total': 2,
+                'timing': {'phases': {'render': 1.5}, 'http': {}},
+                'timing_file': os.path.join(self.tmpdir, 'run.timing.json'),
+                'target': 'smoke',
+                'metrics': {'state': os.path.join(self.tmpdir, 'metrics.json'),
+                            'textfile_dir': self.tmpdir},
+                'action_info': {'concurrency': 1}}, f)
+        supervisor.main([job_dir])
+        with open(os.path.join(job_dir, 'state.json')) as f:
+            state = json.load(f)
+        self.assertEqual(state['status'], 'finished')
+        self.assertEqual(state['done'], 2)
+        self.assertEqual(state['result']['passed'], '1')
+        self.assertEqual(state['result']['failed'], '1')
+        self.assertEqual(state['result']['concurrency'], 1)
+        with open(os.path.join(self.tmpdir, 'run.timing.json')) as f:
+            phases = json.load(f)['phases']
+        self.assertEqual(sorted(phases),
+                         ['execute-tox', 'parse-results', 'render'])
+        self.assertEqual(phases['render'], 1.5)
+        self.assertTrue(
+            state['result']['phase-times'].startswith('render 1.500s\n'))
+        with open(os.path.join(self.tmpdir, 'run.log')) as f:
+            self.assertIn('test_2', f.read())
+        with open(os.path.join(self.tmpdir, 'tempest.prom')) as f:
+            self.assertIn('tempest_runs_total{target="smoke"} 1\n', f.read())
+
+    def test_run_timeout(self):
+        job_dir = os.path.join(self.tmpdir, 'job')
+        os.mkdir(job_dir)
+        script = ('import time\n'
+                  'print("{0} tempest.a.Test.test_1 [0.1s] ... ok", '
+                  'flush=True)\n'
+                  'time.sleep(60)\n')
+        with open(os.path.join(job_dir, 'spec.json'), 'w') as f:
+            json.dump({
+                'cmd': [sys.executable, '-c', script],
+                'env': dict(os.environ),
+                'cwd': self.tmpdir,
+                'logfile': os.path.join(self.tmpdir, 'run.log'),
+                'subunit_cmd': [sys.executable, '-c',
+                                'open("collected", "w")'],
+                'subunit_file': os.path.join(self.tmpdir, 'run.subunit'),
+                'run_timeout': 1}, f)
+        supervisor.main([job_dir])
+        with open(os.path.join(job_dir, 'state.json')) as f:
+            state = json.load(f)
+        self.assertEqual(state['status'], 'finished')
+        self.assertEqual(state['result']['timed-out'], 'run')
+        self.assertEqual(state['result']['passed'], '1')
+        self.assertLess(state['finished'] - state['started'], 30)
+        # stestr last would report the previous run
+        self.assertFalse(
+            os.path.exists(os.path.join(self.tmpdir, 'collected')))
+
+    def test_run_cancelled(self):
+        job_dir = os.path.join(self.tmpdir, 'job')
+        os.mkdir(job_dir)
+        script = ('import time\n'
+                  'print("{0} tempest.a.Test.test_1 [0.1s] ... ok", '
+                  'flush=True)\n'
+                  'time.sleep(60)\n')
+        with open(os.path.join(job_dir, 'spec.json'), 'w') as f:
+            json.dump({
+                'cmd': [sys.executable, '-c', script],
+                'env': dict(os.environ),
+                'cwd': self.tmpdir,
+                'logfile': os.path.join(self.tmpdir, 'run.log'),
+                'subunit_cmd': [sys.executable, '-c',
+                                'open("collected", "w")'],
+                'subunit_file': os.path.join(self.tmpdir, 'run.subunit'),
+                'results_db': os.path.join(self.tmpdir, 'results.db')}, f)
+        job = supervisor.Supervisor(job_dir)
+        self.addCleanup(supervisor.signal.signal, supervisor.signal.SIGTERM,
+                        supervisor.signal.getsignal(supervisor.signal.SIGTERM))
+        timer = threading.Timer(1, job.cancel)
+        timer.start()
+        job.run()
+        timer.join()
+        state = job.state.load()
+        self.assertEqual(state['status'], 'cancelled')
+        self.assertEqual(state['result']['passed'], '1')
+        self.assertNotIn('run-id', state['result'])
+        self.assertFalse(
+            os.path.exists(os.path.join(self.tmpdir, 'collected')))
+
+    def test_watchdog_overrun(self):
+        watchdog = supervisor.Watchdog(None, run_timeout=100, test_timeout=10,
+                                       startup_grace=50)
+        watchdog.started = 1000.0
+        # No test has completed yet, the virtualenv may still be building
+        self.assertIsNone(watchdog.overrun(1065.0))
+        self.assertEqual(watchdog.overrun(1071.0), 'test')
+        watchdog.last_test = 1000.0
+        self.assertIsNone(watchdog.overrun(1015.0))
+        self.assertEqual(watchdog.overrun(1021.0), 'test')
+        watchdog.last_test = 1090.0
+        self.assertIsNone(watchdog.overrun(1095.0))
+        self.assertEqual(watchdog.overrun(1101.0), 'run')
+        self.assertIsNone(supervisor.Watchdog(None).overrun(1e12))
+
+    def test_stop_process_group(self):
+        self.patch_object(supervisor.os, 'killpg')
+        proc = mock.MagicMock(pid=10)
+        proc.wait.side_effect = supervisor.subprocess.TimeoutExpired('t', 1)
+        supervisor.stop_process_group(proc, grace=1)
+        self.killpg.assert_has_calls([
+            mock.call(10, supervisor.signal.SIGTERM),
+            mock.call(10, supervisor.signal.SIGKILL)])
+        proc.wait.assert_called_once_with(timeout=1)
+
+    def test_run_fails(self):
+        job_dir = os.path.join(self.tmpdir, 'job')
+        os.mkdir(job_dir)
+        with open(os.path.join(job_dir, 'spec.json'), 'w') as f:
+            json.dump({
+                'cmd': [os.path.join(self.tmpdir, 'missing')],
+                'env': {},
+                'cwd': self.tmpdir,
+                'logfile': os.path.join(self.tmpdir, 'run.log')}, f)
+        self.assertRaises(OSError, supervisor.main, [job_dir])
+        with open(os.path.join(job_dir, 'state.json')) as f:
+            self.assertEqual(json.load(f)['status'], 'failed')
+
+    def test_run_prepare_fails(self):
+        job_dir = os.path.join(self.tmpdir, 'job')
+        os.mkdir(job_dir)
+        prepare = {'mirror': '/tmp/mirror', 'run_dir': '/tmp/run'}
+        with open(os.path.join(job_dir, 'spec.json'), 'w') as f:
+            json.dump({
+                'cmd': [sys.executable, '-c', 'pass'],
+                'env': {},
+                'cwd': self.tmpdir,
+                'logfile': os.path.join(self.tmpdir, 'run.log'),
+                'prepare': prepare}, f)
+        self.patch_object(supervisor.workspace, 'prepare',
+                          side_effect=OSError('no git'))
+        self.patch_object(supervisor.subprocess, 'Popen')
+        self.assertRaises(OSError, supervisor.main, [job_dir])
+        self.prepare.assert_called_once_with(prepare)
+        self.assertFalse(self.Popen.called)
+        with open(os.path.join(job_dir, 'state.json')) as f:
+            state = json.load(f)
+        self.assertEqual(state['status'], 'failed')
+        self.assertEqual(state['error'], 'no git')
+
+    def test_collect_subunit_missing(self):
+        store = supervisor.collect_subunit(
+            [os.path.join(self.tmpdir, 'missing')], self.tmpdir,
+            os.path.join(self.tmpdir, 'run.subunit'))
+        self.assertEqual(store.records, {})
@@ -13,7 +13,12 @@
 # limitations under the License.
 
 import io
+import json
 import mock
+import os
+import shutil
+import tarfile
+import tempfile
 
 import charms_openstack.test_utils as test_utils
 import charm.openstack.tempest as tempest
@@ -46,35 +51,56 @@ class TestTempestAdminAdapter(test_utils.PatchHelper):
             'service_password': 'pass1',
             'service_tenant_name': 'svc',
             'service_region': 'reg1'}
-        self.patch_object(tempest.keystoneclient_v2, 'Client')
+        self.patch_object(tempest.clients, 'ClientFactory')
         self.patch_object(tempest.hookenv, 'config')
+        self.config.return_value = {'discovery-timeout': 30}
         self.patch_object(
             tempest.adapters.OpenStackRelationAdapter, '__init__')
         self.patch_object(
             tempest.TempestAdminAdapter,
             'keystone_info',
             new=ks_info)
+        factory = self.ClientFactory.return_value
         a = tempest.TempestAdminAdapter('rel2')
         a.init_keystone_client()
-        self.Client.assert_called_once_with(
-            auth_url='http://kshost:5001/v2.0',
-            password='pass1',
+        self.ClientFactory.assert_called_once_with(
+            '2',
+            {'auth_url': 'http://kshost:5001/v2.0',
+             'password': 'pass1',
+             'tenant_name': 'svc',
+             'username': 'user1'},
             region_name='reg1',
-            tenant_name='svc',
-            username='user1')
+            timeout=30)
+        factory.client.assert_called_once_with('identity')
+        factory.session.get_token.assert_called_once_with()
+        self.assertEqual(a.ks_client, factory.client.return_value)
+        self.assertEqual(a.keystone_session, factory.session)
+        self.assertEqual(a.api_version, '2')
 
     def test_ec2_creds(self):
         self.patch_object(tempest.hookenv, 'config')
         self.patch_object(tempest.TempestAdminAdapter, 'init_keystone_client')
         self.patch_object(tempest.TempestAdminAdapter, '_setup_properties')
         kc = mock.MagicMock()
-        kc.user_id = 'bob'
-        kc.ec2.list = lambda x: [{'access_token': 'ac2',
-                                  'secret_token': 'st2'}]
+        kc.ec2.list.return_value = [mock.MagicMock(access='ac2',
+                                                   secret='st2')]
         self.patch_object(tempest.TempestAdminAdapter, 'ks_client', new=kc)
         a = tempest.TempestAdminAdapter('rel2')
+        a.api_version = '2'
+        a.keystone_session = mock.MagicMock()
+        a.keystone_session.get_user_id.return_value = 'bob'
         self.assertEqual(a.ec2_creds, {'access_token': 'ac2',
                                        'secret_token': 'st2'})
+        kc.ec2.list.assert_called_once_with('bob')
+        self.assertFalse(kc.ec2.create.called)
+        # Credentials are created when the user has none
+        kc.ec2.list.return_value = []
+        kc.ec2.create.return_value = mock.MagicMock(access='ac3',
+                                                    secret='st3')
+        a.keystone_session.get_project_id.return_value = 'admin'
+        self.assertEqual(a.get_ec2_creds(), {'access_token': 'ac3',
+                                             'secret_token': 'st3'})
+        kc.ec2.create.assert_called_once_with('bob', 'admin')
 
     def test_image_info(self):
         self.patch_object(tempest.hookenv, 'config')
@@ -83,16 +109,11 @@ class TestTempestAdminAdapter(test_utils.PatchHelper):
                           return_value=True)
         self.patch_object(
             tempest.adapters.OpenStackRelationAdapter, '__init__')
-        self.patch_object(tempest.TempestAdminAdapter, 'ks_client')
-        self.patch_object(tempest.glanceclient, 'Client')
+        self.patch_object(tempest.TempestAdminAdapter, 'get_client')
         self.config.return_value = {
             'glance-image-name': 'img1',
             'glance-alt-image-name': 'altimg',
         }
-        kc = mock.MagicMock()
-        kc.service_catalog.url_for = \
-            lambda service_type=None, endpoint_type=None: 'http://glance'
-        self.ks_client.return_value = kc
         img1 = mock.MagicMock()
         img1.name = 'img1'
         img1.id = 'img1_id'
@@ -100,10 +121,101 @@ class TestTempestAdminAdapter(test_utils.PatchHelper):
         img2.name = 'img2'
         img2.id = 'img2_id'
         gc = mock.MagicMock()
-        gc.images.list = lambda: [img1, img2]
-        self.Client.return_value = gc
+        gc.images.list = lambda filters=None: [
+            i for i in [img1, img2] if i.name == filters['name']]
+        self.get_client.return_value = gc
+        a = tempest.TempestAdminAdapter('rel2')
+        self.assertEqual(a.image_info, {'image_id': 'img1_id'})
+        self.get_client.assert_called_once_with('image')
+
+    def test_discovery_snapshot(self):
+        self.patch_object(tempest.hookenv, 'config')
+        self.patch_object(tempest.TempestAdminAdapter, 'init_keystone_client')
+        self.patch_object(
+            tempest.adapters.OpenStackRelationAdapter, '__init__')
+        self.patch_object(tempest.TempestAdminAdapter, 'get_image_info',
+                          return_value={'image_id': 'img1_id'})
+        a = tempest.TempestAdminAdapter('rel2')
+        self.assertEqual(a.image_info, {'image_id': 'img1_id'})
+        self.assertEqual(a.image_info, {'image_id': 'img1_id'})
+        self.get_image_info.assert_called_once_with()
+        self.patch_object(tempest.TempestAdminAdapter, 'discovery_cache')
+        a.invalidate_discovery()
+        self.discovery_cache.return_value.clear.assert_called_once_with()
+        self.assertEqual(a.image_info, {'image_id': 'img1_id'})
+        self.assertEqual(self.get_image_info.call_count, 2)
+
+    def test_prefetch_discovery(self):
+        self.patch_object(tempest.hookenv, 'config')
+        self.config.return_value = {'discovery-timeout': 30,
+                                    'discovery-timeouts': 'quota_headroom=5'}
+        self.patch_object(tempest.hookenv, 'action_get', return_value={})
+        self.patch_object(tempest.TempestAdminAdapter, 'init_keystone_client')
+        self.patch_object(
+            tempest.adapters.OpenStackRelationAdapter, '__init__')
+        self.patch_object(tempest.discovery, 'run_concurrently')
+        self.patch_object(tempest.TempestAdminAdapter, 'discovery_cache')
+        self.discovery_cache.return_value.load.return_value = None
+        self.run_concurrently.return_value = {
+            'image_info': {'image_id': 'img1_id'}}
         a = tempest.TempestAdminAdapter('rel2')
+        a._discovery['ec2_creds'] = {'access_token': 'ac2'}
+        a.prefetch_discovery()
+        lookups = self.run_concurrently.call_args[0][0]
+        self.assertEqual(
+            sorted(lookups.keys()),
+            ['compute_info', 'image_info', 'network_info',
+             'quota_headroom', 'service_info'])
+        self.run_concurrently.assert_called_once_with(
+            lookups, timeouts={'quota_headroom': 5}, default_timeout=30)
         self.assertEqual(a.image_info, {'image_id': 'img1_id'})
+        self.assertEqual(a.ec2_creds, {'access_token': 'ac2'})
+        self.assertEqual(a.compute_info, {})
+        # network_info and compute_info failed so nothing is cached
+        self.assertFalse(self.discovery_cache.return_value.save.called)
+
+    def test_prefetch_discovery_cached(self):
+        self.patch_object(tempest.hookenv, 'config')
+        self.config.return_value = {'discovery-timeout': 30}
+        self.patch_object(tempest.hookenv, 'action_get')
+        self.action_get.return_value = {'refresh-discovery': False}
+        self.patch_object(tempest.TempestAdminAdapter, 'init_keystone_client')
+        self.patch_object(
+            tempest.adapters.OpenStackRelationAdapter, '__init__')
+        self.patch_object(tempest.TempestAdminAdapter, 'get_client')
+        self.patch_object(tempest.TempestAdminAdapter, 'discovery_cache')
+        self.patch_object(tempest.discovery, 'run_concurrently')
+        cache = self.discovery_cache.return_value
+        cache.load.return_value = {
+            'ec2_creds': {},
+            'image_info': {'image_id': 'img1_id'},
+            'network_info': {'router_id': '16'},
+            'compute_info': {'flavor_id': 'id1'},
+            'quota_headroom': {'instances': 10}}
+        self.run_concurrently.return_value = {
+            'service_info': {'nova': 'true'}}
+        a = tempest.TempestAdminAdapter('rel2')
+        a.prefetch_discovery()
+        self.run_concurrently.assert_called_once_with(
+            {'service_info': a.get_service_info}, timeouts={},
+            default_timeout=30)
+        self.get_client.return_value.images.get.assert_called_once_with(
+            'img1_id')
+        self.assertEqual(a.compute_info, {'flavor_id': 'id1'})
+        self.assertEqual(a.service_info, {'nova': 'true'})
+        self.assertEqual(a.quota_headroom, {'instances': 10})
+        self.assertFalse(cache.clear.called)
+        self.assertFalse(cache.save.called)
+        # refresh-discovery drops the cache and the memoized lookups
+        self.action_get.return_value = {'refresh-discovery': True}
+        cache.load.return_value = None
+        self.run_concurrently.reset_mock()
+        a.prefetch_discovery()
+        cache.clear.assert_called_once_with()
+        self.assertEqual(
+            sorted(self.run_concurrently.call_args[0][0]),
+            ['compute_info', 'ec2_creds', 'image_info', 'network_info',
+             'quota_headroom', 'service_info'])
 
     def test_network_info(self):
         self.patch_object(tempest.hookenv, 'config')
@@ -112,28 +224,25 @@ class TestTempestAdminAdapter(test_utils.PatchHelper):
         self.patch_object(tempest.TempestAdminAdapter, 'init_keystone_client')
         self.patch_object(
             tempest.adapters.OpenStackRelationAdapter, '__init__')
-        self.patch_object(tempest.TempestAdminAdapter, 'ks_client')
-        self.patch_object(tempest.neutronclient, 'Client')
-        router1 = {'id': '16'}
-        net1 = {'id': 'pubnet1'}
-        kc = mock.MagicMock()
-        kc.service_catalog.url_for = \
-            lambda service_type=None, endpoint_type=None: 'http://neutron'
-        self.ks_client.return_value = kc
+        self.patch_object(tempest.TempestAdminAdapter, 'get_client')
+        router1 = {'id': '16', 'name': 'route1'}
+        net1 = {'id': 'pubnet1', 'name': 'net1'}
+        net2 = {'id': 'extnet1', 'name': 'ext_net'}
         self.config.return_value = {
             'router-name': 'route1',
             'floating-network-name': 'ext_net',
             'network-name': 'net1'}
         nc = mock.MagicMock()
-        nc.list_routers = lambda name=None: {'routers': [router1]}
-        nc.list_networks = lambda name=None: {'networks': [net1]}
-        self.Client.return_value = nc
+        nc.list_routers.return_value = {'routers': [router1]}
+        nc.list_networks.return_value = {'networks': [net1, net2]}
+        self.get_client.return_value = nc
         a = tempest.TempestAdminAdapter('rel2')
         self.assertEqual(
             a.network_info,
             {'floating_network_name': 'ext_net',
              'public_network_id': 'pubnet1',
              'router_id': '16'})
+        nc.list_networks.assert_called_once_with(name=['ext_net', 'net1'])
 
     def test_compute_info(self):
         self.patch_object(tempest.hookenv, 'config')
@@ -142,33 +251,20 @@ class TestTempestAdminAdapter(test_utils.PatchHelper):
                           return_value=True)
         self.patch_object(
             tempest.adapters.OpenStackRelationAdapter, '__init__')
-        ki = {
-            'service_username': 'user',
-            'service_password': 'pass',
-            'service_tenant_name': 'ten',
-        }
         self.patch_object(
             tempest.TempestAdminAdapter,
-            'keystone_info',
-            new=ki)
-        self.patch_object(
-            tempest.TempestAdminAdapter,
-            'keystone_auth_url',
-            return_value='auth_url')
+            'resolve_endpoint',
+            return_value='http://nova:999/bob')
         self.config.return_value = {
             'flavor-alt-name': None,
             'flavor-name': 'm3.huuge'}
-        kc = mock.MagicMock()
-        kc.service_catalog.url_for = \
-            lambda service_type=None, endpoint_type=None: 'http://nova:999/bob'
-        self.patch_object(tempest.TempestAdminAdapter, 'ks_client', new=kc)
-        self.patch_object(tempest.novaclient_client, 'Client')
+        self.patch_object(tempest.TempestAdminAdapter, 'get_client')
         _flavor1 = mock.MagicMock()
         _flavor1.name = 'm3.huuge'
         _flavor1.id = 'id1'
         nc = mock.MagicMock()
-        nc.flavors.list = lambda: [_flavor1]
-        self.Client.return_value = nc
+        nc.flavors.list = lambda marker=None, limit=None: [_flavor1]
+        self.get_client.return_value = nc
         a = tempest.TempestAdminAdapter('rel2')
         self.assertEqual(
             a.compute_info,
@@ -176,27 +272,46 @@ class TestTempestAdminAdapter(test_utils.PatchHelper):
                 'flavor_id': 'id1',
                 'nova_base': 'http://nova'})
 
+    def test_get_quota_headroom(self):
+        self.patch_object(tempest.hookenv, 'config')
+        self.patch_object(tempest.TempestAdminAdapter, 'init_keystone_client')
+        self.patch_object(tempest.TempestAdminAdapter, 'service_present',
+                          return_value=True)
+        self.patch_object(
+            tempest.adapters.OpenStackRelationAdapter, '__init__')
+        self.patch_object(tempest.TempestAdminAdapter, 'get_client')
+        limits = []
+        for name, value in [('maxTotalInstances', 10),
+                            ('totalInstancesUsed', 4),
+                            ('maxTotalCores', -1),
+                            ('totalCoresUsed', 8)]:
+            limit = mock.MagicMock()
+            limit.name = name
+            limit.value = value
+            limits.append(limit)
+        client = self.get_client.return_value
+        client.limits.get.return_value.absolute = limits
+        client.show_quota_details.return_value = {'quota': {
+            'port': {'limit': 50, 'used': 10, 'reserved': 2},
+            'network': {'limit': -1, 'used': 3, 'reserved': 0}}}
+        a = tempest.TempestAdminAdapter('rel2')
+        a.keystone_session = mock.MagicMock()
+        a.keystone_session.get_project_id.return_value = 'proj1'
+        self.assertEqual(a.get_quota_headroom(),
+                         {'instances': 6, 'port': 38})
+        client.show_quota_details.assert_called_once_with('proj1')
+
     def test_get_present_services(self):
         self.patch_object(tempest.TempestAdminAdapter, 'init_keystone_client')
         self.patch_object(
             tempest.adapters.OpenStackRelationAdapter, '__init__')
-        kc = mock.MagicMock()
-        svc1 = mock.Mock()
-        svc2 = mock.Mock()
-        svc3 = mock.Mock()
-        svc1.name = 'compute'
-        svc1.enabled = True
-        svc2.name = 'image'
-        svc2.enabled = False
-        svc3.name = 'network'
-        svc3.enabled = True
-        svcs = [svc1, svc2, svc3]
-        kc.services.list = lambda: svcs
-        self.patch_object(tempest.TempestAdminAdapter, 'ks_client', new=kc)
         a = tempest.TempestAdminAdapter('rel2')
+        a.catalogue = tempest.clients.ServiceCatalogue([
+            {'name': 'nova', 'type': 'compute'},
+            {'name': 'neutron', 'type': 'network'}])
         self.assertEqual(
             a.get_present_services(),
-            ['compute', 'network'])
+            ['neutron', 'nova'])
 
     def test_service_info(self):
         self.patch_object(tempest.TempestAdminAdapter, 'init_keystone_client')
@@ -256,9 +371,10 @@ class TestTempestAdminAdapter(test_utils.PatchHelper):
         self.patch_object(tempest.TempestAdminAdapter, 'init_keystone_client')
         self.patch_object(
             tempest.adapters.OpenStackRelationAdapter, '__init__')
-        self.patch_object(tempest.TempestAdminAdapter, 'get_present_services',
-                          return_value=['svc1', 'svc2'])
         a = tempest.TempestAdminAdapter('rel2')
+        a.catalogue = tempest.clients.ServiceCatalogue([
+            {'name': 'svc1', 'type': 'type1'},
+            {'name': 'svc2', 'type': 'type2'}])
         self.assertTrue(a.service_present('svc1'))
         self.assertFalse(a.service_present('svc3'))
 
@@ -289,56 +405,576 @@ class TestTempestCharm(Helper):
         ]
         self.mkdir.assert_has_calls(calls)
 
-    def test_setup_git(self):
+    def patch_render_files(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        conf = os.path.join(tmpdir, 'tempest.conf')
+        self.patch_object(tempest.TempestCharm, 'TEMPEST_CONF', new=conf)
+        self.patch_object(tempest.TempestCharm, 'RENDER_FINGERPRINT',
+                          new=conf + '.fingerprint')
+        self.patch_object(tempest.hookenv, 'action_get', return_value={})
+        self.patch_object(tempest.TempestCharm, 'render_with_interfaces')
+        self.patch_object(tempest.TempestCharm, 'render_fingerprint',
+                          return_value='fp1')
+        with open(conf, 'w') as f:
+            f.write('[DEFAULT]')
+
+    def test_render_if_changed(self):
+        self.patch_render_files()
+        c = tempest.TempestCharm()
+        c.render_if_changed(['ks'])
+        self.render_with_interfaces.assert_called_once_with(['ks'])
+        with open(c.RENDER_FINGERPRINT) as f:
+            self.assertEqual(f.read(), 'fp1')
+        self.render_with_interfaces.reset_mock()
+        c.render_if_changed(['ks'])
+        self.assertFalse(self.render_with_interfaces.called)
+        self.render_fingerprint.return_value = 'fp2'
+        c.render_if_changed(['ks'])
+        self.render_with_interfaces.assert_called_once_with(['ks'])
+
+    def test_render_if_changed_forced(self):
+        self.patch_render_files()
+        c = tempest.TempestCharm()
+        c.render_if_changed(['ks'])
+        self.action_get.return_value = {'force-render': True}
+        c.render_if_changed(['ks'])
+        self.assertEqual(self.render_with_interfaces.call_count, 2)
+
+    def test_render_if_changed_no_fingerprint(self):
+        self.patch_render_files()
+        self.render_fingerprint.return_value = None
+        c = tempest.TempestCharm()
+        c.render_if_changed(['ks'])
+        c.render_if_changed(['ks'])
+        self.assertEqual(self.render_with_interfaces.call_count, 2)
+        self.assertFalse(os.path.exists(c.RENDER_FINGERPRINT))
+
+    def test_update_mirror_clone(self):
+        self.patch_object(tempest.TempestCharm, 'tempest_bundle',
+                          return_value=None)
         self.patch_object(tempest.hookenv, 'config')
-        self.patch_object(tempest.os.path, 'exists')
-        self.patch_object(tempest.os, 'symlink')
-        self.patch_object(tempest.fetch, 'install_remote')
+        self.patch_object(tempest.os.path, 'exists', return_value=False)
+        self.patch_object(tempest.workspace.Workspace, 'git')
         self.config.return_value = {'tempest-source': 'git_url'}
-        self.exists.return_value = False
+        c = tempest.TempestCharm()
+        c.update_mirror()
+        self.git.assert_has_calls([
+            mock.call('clone', '--bare', 'git_url',
+                      '/var/lib/tempest/tempest.git'),
+            mock.call('config', 'remote.origin.fetch',
+                      '+refs/heads/*:refs/heads/*',
+                      cwd='/var/lib/tempest/tempest.git')])
+
+    def test_update_mirror_fetch(self):
+        self.patch_object(tempest.TempestCharm, 'tempest_bundle',
+                          return_value=None)
+        self.patch_object(tempest.hookenv, 'config')
+        self.patch_object(tempest.os.path, 'exists', return_value=True)
+        self.patch_object(tempest.workspace.Workspace, 'git')
+        self.patch_object(tempest.TempestCharm, 'mirror_is_stale')
+        self.config.return_value = {'tempest-source': 'git_url'}
+        self.mirror_is_stale.return_value = False
+        c = tempest.TempestCharm()
+        c.update_mirror()
+        self.assertFalse(self.git.called)
+        self.mirror_is_stale.return_value = True
+        c.update_mirror()
+        self.git.assert_has_calls([
+            mock.call('remote', 'set-url', 'origin', 'git_url',
+                      cwd='/var/lib/tempest/tempest.git'),
+            mock.call('fetch', '--prune', '--tags', 'origin',
+                      cwd='/var/lib/tempest/tempest.git')])
+
+    def test_update_mirror_bundle(self):
+        self.patch_object(tempest.TempestCharm, 'tempest_bundle',
+                          return_value='/var/lib/tempest/bundle')
+        self.patch_object(tempest.hookenv, 'config', return_value={})
+        self.patch_object(tempest.os.path, 'exists', return_value=True)
+        self.patch_object(tempest.workspace.Workspace, 'git')
+        c = tempest.TempestCharm()
+        c.update_mirror()
+        self.git.assert_has_calls([
+            mock.call('remote', 'set-url', 'origin',
+                      '/var/lib/tempest/bundle/tempest.git',
+                      cwd='/var/lib/tempest/tempest.git'),
+            mock.call('fetch', '--prune', '--tags', 'origin',
+                      cwd='/var/lib/tempest/tempest.git')])
+
+    def test_unpack_tempest_bundle(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        wheel = os.path.join(tmpdir, 'pbr.whl')
+        with open(wheel, 'w') as f:
+            f.write('wheel')
+        resource = os.path.join(tmpdir, 'tempest-bundle.tar.gz')
+        with tarfile.open(resource, 'w:gz') as bundle:
+            bundle.add(wheel, arcname='wheelhouse/pbr.whl')
+        bundle_dir = os.path.join(tmpdir, 'bundle')
+        self.patch_object(tempest.TempestCharm, 'TEMPEST_BUNDLE',
+                          new=bundle_dir)
+        self.patch_object(tempest.hookenv, 'resource_get',
+                          return_value=resource)
+        self.patch_object(tempest.tarfile, 'open', wraps=tarfile.open)
+        c = tempest.TempestCharm()
+        self.assertEqual(c.unpack_tempest_bundle(), bundle_dir)
+        self.assertTrue(
+            os.path.exists(os.path.join(bundle_dir, 'wheelhouse/pbr.whl')))
+        # An unchanged resource is not unpacked again
+        self.assertEqual(c.unpack_tempest_bundle(), bundle_dir)
+        self.assertEqual(self.open.call_count, 1)
+
+    def test_unpack_tempest_bundle_links(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.patch_object(tempest.TempestCharm, 'TEMPEST_BUNDLE',
+                          new=os.path.join(tmpdir, 'bundle'))
+        self.patch_object(tempest.hookenv, 'resource_get')
+        c = tempest.TempestCharm()
+        for name, kind, target in (
+                ('wheelhouse/../../escape', tarfile.REGTYPE, ''),
+                ('wheelhouse/passwd', tarfile.SYMTYPE, '/etc/passwd'),
+                ('wheelhouse/up', tarfile.SYMTYPE, '../../etc'),
+                ('wheelhouse/hard', tarfile.LNKTYPE, '../etc/passwd')):
+            resource = os.path.join(tmpdir, 'tempest-bundle.tar')
+            with tarfile.open(resource, 'w') as bundle:
+                member = tarfile.TarInfo(name)
+                member.type = kind
+                member.linkname = target
+                bundle.addfile(member)
+            self.resource_get.return_value = resource
+            self.assertRaises(ValueError, c.unpack_tempest_bundle)
+        self.assertTrue(c.bundle_path_is_safe('wheelhouse/../tempest.git'))
+        self.assertTrue(c.bundle_path_is_safe('..wheels'))
+
+    def test_unpack_tempest_bundle_missing(self):
+        self.patch_object(tempest.hookenv, 'resource_get',
+                          return_value=False)
+        c = tempest.TempestCharm()
+        self.assertIsNone(c.unpack_tempest_bundle())
+
+    def test_mirror_is_stale(self):
+        self.patch_object(tempest.TempestCharm, 'tempest_bundle',
+                          return_value=None)
+        self.patch_object(tempest.hookenv, 'config')
+        self.patch_object(tempest.os.path, 'exists', return_value=True)
+        self.patch_object(tempest.os.path, 'getmtime', return_value=1000)
+        self.patch_object(tempest.time, 'time', return_value=1100)
+        c = tempest.TempestCharm()
+        self.config.return_value = {'tempest-source-refresh-interval': 60}
+        self.assertTrue(c.mirror_is_stale())
+        self.config.return_value = {'tempest-source-refresh-interval': 600}
+        self.assertFalse(c.mirror_is_stale())
+        self.config.return_value = {'tempest-source-refresh-interval': -1}
+        self.assertFalse(c.mirror_is_stale())
+
+    def test_setup_git(self):
+        self.patch_object(tempest.TempestCharm, 'update_mirror')
+        self.patch_object(tempest.workspace.Workspace, 'git')
+        self.patch_object(tempest.os.path, 'isdir', return_value=False)
+        self.patch_object(tempest.os.path, 'exists', return_value=False)
+        self.patch_object(tempest.os, 'symlink')
         c = tempest.TempestCharm()
         c.setup_git('git_branch', 'git_dir')
-        self.install_remote.assert_called_once_with(
-            'git_url',
-            branch='git_branch',
-            depth='1',
-            dest='git_dir')
+        self.update_mirror.assert_called_once_with()
+        self.git.assert_has_calls([
+            mock.call('worktree', 'prune',
+                      cwd='/var/lib/tempest/tempest.git'),
+            mock.call('worktree', 'add', '--force', '--detach',
+                      'git_dir/tempest', 'git_branch',
+                      cwd='/var/lib/tempest/tempest.git')])
         self.symlink.assert_called_once_with(
             '/var/lib/tempest/tempest.conf',
             'git_dir/tempest/etc/tempest.conf')
 
-    def test_setup_git_noop(self):
-        self.patch_object(tempest.hookenv, 'config')
-        self.patch_object(tempest.os.path, 'exists')
-        self.config.return_value = {'tempest-source': 'git_url'}
+    def test_setup_git_existing(self):
+        self.patch_object(tempest.TempestCharm, 'update_mirror')
+        self.patch_object(tempest.workspace.Workspace, 'git')
+        self.patch_object(tempest.os.path, 'isdir', return_value=False)
+        self.patch_object(tempest.os.path, 'exists', return_value=True)
         self.patch_object(tempest.os, 'symlink')
-        self.patch_object(tempest.fetch, 'install_remote')
-        self.exists.return_value = True
         c = tempest.TempestCharm()
         c.setup_git('git_branch', 'git_dir')
-        self.assertFalse(self.install_remote.called)
+        self.git.assert_called_once_with(
+            'checkout', '--force', '--detach', 'git_branch',
+            cwd='git_dir/tempest')
         self.assertFalse(self.symlink.called)
 
     def test_execute_tox(self):
-        # XXX env seems unused
         self.patch_object(tempest.hookenv, 'config')
         self.patch_object(tempest.os.environ, 'copy')
-        self.patch_object(tempest.subprocess, 'call')
+        self.patch_object(tempest.subprocess, 'Popen')
         os_env = mock.MagicMock()
         self.copy.return_value = os_env
         self.config.return_value = {
             'http-proxy': 'http://proxy',
             'https-proxy': 'https://proxy',
         }
-        with mock.patch("builtins.open", return_value="fhandle"):
+        output = unit_tests.tempest_output.TEMPEST_OUT.encode('utf-8')
+        self.Popen.return_value.stdout = io.BytesIO(output)
+        log = io.StringIO()
+        with mock.patch("builtins.open") as _open:
+            _open.return_value.__enter__.return_value = log
             c = tempest.TempestCharm()
-            c.execute_tox('/tmp/run', '/tmp/t.log', 'py38')
-        self.call.assert_called_with(
+            summary = c.execute_tox('/tmp/run', '/tmp/t.log', 'py38')
+        _open.assert_called_once_with('/tmp/t.log', 'w')
+        self.Popen.assert_called_with(
             ['tox', '-e', 'py38'],
             cwd='/tmp/run',
-            stderr='fhandle',
-            stdout='fhandle',
-            env=os_env)
+            stderr=tempest.subprocess.STDOUT,
+            stdout=tempest.subprocess.PIPE,
+            env=os_env,
+            start_new_session=True)
+        self.Popen.return_value.wait.assert_called_once_with()
+        self.assertEqual(
+            log.getvalue(), unit_tests.tempest_output.TEMPEST_OUT)
+        self.assertEqual(summary['passed'], '21')
+
+    def test_execute_tox_venv(self):
+        self.patch_object(tempest.hookenv, 'config', return_value={})
+        self.patch_object(tempest.os.environ, 'copy',
+                          return_value={'PATH': '/usr/bin'})
+        self.patch_object(tempest.subprocess, 'Popen')
+        self.Popen.return_value.stdout = io.BytesIO()
+        with mock.patch("builtins.open"):
+            c = tempest.TempestCharm()
+            c.execute_tox('/tmp/run', '/tmp/t.log', 'smoke',
+                          venv_dir='/tmp/venv')
+        self.Popen.assert_called_with(
+            ['/tmp/venv/bin/tempest', 'run', '--smoke'],
+            cwd='/tmp/run',
+            stderr=tempest.subprocess.STDOUT,
+            stdout=tempest.subprocess.PIPE,
+            env={
+                'PATH': '/tmp/venv/bin:/usr/bin',
+                'VIRTUAL_ENV': '/tmp/venv',
+                'TEMPEST_CONFIG_DIR': '/tmp/run/etc',
+                'OS_TEST_TIMEOUT': '1200'},
+            start_new_session=True)
+
+    def test_tempest_cmd_test_timeout(self):
+        self.patch_object(tempest.hookenv, 'config', return_value={})
+        self.patch_object(tempest.os.environ, 'copy', side_effect=dict)
+        c = tempest.TempestCharm()
+        _, env = c.tempest_cmd('/tmp/run', 'smoke', venv_dir='/tmp/venv',
+                               test_timeout=300)
+        self.assertEqual(env['OS_TEST_TIMEOUT'], '300')
+        _, env = c.tempest_cmd('/tmp/run', 'smoke', test_timeout=300)
+        self.assertEqual(env['OS_TEST_TIMEOUT'], '300')
+        _, env = c.tempest_cmd('/tmp/run', 'smoke')
+        self.assertNotIn('OS_TEST_TIMEOUT', env)
+        # The virtualenv keeps the default tox would have set
+        _, env = c.tempest_cmd('/tmp/run', 'smoke', venv_dir='/tmp/venv')
+        self.assertEqual(env['OS_TEST_TIMEOUT'], '1200')
+
+    def test_resolve_timeouts(self):
+        self.patch_object(tempest.hookenv, 'config')
+        self.config.return_value = {'run-timeout': 3600, 'test-timeout': 0}
+        c = tempest.TempestCharm()
+        self.assertEqual(c.resolve_timeouts({}), (3600, None))
+        self.assertEqual(
+            c.resolve_timeouts({'run-timeout': 0, 'test-timeout': 300}),
+            (3600, 300))
+        self.assertEqual(
+            c.resolve_timeouts({'run-timeout': 60, 'test-timeout': 0}),
+            (60, None))
+
+    def test_tempest_cmd_args(self):
+        self.patch_object(tempest.hookenv, 'config', return_value={})
+        self.patch_object(tempest.os.environ, 'copy', return_value={})
+        c = tempest.TempestCharm()
+        cmd, _ = c.tempest_cmd('/tmp/run', 'smoke', venv_dir='/tmp/venv',
+                               run_args=['--regex', 'api'], concurrency=3)
+        self.assertEqual(
+            cmd,
+            ['/tmp/venv/bin/tempest', 'run', '--regex', 'api',
+             '--concurrency', '3'])
+        cmd, _ = c.tempest_cmd('/tmp/run', 'smoke', concurrency=3)
+        self.assertEqual(
+            cmd, ['tox', '-e', 'smoke', '--', '--concurrency', '3'])
+        cmd, _ = c.tempest_cmd('/tmp/run', 'smoke', venv_dir='/tmp/venv',
+                               load_list='/tmp/t.tests', concurrency=3)
+        self.assertEqual(
+            cmd,
+            ['/tmp/venv/bin/tempest', 'run', '--load-list', '/tmp/t.tests',
+             '--concurrency', '3'])
+
+    def test_resolve_concurrency(self):
+        self.patch_object(tempest, 'action_arg', return_value='')
+        self.patch_object(tempest.hookenv, 'config',
+                          return_value={'concurrency': '3'})
+        c = tempest.TempestCharm()
+        self.assertEqual(c.resolve_concurrency(), 3)
+        self.action_arg.return_value = '2'
+        self.assertEqual(c.resolve_concurrency(), 2)
+
+    def test_resolve_concurrency_auto(self):
+        self.patch_object(tempest, 'action_arg', return_value='auto')
+        self.patch_object(tempest.hookenv, 'config', return_value={})
+        self.patch_object(tempest.os, 'cpu_count', return_value=8)
+        self.patch_object(tempest, 'TempestAdminAdapter')
+        self.patch_object(tempest.TempestCharm, 'cached_quota_headroom',
+                          return_value=None)
+        adapter = self.TempestAdminAdapter.return_value
+        adapter.get_quota_headroom.return_value = {'instances': 6}
+        c = tempest.TempestCharm()
+        self.assertEqual(c.resolve_concurrency(), 8)
+        self.assertEqual(c.resolve_concurrency(['identity']), 3)
+        self.TempestAdminAdapter.assert_called_once_with('identity')
+        adapter.get_quota_headroom.side_effect = Exception('no quotas')
+        self.assertEqual(c.resolve_concurrency(['identity']), 8)
+        # The cached headroom saves authenticating again
+        self.TempestAdminAdapter.reset_mock()
+        self.cached_quota_headroom.return_value = {'cores': 4}
+        self.assertEqual(c.resolve_concurrency(['identity']), 2)
+        self.assertFalse(self.TempestAdminAdapter.called)
+
+    def test_cached_quota_headroom(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache_file = os.path.join(tmpdir, 'discovery-cache.json')
+        self.patch_object(tempest.TempestCharm, 'DISCOVERY_CACHE',
+                          new=cache_file)
+        self.patch_object(tempest.hookenv, 'config',
+                          return_value={'discovery-cache-ttl': 60})
+        c = tempest.TempestCharm()
+        self.assertIsNone(c.cached_quota_headroom())
+        tempest.discovery.DiscoveryCache(cache_file, 'fp', 60).save(
+            {'image_info': {}})
+        self.assertIsNone(c.cached_quota_headroom())
+        tempest.discovery.DiscoveryCache(cache_file, 'fp', 60).save(
+            {'quota_headroom': {'instances': 3}})
+        self.assertEqual(c.cached_quota_headroom(), {'instances': 3})
+
+    def test_tempest_cmd_worker_file(self):
+        self.patch_object(tempest.hookenv, 'config', return_value={})
+        self.patch_object(tempest.os.environ, 'copy', return_value={})
+        c = tempest.TempestCharm()
+        cmd, env = c.tempest_cmd('/tmp/run', 'smoke', venv_dir='/tmp/venv',
+                                 worker_file='/tmp/w.yaml')
+        self.assertEqual(
+            cmd,
+            ['/tmp/venv/bin/stestr', 'run', '--worker-file', '/tmp/w.yaml'])
+        self.assertEqual(env['VIRTUAL_ENV'], '/tmp/venv')
+
+    def test_setup_venv(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        run_dir = os.path.join(tmpdir, 'tempest')
+        os.mkdir(run_dir)
+        with open(os.path.join(run_dir, 'requirements.txt'), 'w') as f:
+            f.write('pbr')
+        with open(os.path.join(run_dir, 'tox.ini'), 'w') as f:
+            f.write('[testenv]\ndeps = -c{env:TOX_CONSTRAINTS_FILE:'
+                    'https://example.com/upper-constraints.txt}\n')
+        self.patch_object(tempest.TempestCharm, 'TEMPEST_ROOT', new=tmpdir)
+        self.patch_object(tempest.TempestCharm, 'tempest_bundle',
+                          return_value=None)
+        self.patch_object(tempest.hookenv, 'config', return_value={})
+        self.patch_object(tempest.subprocess, 'check_call')
+        venv_dir = os.path.join(tmpdir, 'venv-br1')
+        self.check_call.side_effect = lambda cmd, **kwargs: (
+            os.path.isdir(venv_dir) or os.mkdir(venv_dir))
+        c = tempest.TempestCharm()
+        self.assertEqual(c.setup_venv('br1', run_dir), venv_dir)
+        self.check_call.assert_has_calls([
+            mock.call(['python3', '-m', 'venv', venv_dir]),
+            mock.call([venv_dir + '/bin/pip', 'install', '--upgrade', 'pip'],
+                      env=mock.ANY),
+            mock.call([venv_dir + '/bin/pip', 'install', '-c',
+                       'https://example.com/upper-constraints.txt', '-r',
+                       run_dir + '/requirements.txt'],
+                      env=mock.ANY),
+            mock.call([venv_dir + '/bin/pip', 'install', '-e', run_dir],
+                      env=mock.ANY)])
+        # Unchanged requirements reuse the virtualenv
+        self.check_call.reset_mock()
+        self.assertEqual(c.setup_venv('br1', run_dir), venv_dir)
+        self.assertFalse(self.check_call.called)
+        # Changed requirements rebuild it
+        with open(os.path.join(run_dir, 'requirements.txt'), 'w') as f:
+            f.write('pbr\nsix')
+        self.assertEqual(c.setup_venv('br1', run_dir), venv_dir)
+        self.assertTrue(self.check_call.called)
+
+    def test_constraints_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.patch_object(tempest.TempestCharm, 'tempest_bundle',
+                          return_value=None)
+        c = tempest.TempestCharm()
+        self.assertIsNone(c.constraints_file(tmpdir))
+        with open(os.path.join(tmpdir, 'tox.ini'), 'w') as f:
+            f.write('install_command = pip install -c{env:UPPER_CONSTRAINTS_'
+                    'FILE:https://example.com/stable/uc.txt} {opts}\n')
+        self.assertEqual(c.constraints_file(tmpdir),
+                         'https://example.com/stable/uc.txt')
+        # A bundle's own constraints are used in place of tox.ini's
+        self.tempest_bundle.return_value = tmpdir
+        self.assertIsNone(c.constraints_file(tmpdir))
+        with open(os.path.join(tmpdir, 'upper-constraints.txt'), 'w') as f:
+            f.write('pbr===5.0.0\n')
+        self.assertEqual(c.constraints_file(tmpdir),
+                         os.path.join(tmpdir, 'upper-constraints.txt'))
+
+    def test_setup_venv_bundle(self):
+        self.patch_object(tempest.workspace, 'requirements_hash')
+        self.patch_object(tempest.TempestCharm, 'tempest_bundle',
+                          return_value='/bundle')
+        self.patch_object(tempest.os.path, 'exists', return_value=False)
+        self.patch_object(tempest.hookenv, 'config', return_value={})
+        self.patch_object(tempest.subprocess, 'check_call')
+        pip = ['/var/lib/tempest/venv-br1/bin/pip', 'install', '--no-index',
+               '--find-links', '/bundle/wheelhouse']
+        with mock.patch("builtins.open"):
+            c = tempest.TempestCharm()
+            c.setup_venv('br1', '/tmp/run')
+        self.assertEqual(
+            self.check_call.call_args_list,
+            [mock.call(['python3', '-m', 'venv',
+                        '/var/lib/tempest/venv-br1']),
+             mock.call(pip + ['-r', '/tmp/run/requirements.txt'],
+                       env=mock.ANY),
+             mock.call(pip + ['-e', '/tmp/run'], env=mock.ANY)])
+
+    def test_setup_venv_fails(self):
+        self.patch_object(tempest.TempestCharm, 'tempest_bundle',
+                          return_value=None)
+        self.patch_object(tempest.workspace, 'requirements_hash')
+        self.patch_object(tempest.os.path, 'exists', return_value=False)
+        self.patch_object(tempest.hookenv, 'config', return_value={})
+        self.patch_object(tempest.shutil, 'rmtree')
+        self.patch_object(tempest.subprocess, 'check_call')
+        self.check_call.side_effect = tempest.subprocess.CalledProcessError(
+            1, 'pip')
+        c = tempest.TempestCharm()
+        self.assertIsNone(c.setup_venv('br1', '/tmp/run'))
+
+    def test_run_test_subunit(self):
+        self.patch_object(tempest.hookenv, 'action_set')
+        self.patch_object(tempest.hookenv, 'action_get')
+        self.action_get.return_value = {'branch': 'br1', 'slowest-tests': 1}
+        self.patch_object(tempest.hookenv, 'config',
+                          return_value='/var/lib/prometheus/node-exporter')
+        self.patch_object(tempest.TempestCharm, 'get_tempest_files')
+        self.patch_object(tempest.TempestCharm, 'setup_directories')
+        self.patch_object(tempest.TempestCharm, 'setup_git')
+        self.patch_object(tempest.TempestCharm, 'setup_venv',
+                          return_value=None)
+        self.patch_object(tempest.TempestCharm, 'resolve_concurrency',
+                          return_value=4)
+        self.patch_object(tempest.TempestCharm, 'resolve_timeouts',
+                          return_value=(3600, None))
+        self.patch_object(tempest.TempestCharm, 'execute_tox')
+        self.patch_object(tempest.TempestCharm, 'rotate_logs')
+        self.patch_object(tempest.timing, 'report', return_value={})
+        self.patch_object(tempest.metrics, 'record_run')
+        self.patch_object(tempest.TempestCharm, 'collect_subunit')
+        self.get_tempest_files.return_value = (
+            'git_dir1',
+            '/var/log/t.log',
+            '/var/tempest/run')
+        self.execute_tox.return_value = {'passed': '0'}
+        store = tempest.results.TestRecordStore()
+        store.status(test_id='t1', test_status='success')
+        slow = tempest.results.TestRecord('t2')
+        slow.status = 'fail'
+        slow.start, slow.stop = 10.0, 12.5
+        store.records['t2'] = slow
+        self.collect_subunit.return_value = store
+        self.patch_object(tempest.results, 'ResultsHistory')
+        self.ResultsHistory.return_value.record_run.return_value = 7
+        c = tempest.TempestCharm()
+        c.run_test('smoke')
+        self.ResultsHistory.assert_called_once_with(
+            '/var/lib/tempest/results.db')
+        self.ResultsHistory.return_value.record_run.assert_called_once_with(
+            store, logfile='/var/log/t.log', branch='br1', target='smoke',
+            rerun_of=None)
+        self.collect_subunit.assert_called_once_with(
+            '/var/tempest/run', '/var/log/t.subunit', 'smoke',
+            venv_dir=None)
+        self.record_run.assert_called_once_with(
+            '/var/lib/tempest/metrics.json', store, 'smoke',
+            phases=tempest.timing.PHASES.summary(),
+            textfile_dir='/var/lib/prometheus/node-exporter')
+        self.action_set.assert_called_once_with({
+            'passed': '1',
+            'failed': '1',
+            'skipped': '0',
+            'expected-fail': '0',
+            'unexpected-success': '0',
+            'timed-out': '0',
+            'tempest-logfile': '/var/log/t.log',
+            'subunit-file': '/var/log/t.subunit',
+            'slowest-tests': '2.500s t2',
+            'concurrency': 4,
+            'run-id': 7})
+
+    def test_invalidate_discovery(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'discovery-cache.json')
+        self.patch_object(tempest.TempestCharm, 'DISCOVERY_CACHE', new=path)
+        tempest.discovery.DiscoveryCache(path, 'fp', 60).save({})
+        c = tempest.TempestCharm()
+        c.invalidate_discovery()
+        self.assertFalse(os.path.exists(path))
+        c.invalidate_discovery()
+
+    def test_query_history(self):
+        self.patch_object(tempest.hookenv, 'action_set')
+        self.patch_object(tempest.hookenv, 'action_get')
+        self.patch_object(tempest.os.path, 'exists', return_value=True)
+        self.patch_object(tempest.results, 'ResultsHistory')
+        self.action_get.return_value = {
+            'test': 't1', 'percentile': 90, 'runs': 10, 'threshold': 50}
+        history = self.ResultsHistory.return_value
+        history.duration_percentile.return_value = 1.5
+        history.slower_tests.return_value = [('t2', 1.0, 2.0)]
+        c = tempest.TempestCharm()
+        c.query_history()
+        history.duration_percentile.assert_called_once_with(
+            't1', pct=90, runs=10)
+        history.slower_tests.assert_called_once_with(threshold=0.5, runs=10)
+        history.close.assert_called_once_with()
+        self.action_set.assert_called_once_with({
+            'percentile': 'p90 1.500s',
+            'slower-tests': '1.000s -> 2.000s t2'})
+
+    def test_collect_subunit(self):
+        self.patch_object(tempest.subprocess, 'Popen')
+        self.patch_object(tempest.results.TestRecordStore, 'feed')
+        with mock.patch("builtins.open"):
+            c = tempest.TempestCharm()
+            c.collect_subunit('/tmp/run', '/tmp/t.subunit', 'smoke',
+                              venv_dir='/tmp/venv')
+        self.Popen.assert_called_once_with(
+            ['/tmp/venv/bin/stestr', 'last', '--subunit'],
+            cwd='/tmp/run',
+            stdout=tempest.subprocess.PIPE)
+        self.assertTrue(self.feed.called)
+
+    def test_tox_envdir(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        c = tempest.TempestCharm()
+        self.assertEqual(c.subunit_cmd(tmpdir, 'smoke'),
+                         [tmpdir + '/.tox/smoke/bin/stestr', 'last',
+                          '--subunit'])
+        with open(os.path.join(tmpdir, 'tox.ini'), 'w') as f:
+            f.write('[testenv]\n'
+                    'setenv = OS_TEST_TIMEOUT={env:OS_TEST_TIMEOUT:1200}\n'
+                    '[testenv:smoke]\n'
+                    'envdir = .tox/tempest\n'
+                    '[testenv:pep8]\n'
+                    'envdir = {toxworkdir}/lint\n')
+        self.assertEqual(c.subunit_cmd(tmpdir, 'smoke'),
+                         [tmpdir + '/.tox/tempest/bin/stestr', 'last',
+                          '--subunit'])
+        self.assertEqual(c.tox_envdir(tmpdir, 'pep8'),
+                         tmpdir + '/.tox/lint')
+        self.assertEqual(c.tox_envdir(tmpdir, 'all'), tmpdir + '/.tox/all')
 
     def test_get_tempest_files(self):
         self.patch_object(tempest.time, 'strftime')
@@ -366,18 +1002,729 @@ class TestTempestCharm(Helper):
         self.patch_object(tempest.hookenv, 'action_set')
         self.patch_object(tempest.hookenv, 'action_get')
         self.action_get.return_value = {
-            'branch': 'br1'}
+            'branch': 'br1', 'run-tempest-args': '--regex tempest.api'}
         self.patch_object(tempest.TempestCharm, 'get_tempest_files')
         self.patch_object(tempest.TempestCharm, 'setup_directories')
         self.patch_object(tempest.TempestCharm, 'setup_git')
+        self.patch_object(tempest.TempestCharm, 'setup_venv',
+                          return_value='/var/lib/tempest/venv-br1')
+        self.patch_object(tempest.TempestCharm, 'resolve_concurrency',
+                          return_value=4)
+        self.patch_object(tempest.TempestCharm, 'resolve_timeouts',
+                          return_value=(3600, None))
         self.patch_object(tempest.TempestCharm, 'execute_tox')
-        self.patch_object(tempest.TempestCharm, 'parse_tempest_log')
+        self.patch_object(tempest.TempestCharm, 'rotate_logs')
+        self.patch_object(tempest.timing, 'report', return_value={})
+        self.patch_object(tempest.metrics, 'record_run')
+        self.patch_object(tempest.TempestCharm, 'collect_subunit')
+        self.collect_subunit.return_value.records = {}
         self.get_tempest_files.return_value = (
             'git_dir1',
             '/var/log/t.log',
             '/var/tempest/run')
-        self.parse_tempest_log.return_value = {'run_info': 'OK'}
+        self.execute_tox.return_value = {'run_info': 'OK'}
+        c = tempest.TempestCharm()
+        c.run_test('py39', ['identity'])
+        self.resolve_concurrency.assert_called_once_with(['identity'])
+        self.setup_venv.assert_called_once_with('br1', '/var/tempest/run')
+        self.execute_tox.assert_called_once_with(
+            '/var/tempest/run', '/var/log/t.log', 'py39',
+            venv_dir='/var/lib/tempest/venv-br1', worker_file=None,
+            run_args=['--regex', 'tempest.api'], concurrency=4,
+            load_list=None, run_timeout=3600, test_timeout=None)
+        self.action_set.assert_called_once_with(
+            {'run_info': 'OK', 'tempest-logfile': '/var/log/t.log',
+             'concurrency': 4})
+        self.report.assert_called_once_with(
+            tempest.timing.PHASES, tempest.timing.HTTP,
+            path='/var/log/t.timing.json')
+
+    def run_test_mocks(self, action_args):
+        self.patch_object(tempest.hookenv, 'action_set')
+        self.patch_object(tempest.hookenv, 'action_fail')
+        self.patch_object(tempest.hookenv, 'action_get',
+                          return_value=action_args)
+        self.patch_object(tempest.TempestCharm, 'get_tempest_files')
+        self.patch_object(tempest.TempestCharm, 'setup_directories')
+        self.patch_object(tempest.TempestCharm, 'setup_git')
+        self.patch_object(tempest.TempestCharm, 'setup_venv',
+                          return_value='/var/lib/tempest/venv-br1')
+        self.patch_object(tempest.TempestCharm, 'select_tests',
+                          return_value=['t1', 't2'])
+        self.patch_object(tempest.TempestCharm, 'schedule_tests',
+                          return_value='/var/log/t.workers.yaml')
+        self.patch_object(tempest.TempestCharm, 'resolve_concurrency',
+                          return_value=4)
+        self.patch_object(tempest.TempestCharm, 'resolve_timeouts',
+                          return_value=(None, None))
+        self.patch_object(tempest.TempestCharm, 'execute_tox',
+                          return_value={})
+        self.patch_object(tempest.TempestCharm, 'rotate_logs')
+        self.patch_object(tempest.timing, 'report', return_value={})
+        self.patch_object(tempest.metrics, 'record_run')
+        self.patch_object(tempest.TempestCharm, 'collect_subunit')
+        self.collect_subunit.return_value.records = {}
+        self.get_tempest_files.return_value = (
+            'git_dir1',
+            '/var/log/t.log',
+            '/var/tempest/run')
+
+    def test_run_test_scheduled(self):
+        self.run_test_mocks({'branch': 'br1', 'schedule': 'duration'})
+        c = tempest.TempestCharm()
+        c.run_test('smoke')
+        self.select_tests.assert_called_once_with(
+            {'branch': 'br1', 'schedule': 'duration'}, 'git_dir1',
+            '/var/tempest/run', 'smoke',
+            venv_dir='/var/lib/tempest/venv-br1')
+        self.schedule_tests.assert_called_once_with(
+            ['t1', 't2'], '/var/log/t.log', workers=4)
+        self.execute_tox.assert_called_once_with(
+            '/var/tempest/run', '/var/log/t.log', 'smoke',
+            venv_dir='/var/lib/tempest/venv-br1',
+            worker_file='/var/log/t.workers.yaml',
+            run_args=[], concurrency=4, load_list=None,
+            run_timeout=None, test_timeout=None)
+        self.action_set.assert_called_once_with({
+            'tempest-logfile': '/var/log/t.log',
+            'concurrency': 4,
+            'worker-file': '/var/log/t.workers.yaml',
+            'selected-tests': 2})
+
+    def test_run_test_selected(self):
+        self.run_test_mocks({'branch': 'br1', 'include-regex': 't'})
+        load_list = io.StringIO()
+        with mock.patch("builtins.open") as _open:
+            _open.return_value.__enter__.return_value = load_list
+            c = tempest.TempestCharm()
+            c.run_test('smoke')
+        _open.assert_called_once_with('/var/log/t.tests', 'w')
+        self.assertEqual(load_list.getvalue(), 't1\nt2\n')
+        self.assertFalse(self.schedule_tests.called)
+        self.execute_tox.assert_called_once_with(
+            '/var/tempest/run', '/var/log/t.log', 'smoke',
+            venv_dir='/var/lib/tempest/venv-br1', worker_file=None,
+            run_args=[], concurrency=4, load_list='/var/log/t.tests',
+            run_timeout=None, test_timeout=None)
+
+    def test_run_test_timed_out(self):
+        self.run_test_mocks({'branch': 'br1'})
+        self.execute_tox.return_value = {'passed': '1', 'timed-out': 'run'}
+        self.select_tests.return_value = None
+        c = tempest.TempestCharm()
+        c.run_test('smoke')
+        self.assertFalse(self.collect_subunit.called)
+        self.assertFalse(self.record_run.called)
+        self.action_set.assert_called_once_with({
+            'passed': '1', 'timed-out': 'run',
+            'tempest-logfile': '/var/log/t.log', 'concurrency': 4})
+
+    def test_run_test_no_selection(self):
+        self.run_test_mocks({'branch': 'br1', 'include-regex': 'x'})
+        self.select_tests.return_value = []
+        c = tempest.TempestCharm()
+        c.run_test('smoke')
+        self.action_fail.assert_called_once_with(
+            "No tests match the selection")
+        self.select_tests.side_effect = ValueError('bad regex')
+        c.run_test('smoke')
+        self.action_fail.assert_called_with('bad regex')
+        self.assertFalse(self.execute_tox.called)
+
+    def test_run_test_rerun_failed(self):
+        self.run_test_mocks({'branch': 'br1', 'rerun-failed': True})
+        self.patch_object(tempest.TempestCharm, 'failed_tests',
+                          return_value=(3, ['t2']))
+        store = tempest.results.TestRecordStore()
+        store.status(test_id='t2', test_status='success')
+        self.collect_subunit.return_value = store
+        self.patch_object(tempest.results, 'ResultsHistory')
+        history = self.ResultsHistory.return_value
+        history.record_run.return_value = 4
+        history.run_outcome.return_value = (3, {
+            't1': 'success', 't2': 'success', 't3': 'fail'})
+        with mock.patch("builtins.open"):
+            c = tempest.TempestCharm()
+            c.run_test('smoke')
+        self.assertFalse(self.select_tests.called)
+        self.execute_tox.assert_called_once_with(
+            '/var/tempest/run', '/var/log/t.log', 'smoke',
+            venv_dir='/var/lib/tempest/venv-br1', worker_file=None,
+            run_args=[], concurrency=4, load_list='/var/log/t.tests',
+            run_timeout=None, test_timeout=None)
+        history.record_run.assert_called_once_with(
+            store, logfile='/var/log/t.log', branch='br1', target='smoke',
+            rerun_of=3)
+        action_info = self.action_set.call_args[0][0]
+        self.assertEqual(action_info['rerun-of'], 3)
+        self.assertEqual(action_info['rerun-tests'], 1)
+        self.assertEqual(action_info['run-id'], 4)
+        self.assertEqual(action_info['passed'], '2')
+        self.assertEqual(action_info['failed'], '1')
+
+    def test_run_test_rerun_nothing(self):
+        self.run_test_mocks({'branch': 'br1', 'rerun-failed': True})
+        self.patch_object(tempest.TempestCharm, 'failed_tests',
+                          return_value=(None, []))
+        c = tempest.TempestCharm()
+        c.run_test('smoke')
+        self.action_fail.assert_called_once_with(
+            "No previous run to rerun tests from")
+        self.failed_tests.return_value = (3, [])
+        c.run_test('smoke')
+        self.action_set.assert_called_once_with(
+            {'rerun-of': 3, 'rerun-tests': 0})
+        self.assertFalse(self.execute_tox.called)
+
+    def test_failed_tests(self):
+        self.patch_object(tempest.os.path, 'exists', return_value=True)
+        self.patch_object(tempest.results, 'ResultsHistory')
+        self.patch_object(tempest.TempestCharm, 'test_index', return_value=[
+            'tempest.api.A.test_1', 'tempest.api.A.test_2',
+            'tempest.api.AB.test_3'])
+        history = self.ResultsHistory.return_value
+        history.recent_runs.return_value = [5]
+        history.run_outcome.return_value = (3, {
+            't1': 'success',
+            't2': 'fail',
+            't3': 'uxsuccess',
+            'setUpClass (tempest.api.A)': 'fail'})
+        c = tempest.TempestCharm()
+        self.assertEqual(
+            c.failed_tests('git', '/tmp/run', venv_dir='/tmp/venv'),
+            (3, ['t2', 't3', 'tempest.api.A.test_1',
+                 'tempest.api.A.test_2']))
+        history.run_outcome.assert_called_once_with(5)
+        history.close.assert_called_once_with()
+        self.assertEqual(c.failed_tests('git', '/tmp/run'),
+                         (3, ['t2', 't3']))
+        history.recent_runs.return_value = []
+        self.assertEqual(c.failed_tests('git', '/tmp/run'), (None, []))
+
+    def test_run_test_detached(self):
+        self.run_test_mocks({'branch': 'br1', 'detach': True,
+                             'include-regex': 't'})
+        self.patch_object(tempest.TempestCharm, 'start_detached',
+                          return_value='run_1')
+        self.patch_object(tempest.TempestCharm, 'tempest_cmd',
+                          return_value=(['tempest', 'run'], {}))
+        with mock.patch("builtins.open"):
+            c = tempest.TempestCharm()
+            c.run_test('smoke')
+        self.assertFalse(self.execute_tox.called)
+        spec = self.start_detached.call_args[0][0]
+        self.assertEqual(spec['cmd'], ['tempest', 'run'])
+        self.assertEqual(spec['total'], 2)
+        self.assertEqual(spec['subunit_cmd'],
+                         ['/var/lib/tempest/venv-br1/bin/stestr', 'last',
+                          '--subunit'])
+        self.assertEqual(spec['timing_file'], '/var/log/t.timing.json')
+        self.assertEqual(spec['metrics']['state'],
+                         '/var/lib/tempest/metrics.json')
+        self.assertIn('setup-git', spec['timing']['phases'])
+        self.assertFalse(self.report.called)
+        self.action_set.assert_called_once_with({
+            'tempest-logfile': '/var/log/t.log',
+            'concurrency': 4,
+            'selected-tests': 2,
+            'job-id': 'run_1'})
+
+    def test_start_detached(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.patch_object(tempest.TempestCharm, 'RUNS_DIR', new=tmpdir)
+        self.patch_object(tempest.hookenv, 'charm_dir',
+                          return_value='/charm')
+        self.patch_object(tempest.subprocess, 'Popen')
+        c = tempest.TempestCharm()
+        spec = {'logfile': '/var/log/run_1.log', 'total': 5}
+        self.assertEqual(c.start_detached(spec), 'run_1')
+        job_dir = os.path.join(tmpdir, 'run_1')
+        with open(os.path.join(job_dir, 'spec.json')) as f:
+            self.assertEqual(json.load(f), spec)
+        self.assertEqual(
+            self.Popen.call_args[0][0],
+            [tempest.sys.executable, '-m', 'charm.openstack.supervisor',
+             job_dir])
+        kwargs = self.Popen.call_args[1]
+        self.assertTrue(kwargs['start_new_session'])
+        self.assertEqual(kwargs['env']['PYTHONPATH'], '/charm/lib')
+        _, state = c.job_state()
+        self.assertEqual(state.load(), {'status': 'starting', 'total': 5})
+
+    def test_run_status(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.patch_object(tempest.TempestCharm, 'RUNS_DIR', new=tmpdir)
+        self.patch_object(tempest, 'action_arg', return_value='')
+        self.patch_object(tempest.hookenv, 'action_set')
+        self.patch_object(tempest.hookenv, 'action_fail')
+        c = tempest.TempestCharm()
+        c.run_status()
+        self.action_fail.assert_called_once_with("No such tempest run")
+        for job_id in ['run_1', 'run_2']:
+            os.mkdir(os.path.join(tmpdir, job_id))
+            tempest.supervisor.RunState(
+                os.path.join(tmpdir, job_id, 'state.json')).update(
+                    status='finished', done=3, total=3)
+        c.run_status()
+        self.action_set.assert_called_once_with({
+            'job-id': 'run_2', 'status': 'finished', 'progress': '3/3'})
+
+    def test_run_status_rotated(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.patch_object(tempest.TempestCharm, 'RUNS_DIR',
+                          new=os.path.join(tmpdir, 'runs'))
+        self.patch_object(tempest.TempestCharm, 'TEMPEST_LOGDIR', new=tmpdir)
+        self.patch_object(tempest, 'action_arg', return_value='run_1')
+        self.patch_object(tempest.hookenv, 'action_set')
+        os.makedirs(os.path.join(tmpdir, 'runs', 'run_1'))
+        tempest.supervisor.RunState(
+            os.path.join(tmpdir, 'runs', 'run_1', 'state.json')).update(
+                status='finished', result={
+                    'tempest-logfile': os.path.join(tmpdir, 'run_1.log'),
+                    'subunit-file': os.path.join(tmpdir, 'run_1.subunit')})
+        open(os.path.join(tmpdir, 'run_1.log.gz'), 'w').close()
+        c = tempest.TempestCharm()
+        c.run_status()
+        action_info = self.action_set.call_args[0][0]
+        self.assertEqual(action_info['tempest-logfile'],
+                         os.path.join(tmpdir, 'run_1.log.gz'))
+        self.assertEqual(action_info['subunit-file'], 'expired')
+
+    def test_rotate_logs(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.patch_object(tempest.TempestCharm, 'RUNS_DIR',
+                          new=os.path.join(tmpdir, 'runs'))
+        self.patch_object(tempest.TempestCharm, 'TEMPEST_LOGDIR', new=tmpdir)
+        self.patch_object(tempest.TempestCharm, 'active_runs',
+                          return_value=['run_2'])
+        self.patch_object(tempest.hookenv, 'charm_dir',
+                          return_value='/charm')
+        self.patch_object(tempest.hookenv, 'config', return_value={
+            'log-retention-runs': 10, 'log-retention-days': 0,
+            'log-retention-size': 100})
+        self.patch_object(tempest.subprocess, 'Popen')
+        c = tempest.TempestCharm()
+        c.rotate_logs()
+        self.assertEqual(
+            self.Popen.call_args[0][0],
+            [tempest.sys.executable, '-m', 'charm.openstack.logs', tmpdir,
+             '--runs-dir', os.path.join(tmpdir, 'runs'), '--max-runs', '10',
+             '--max-days', '0', '--max-megabytes', '100',
+             '--active', 'run_2'])
+        kwargs = self.Popen.call_args[1]
+        self.assertTrue(kwargs['start_new_session'])
+        self.assertEqual(kwargs['env']['PYTHONPATH'], '/charm/lib')
+
+    def test_active_runs(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.patch_object(tempest.TempestCharm, 'RUNS_DIR', new=tmpdir)
+        self.patch_object(tempest.supervisor, 'process_alive',
+                          return_value=True)
+        for job_id, status in [('run_1', 'finished'), ('run_2', 'running'),
+                               ('run_3', 'starting')]:
+            os.mkdir(os.path.join(tmpdir, job_id))
+            tempest.supervisor.RunState(
+                os.path.join(tmpdir, job_id, 'state.json')).update(
+                    status=status, pid=10)
+        c = tempest.TempestCharm()
+        self.assertEqual(c.active_runs(), ['run_2', 'run_3'])
+        self.process_alive.return_value = False
+        self.assertEqual(c.active_runs(), [])
+
+    def test_cancel_run(self):
+        self.patch_object(tempest, 'action_arg', return_value='run_1')
+        self.patch_object(tempest.hookenv, 'action_set')
+        self.patch_object(tempest.hookenv, 'action_fail')
+        self.patch_object(tempest.TempestCharm, 'job_state')
+        self.patch_object(tempest.os, 'kill')
+        state = mock.MagicMock()
+        state.load.return_value = {'status': 'running', 'pid': 42}
+        self.job_state.return_value = ('run_1', state)
+        c = tempest.TempestCharm()
+        c.cancel_run()
+        self.job_state.assert_called_once_with('run_1')
+        self.kill.assert_called_once_with(42, tempest.signal.SIGTERM)
+        self.action_set.assert_called_once_with(
+            {'job-id': 'run_1', 'status': 'cancelling'})
+        state.load.return_value = {'status': 'finished', 'pid': 42}
+        c.cancel_run()
+        self.action_fail.assert_called_once_with(
+            "Tempest run run_1 is finished")
+
+    def shard_mocks(self, tmpdir, leader=True):
+        self.patch_object(tempest.TempestCharm, 'SHARDS_DIR',
+                          new=os.path.join(tmpdir, 'shards'))
+        self.patch_object(tempest.TempestCharm, 'RUNS_DIR',
+                          new=os.path.join(tmpdir, 'runs'))
+        self.patch_object(tempest.hookenv, 'is_leader', return_value=leader)
+        self.patch_object(tempest.hookenv, 'local_unit',
+                          return_value='tempest/0')
+        self.patch_object(tempest.hookenv, 'relation_ids',
+                          return_value=['cluster:1'])
+        self.patch_object(tempest.hookenv, 'related_units',
+                          return_value=['tempest/2', 'tempest/1'])
+        self.patch_object(tempest.hookenv, 'relation_set')
+        self.patch_object(tempest.hookenv, 'relation_get')
+
+    def finished_job(self, tmpdir, job_id, **state):
+        job_dir = os.path.join(tmpdir, 'runs', job_id)
+        if not os.path.isdir(job_dir):
+            os.makedirs(job_dir)
+        with open(os.path.join(job_dir, 'spec.json'), 'w') as f:
+            json.dump({'subunit_file': '/nonexistent'}, f)
+        tempest.supervisor.RunState(
+            os.path.join(job_dir, 'state.json')).update(
+                **(state or {'status': 'finished'}))
+
+    def test_start_sharded_run(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.shard_mocks(tmpdir)
+        self.patch_object(tempest.TempestCharm, 'prepare_checkout',
+                          return_value=('git', '/var/log/run_1.log',
+                                        '/tmp/run', '/tmp/venv'))
+        self.patch_object(tempest.TempestCharm, 'select_tests',
+                          return_value=['t1', 't2', 't3', 't4'])
+        self.patch_object(tempest.TempestCharm, 'recorded_durations',
+                          return_value={'t1': 4.0, 't2': 3.0, 't3': 2.0,
+                                        't4': 1.0})
+        self.patch_object(tempest.TempestCharm, 'start_run',
+                          return_value={'job-id': 'run_1'})
+        c = tempest.TempestCharm()
+        self.assertEqual(
+            c.start_sharded_run('smoke', {'branch': 'br1'}),
+            {'job-id': 'run_1', 'shard-units': 3})
+        self.assertEqual(self.select_tests.call_args[0][0],
+                         {'branch': 'br1', 'schedule': 'duration'})
+        shards = {'tempest/0': ['t1'], 'tempest/1': ['t2'],
+                  'tempest/2': ['t3', 't4']}
+        request = json.loads(self.relation_set.call_args[1][
+            'relation_settings']['shard-request'])
+        self.assertEqual(request, {'id': 'run_1', 'branch': 'br1',
+                                   'target': 'smoke', 'shards': shards})
+        self.start_run.assert_called_once_with(
+            'smoke', {'branch': 'br1'}, None,
+            checkout=('git', '/var/log/run_1.log', '/tmp/run', '/tmp/venv'),
+            test_ids=['t1'], shard_of='run_1')
+        self.assertEqual(c.shard_state('run_1').load()['units'],
+                         {unit: None for unit in shards})
+
+    def test_start_sharded_run_few_tests(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.shard_mocks(tmpdir)
+        # The leader sorts after its peers
+        self.local_unit.return_value = 'tempest/3'
+        self.patch_object(tempest.TempestCharm, 'prepare_checkout',
+                          return_value=('git', '/var/log/run_1.log',
+                                        '/tmp/run', '/tmp/venv'))
+        self.patch_object(tempest.TempestCharm, 'select_tests',
+                          return_value=['t1', 't2'])
+        self.patch_object(tempest.TempestCharm, 'recorded_durations',
+                          return_value={})
+        self.patch_object(tempest.TempestCharm, 'start_run',
+                          return_value={'job-id': 'run_1'})
         c = tempest.TempestCharm()
-        c.run_test('py39')
+        self.assertEqual(
+            c.start_sharded_run('smoke', {'branch': 'br1'}),
+            {'job-id': 'run_1', 'shard-units': 2})
+        request = json.loads(self.relation_set.call_args[1][
+            'relation_settings']['shard-request'])
+        self.assertEqual(request['shards'],
+                         {'tempest/3': ['t1'], 'tempest/1': ['t2']})
+        self.assertEqual(self.start_run.call_args[1]['test_ids'], ['t1'])
+        self.assertEqual(c.shard_state('run_1').load()['units'],
+                         {'tempest/3': None, 'tempest/1': None})
+
+    def test_run_status_sharded_without_local_shard(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.shard_mocks(tmpdir)
+        self.patch_object(tempest, 'action_arg', return_value='run_1')
+        self.patch_object(tempest.hookenv, 'action_set')
+        c = tempest.TempestCharm()
+        c.new_shard_state('run_1', role='leader', job_id='run_1',
+                          units={'tempest/1': None})
+        c.run_status()
         self.action_set.assert_called_once_with(
-            {'run_info': 'OK', 'tempest-logfile': '/var/log/t.log'})
+            {'status': 'running', 'job-id': 'run_1',
+             'shards': '0/1 units done'})
+
+    def test_start_sharded_run_not_leader(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.shard_mocks(tmpdir, leader=False)
+        c = tempest.TempestCharm()
+        self.assertRaises(ValueError, c.start_sharded_run, 'smoke',
+                          {'branch': 'br1'})
+
+    def test_start_peer_shard(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.shard_mocks(tmpdir, leader=False)
+        self.patch_object(tempest, 'render_configs')
+        self.patch_object(tempest.TempestCharm, 'setup_directories')
+        self.patch_object(tempest.TempestCharm, 'prepare_checkout')
+        self.patch_object(tempest.TempestCharm, 'get_tempest_files',
+                          return_value=('git', '/var/log/run_5.log',
+                                        '/tmp/run'))
+        self.patch_object(tempest.TempestCharm, 'prepare_spec',
+                          return_value={'ref': 'br1'})
+        self.patch_object(tempest.TempestCharm, 'start_run',
+                          return_value={'job-id': 'run_5'})
+        self.relation_get.side_effect = lambda key, unit, rid: (
+            json.dumps({'id': 'run_1', 'branch': 'br1', 'target': 'smoke',
+                        'shards': {'tempest/0': ['t2']}})
+            if key == 'shard-request' and unit == 'tempest/1' else None)
+        self.finished_job(tmpdir, 'run_5', status='running',
+                          pid=os.getpid())
+        c = tempest.TempestCharm()
+        c.sync_shards(['identity'])
+        self.render_configs.assert_called_once_with(['identity'])
+        # The checkout is prepared by the detached run, not the hook
+        self.assertFalse(self.prepare_checkout.called)
+        venv_dir = c.venv_dir('br1')
+        self.prepare_spec.assert_called_once_with('br1', '/tmp/run',
+                                                  venv_dir)
+        self.start_run.assert_called_once_with(
+            'smoke', {'branch': 'br1'}, ['identity'],
+            checkout=('git', '/var/log/run_5.log', '/tmp/run', venv_dir),
+            test_ids=['t2'], shard_of='run_1', prepare={'ref': 'br1'})
+        self.assertEqual(c.shard_state('run_1').load(),
+                         {'role': 'peer', 'job_id': 'run_5',
+                          'published': False})
+        # The shard is only started once
+        c.sync_shards(['identity'])
+        self.assertEqual(self.start_run.call_count, 1)
+
+    def test_start_peer_shard_fails(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.shard_mocks(tmpdir, leader=False)
+        self.patch_object(tempest, 'render_configs',
+                          side_effect=OSError('no keystone'))
+        self.patch_object(tempest.TempestCharm, 'start_run')
+        self.relation_get.side_effect = lambda key, unit, rid: (
+            json.dumps({'id': 'run_1', 'branch': 'br1', 'target': 'smoke',
+                        'shards': {'tempest/0': ['t2']}})
+            if key == 'shard-request' and unit == 'tempest/1' else None)
+        c = tempest.TempestCharm()
+        c.sync_shards(['identity'])
+        self.assertFalse(self.start_run.called)
+        # The failure is reported to the leader rather than left pending
+        self.relation_set.assert_called_once_with(
+            relation_id='cluster:1',
+            relation_settings={'shard-result': json.dumps({
+                'id': 'run_1', 'records': {}, 'error': 'no keystone'})})
+        self.assertTrue(c.shard_state('run_1').load()['published'])
+
+    def test_publish_shard_results(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.shard_mocks(tmpdir, leader=False)
+        self.patch_object(tempest.TempestCharm, 'job_records')
+        self.job_records.return_value.dump.return_value = {
+            't2': ['success', 1.0, 2.0, None]}
+        c = tempest.TempestCharm()
+        c.new_shard_state('run_1', role='peer', job_id='run_5',
+                          published=False)
+        self.finished_job(tmpdir, 'run_5', status='running',
+                          pid=os.getpid())
+        c.publish_shard_results()
+        self.assertFalse(self.relation_set.called)
+        self.finished_job(tmpdir, 'run_5')
+        c.publish_shard_results()
+        self.relation_set.assert_called_once_with(
+            relation_id='cluster:1',
+            relation_settings={'shard-result': json.dumps({
+                'id': 'run_1',
+                'records': {'t2': ['success', 1.0, 2.0, None]}})})
+        self.assertTrue(c.shard_state('run_1').load()['published'])
+
+    def test_publish_shard_results_failed(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.shard_mocks(tmpdir, leader=False)
+        self.patch_object(tempest.TempestCharm, 'job_records')
+        c = tempest.TempestCharm()
+        c.new_shard_state('run_1', role='peer', job_id='run_5',
+                          published=False)
+        c.new_shard_state('run_2', role='peer', job_id='run_6',
+                          published=False)
+        self.finished_job(tmpdir, 'run_5', status='failed',
+                          error='pip failed')
+        c.publish_shard_results()
+        self.assertFalse(self.job_records.called)
+        self.relation_set.assert_has_calls([
+            mock.call(relation_id='cluster:1',
+                      relation_settings={'shard-result': json.dumps({
+                          'id': 'run_1', 'records': {},
+                          'error': 'pip failed'})}),
+            mock.call(relation_id='cluster:1',
+                      relation_settings={'shard-result': json.dumps({
+                          'id': 'run_2', 'records': {},
+                          'error': 'Shard run run_6 no longer exists'})})])
+
+    def test_merge_shard_results(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.shard_mocks(tmpdir)
+        self.patch_object(tempest.results, 'record_results',
+                          return_value={'passed': '2', 'run-id': 9})
+        self.patch_object(tempest.metrics, 'record_run')
+        self.patch_object(tempest.hookenv, 'config', return_value={})
+        published = {'tempest/1': json.dumps({
+            'id': 'run_1', 'records': {'t2': ['success', 0, 1, None]}})}
+        self.relation_get.side_effect = (
+            lambda key, unit, rid: published.get(unit))
+        c = tempest.TempestCharm()
+        c.new_shard_state('run_1', role='leader', job_id='run_1',
+                          branch='br1', target='smoke',
+                          units={'tempest/0': None, 'tempest/1': None})
+        self.finished_job(tmpdir, 'run_1', status='running',
+                          pid=os.getpid())
+        c.merge_shard_results()
+        self.assertEqual(
+            c.shard_state('run_1').load()['units'],
+            {'tempest/0': None,
+             'tempest/1': {'t2': ['success', 0, 1, None]}})
+        self.assertFalse(self.record_results.called)
+        self.finished_job(tmpdir, 'run_1')
+        c.merge_shard_results()
+        store = self.record_results.call_args[0][0]
+        self.assertEqual(sorted(store.records), ['t2'])
+        self.record_run.assert_called_once_with(
+            '/var/lib/tempest/metrics.json', store, 'smoke',
+            textfile_dir=None)
+        self.assertEqual(c.shard_state('run_1').load()['result'],
+                         {'passed': '2', 'run-id': 9})
+        # Report the merged results on the leader's job
+        self.patch_object(tempest, 'action_arg', return_value='run_1')
+        self.patch_object(tempest.hookenv, 'action_set')
+        c.run_status()
+        action_info = self.action_set.call_args[0][0]
+        self.assertEqual(action_info['shards'], 'merged')
+        self.assertEqual(action_info['run-id'], 9)
+
+    def test_merge_shard_results_deadline(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.shard_mocks(tmpdir)
+        self.patch_object(tempest.results, 'record_results',
+                          return_value={'passed': '1', 'run-id': 9})
+        self.patch_object(tempest.metrics, 'record_run')
+        self.patch_object(tempest.hookenv, 'config',
+                          return_value={'shard-timeout': 600,
+                                        'metrics-textfile-dir': ''})
+        self.patch_object(tempest.hookenv, 'log')
+        published = {'tempest/1': json.dumps({
+            'id': 'run_1', 'records': {}, 'error': 'no keystone'})}
+        self.relation_get.side_effect = (
+            lambda key, unit, rid: published.get(unit))
+        c = tempest.TempestCharm()
+        c.new_shard_state('run_1', role='leader', job_id='run_1',
+                          branch='br1', target='smoke', started=1000,
+                          units={'tempest/0': None, 'tempest/1': None,
+                                 'tempest/2': None})
+        self.patch_object(tempest.TempestCharm, 'job_records')
+        self.job_records.return_value.dump.return_value = {
+            't1': ['success', 0, 1, None]}
+        self.finished_job(tmpdir, 'run_1')
+        # tempest/2 has not published yet
+        c.merge_shard_results(now=1500)
+        self.assertNotIn('result', c.shard_state('run_1').load())
+        self.assertEqual(c.shard_state('run_1').load()['errors'],
+                         {'tempest/1': 'no keystone'})
+        c.merge_shard_results(now=1600)
+        store = self.record_results.call_args[0][0]
+        self.assertEqual(sorted(store.records), ['t1'])
+        self.assertEqual(c.shard_state('run_1').load()['result'],
+                         {'passed': '1', 'run-id': 9,
+                          'failed-shards': 'tempest/1: no keystone',
+                          'missing-shards': 'tempest/2'})
+        # Merged shards are not merged again
+        c.merge_shard_results(now=1700)
+        self.assertEqual(self.record_results.call_count, 1)
+
+    def test_list_tests(self):
+        self.patch_object(tempest.hookenv, 'config', return_value={})
+        self.patch_object(tempest.os.environ, 'copy', return_value={})
+        self.patch_object(tempest.subprocess, 'check_output')
+        self.check_output.return_value = b't1[smoke]\n\nt2[id-2,smoke]\n'
+        c = tempest.TempestCharm()
+        self.assertEqual(c.list_tests('/tmp/run', '/tmp/venv'),
+                         ['t1[smoke]', 't2[id-2,smoke]'])
+        self.check_output.assert_called_once_with(
+            ['/tmp/venv/bin/stestr', 'list'], cwd='/tmp/run', env=mock.ANY)
+        self.check_output.side_effect = OSError('no stestr')
+        self.assertEqual(c.list_tests('/tmp/run', '/tmp/venv'), [])
+
+    def test_test_index(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.patch_object(tempest.TempestCharm, 'git_head',
+                          return_value='abc')
+        self.patch_object(tempest.TempestCharm, 'list_tests',
+                          return_value=['t1', 't2'])
+        c = tempest.TempestCharm()
+        self.assertEqual(c.test_index(tmpdir, '/tmp/run', '/tmp/venv'),
+                         ['t1', 't2'])
+        self.list_tests.assert_called_once_with('/tmp/run', '/tmp/venv')
+        # The index is reused until HEAD moves
+        self.assertEqual(c.test_index(tmpdir, '/tmp/run', '/tmp/venv'),
+                         ['t1', 't2'])
+        self.assertEqual(self.list_tests.call_count, 1)
+        self.git_head.return_value = 'def'
+        c.test_index(tmpdir, '/tmp/run', '/tmp/venv')
+        self.assertEqual(self.list_tests.call_count, 2)
+
+    def test_select_tests(self):
+        self.patch_object(tempest.TempestCharm, 'test_index', return_value=[
+            'tempest.api.compute.test_a[smoke]',
+            'tempest.api.network.test_b[smoke]',
+            'tempest.scenario.test_c[slow]'])
+        c = tempest.TempestCharm()
+        self.assertIsNone(c.select_tests(
+            {}, 'git', '/tmp/run', 'smoke', venv_dir='/tmp/venv'))
+        self.assertEqual(
+            c.select_tests({'include-regex': 'tempest.api',
+                            'exclude-regex': 'network'},
+                           'git', '/tmp/run', 'smoke', venv_dir='/tmp/venv'),
+            ['tempest.api.compute.test_a[smoke]'])
+        self.assertEqual(
+            c.select_tests({'schedule': 'duration'},
+                           'git', '/tmp/run', 'smoke', venv_dir='/tmp/venv'),
+            ['tempest.api.compute.test_a[smoke]',
+             'tempest.api.network.test_b[smoke]'])
+        self.assertIsNone(c.select_tests(
+            {'schedule': 'duration', 'run-tempest-args': '--serial'},
+            'git', '/tmp/run', 'smoke', venv_dir='/tmp/venv'))
+        self.assertRaises(
+            ValueError, c.select_tests, {'include-regex': 'a'},
+            'git', '/tmp/run', 'smoke')
+        self.assertRaises(
+            ValueError, c.select_tests, {'include-regex': '(unclosed'},
+            'git', '/tmp/run', 'smoke', venv_dir='/tmp/venv')
+        self.assertRaises(
+            ValueError, c.select_tests, {'test-list': '/nonexistent'},
+            'git', '/tmp/run', 'smoke', venv_dir='/tmp/venv')
+
+    def test_schedule_tests(self):
+        self.patch_object(tempest.os.path, 'exists', return_value=True)
+        self.patch_object(tempest.os, 'cpu_count', return_value=2)
+        self.patch_object(tempest.results, 'ResultsHistory')
+        self.patch_object(tempest.scheduling, 'write_worker_file')
+        history = self.ResultsHistory.return_value
+        history.median_durations.return_value = {'t1': 1.0, 't3': 4.0}
+        c = tempest.TempestCharm()
+        self.assertEqual(
+            c.schedule_tests(['t1', 't2', 't3'], '/var/log/t.log'),
+            '/var/log/t.workers.yaml')
+        self.write_worker_file.assert_called_once_with(
+            [['t2', 't1'], ['t3']], '/var/log/t.workers.yaml')
+        history.close.assert_called_once_with()
@@ -0,0 +1,113 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import json
+import mock
+import os
+import shutil
+import tempfile
+
+import charms_openstack.test_utils as test_utils
+import charm.openstack.timing as timing
+
+
+class TestTiming(test_utils.PatchHelper):
+
+    def test_endpoint(self):
+        self.assertEqual(
+            timing.endpoint(
+                'GET', 'http://glance:9292/v2/images/'
+                       '5d3a6a1c-8a55-4d3f-9f4b-3b2a1c0d9e8f?x=1'),
+            'GET glance:9292/v2/images/{id}')
+        self.assertEqual(
+            timing.endpoint('GET', 'http://nova:8774/v2.1/flavors/42'),
+            'GET nova:8774/v2.1/flavors/{id}')
+        self.assertEqual(
+            timing.endpoint('POST', 'http://ks:5000/v3/auth/tokens'),
+            'POST ks:5000/v3/auth/tokens')
+
+    def test_phase_timer(self):
+        self.patch_object(timing.time, 'monotonic',
+                          side_effect=[10.0, 12.5, 20.0, 21.0, 30.0, 30.25])
+        phases = timing.PhaseTimer({'render': 1.0})
+        with phases.phase('setup-git'):
+            pass
+        with phases.phase('render'):
+            pass
+        with self.assertRaises(ValueError):
+            with phases.phase('execute-tox'):
+                raise ValueError()
+        self.assertEqual(phases.summary(), {
+            'render': 2.0, 'setup-git': 2.5, 'execute-tox': 0.25})
+        self.assertEqual(phases.report(),
+                         'render 2.000s\nsetup-git 2.500s\n'
+                         'execute-tox 0.250s')
+
+    def response(self, method, url, status=200, headers=None,
+                 content=b'', seconds=0.5):
+        response = mock.MagicMock(status_code=status, content=content,
+                                  headers=headers or {})
+        response.request.method = method
+        response.request.url = url
+        response.elapsed = datetime.timedelta(seconds=seconds)
+        return response
+
+    def test_http_stats(self):
+        stats = timing.HTTPStats()
+        stats.hook(self.response('GET', 'http://nova/v2.1/flavors/1',
+                                 headers={'Content-Length': '100'}))
+        stats.hook(self.response('GET', 'http://nova/v2.1/flavors/2',
+                                 status=404, content=b'missing',
+                                 seconds=0.25))
+        stats.hook(self.response('POST', 'http://ks/v3/auth/tokens',
+                                 content=b'token', seconds=1.0))
+        self.assertEqual(stats.summary(), {
+            'GET nova/v2.1/flavors/{id}': {
+                'requests': 2, 'errors': 1, 'bytes': 107, 'seconds': 0.75},
+            'POST ks/v3/auth/tokens': {
+                'requests': 1, 'errors': 0, 'bytes': 5, 'seconds': 1.0}})
+        self.assertEqual(
+            stats.report(),
+            '1 requests 1.000s 5B POST ks/v3/auth/tokens\n'
+            '2 requests 0.750s 107B GET nova/v2.1/flavors/{id} (1 failed)')
+
+    def test_http_stats_stream(self):
+        stats = timing.HTTPStats()
+        response = self.response('GET', 'http://glance/v2/images/1/file')
+        type(response).content = mock.PropertyMock(
+            side_effect=AssertionError('streamed body read'))
+        stats.hook(response, stream=True)
+        self.assertEqual(
+            stats.summary()['GET glance/v2/images/{id}/file']['bytes'], 0)
+
+    def test_report(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        phases = timing.PhaseTimer({'render': 1.0})
+        http = timing.HTTPStats()
+        self.assertEqual(timing.report(phases, http),
+                         {'phase-times': 'render 1.000s'})
+        http.record('GET', 'http://nova/v2.1/limits', 200, 10, 0.5)
+        path = os.path.join(tmpdir, 'run_1.timing.json')
+        info = timing.report(phases, http, path=path)
+        self.assertEqual(info['timing-file'], path)
+        self.assertEqual(info['http-requests'],
+                         '1 requests 0.500s 10B GET nova/v2.1/limits')
+        with open(path) as f:
+            self.assertEqual(json.load(f), {
+                'phases': {'render': 1.0},
+                'http': {'GET nova/v2.1/limits': {
+                    'requests': 1, 'errors': 0, 'bytes': 10,
+                    'seconds': 0.5}}})
@@ -0,0 +1,90 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import os
+import shutil
+import subprocess
+import tempfile
+
+import charms_openstack.test_utils as test_utils
+import charm.openstack.workspace as workspace
+
+
+class TestWorkspace(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.run_dir = os.path.join(self.tmpdir, 'run')
+        os.mkdir(self.run_dir)
+        with open(os.path.join(self.run_dir, 'requirements.txt'), 'w') as f:
+            f.write('pbr\n')
+
+    def test_venv_current(self):
+        venv_dir = os.path.join(self.tmpdir, 'venv')
+        self.assertFalse(workspace.venv_current(venv_dir, self.run_dir))
+        os.mkdir(venv_dir)
+        with open(os.path.join(venv_dir, workspace.VENV_STAMP), 'w') as f:
+            f.write(workspace.requirements_hash(self.run_dir))
+        self.assertTrue(workspace.venv_current(venv_dir, self.run_dir))
+        with open(os.path.join(self.run_dir, 'requirements.txt'), 'a') as f:
+            f.write('six\n')
+        self.assertFalse(workspace.venv_current(venv_dir, self.run_dir))
+
+    def test_build_venv_fails(self):
+        venv_dir = os.path.join(self.tmpdir, 'venv')
+
+        def check_call(cmd, env=None):
+            os.makedirs(venv_dir, exist_ok=True)
+            if '-r' in cmd:
+                raise subprocess.CalledProcessError(1, cmd)
+
+        self.patch_object(workspace.subprocess, 'check_call',
+                          side_effect=check_call)
+        self.assertRaises(subprocess.CalledProcessError,
+                          workspace.Workspace('/tmp/mirror').build_venv,
+                          venv_dir, self.run_dir, bundle='/tmp/bundle')
+        self.assertFalse(os.path.exists(venv_dir))
+        # A bundle only installs from its wheelhouse
+        self.assertEqual(
+            self.check_call.call_args[0][0][:5],
+            [os.path.join(venv_dir, 'bin', 'pip'), 'install', '--no-index',
+             '--find-links', '/tmp/bundle/wheelhouse'])
+
+    def test_prepare(self):
+        self.patch_object(workspace.Workspace, 'git')
+        self.patch_object(workspace.Workspace, 'build_venv')
+        self.patch_object(workspace, 'venv_current', return_value=False)
+        mirror = os.path.join(self.tmpdir, 'mirror')
+        os.mkdir(mirror)
+        spec = {'mirror': mirror, 'git_url': 'https://git/tempest',
+                'fetch': False, 'run_dir': self.run_dir, 'ref': '33.0.0',
+                'conf': None, 'venv_dir': '/tmp/venv', 'bundle': None,
+                'env': {'https_proxy': 'http://proxy'}}
+        workspace.prepare(spec)
+        self.git.assert_has_calls([
+            mock.call('worktree', 'prune', cwd=mirror),
+            mock.call('worktree', 'add', '--force', '--detach',
+                      self.run_dir, '33.0.0', cwd=mirror)])
+        self.build_venv.assert_called_once_with(
+            '/tmp/venv', self.run_dir, bundle=None)
+        # A current virtualenv is reused and a stale mirror fetched
+        self.git.reset_mock()
+        self.venv_current.return_value = True
+        workspace.prepare(dict(spec, fetch=True))
+        self.git.assert_any_call('fetch', '--prune', '--tags', 'origin',
+                                 cwd=mirror)
+        self.assertEqual(self.build_venv.call_count, 1)
@@ -24,7 +24,13 @@ class TestRegisteredHooks(test_utils.TestRegisteredHooks):
             'when': {
                 'install_packages': ('charm.installed',),
                 'assess_status': ('charm.installed',),
-            }
+            },
+            'hook': {
+                'sync_shards': ('cluster-relation-changed', 'update-status'),
+                'invalidate_discovery': ('identity-admin-relation-changed',
+                                         'identity-admin-relation-departed'),
+                'rotate_logs': ('update-status',),
+            },
         }
         # test that the hooks were registered via the
         # reactive.barbican_handlers